@@ -0,0 +1,166 @@
+"""
+Compact global descriptors: PCA-whitening projection and reduced-precision storage.
+
+NetVLAD descriptors have 32768 float32 dimensions (128 KB each). A PCA-whitening
+projection fit offline on the descriptors of a place keeps the leading
+components (e.g. 512 or 4096), and StoredDescriptors keeps database descriptors
+as float32, float16 or int8 (per-descriptor scale), so retrieval shrinks
+8-64x in memory and compute. Fit a projection with:
+    python -m UNav_core.src.feature.descriptor_projection /mnt/data/UNav-IO/data/New_York_City/global_features.h5 parameters/netvlad_pca_4096.npz --dim 4096
+and reference it from feature.global.netvlad.projection.
+"""
+import argparse
+
+import h5py
+import numpy as np
+import torch
+
+DESCRIPTOR_DTYPES = ('float32', 'float16', 'int8')
+
+class DescriptorProjection():
+    """
+    x -> normalize((x - mean) @ components), with the whitening folded into components [D x d].
+    """
+    def __init__(self, mean, components, device):
+        self.device = device
+        self.mean = torch.as_tensor(np.asarray(mean, dtype=np.float32), device=device)
+        self.components = torch.as_tensor(np.asarray(components, dtype=np.float32), device=device)
+        self.input_dim, self.dim = self.components.shape
+
+    @staticmethod
+    def fit(descriptors, dim, whiten=True, seed=0):
+        """
+        Fit on database descriptors [N x D], offline. Returns (mean [D], components [D x d]).
+        """
+        # Only needed to fit projections offline
+        from sklearn.decomposition import PCA
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        dim = min(dim, descriptors.shape[0], descriptors.shape[1])
+        pca = PCA(n_components=dim, whiten=whiten, svd_solver='randomized', random_state=seed)
+        pca.fit(descriptors)
+        components = pca.components_.T
+        if whiten:
+            components = components / np.sqrt(pca.explained_variance_ + 1e-9)[None]
+        return pca.mean_.astype(np.float32), components.astype(np.float32)
+
+    def save(self, path):
+        np.savez(path, mean=self.mean.cpu().numpy(), components=self.components.cpu().numpy())
+
+    @classmethod
+    def load(cls, path, device):
+        with np.load(path) as data:
+            return cls(data['mean'], data['components'], device)
+
+    def __call__(self, descriptors, chunk_size=4096):
+        """
+        Project descriptors [N x D] (tensor or array), returning L2-normalized float32 [N x d] on the device.
+        """
+        descriptors = torch.as_tensor(descriptors)
+        projected = []
+        for start in range(0, descriptors.shape[0], chunk_size):
+            chunk = descriptors[start:start + chunk_size].to(self.device, dtype=torch.float32)
+            projected.append(torch.nn.functional.normalize((chunk - self.mean) @ self.components, dim=1))
+        if len(projected) == 0:
+            return torch.zeros((0, self.dim), dtype=torch.float32, device=self.device)
+        return torch.cat(projected)
+
+class StoredDescriptors():
+    """
+    Database descriptors [N x d] kept on the device as float32, float16 or int8 with a per-row scale.
+    similarity() always returns float32 inner products, computed chunk-wise so int8 rows are
+    only expanded one chunk at a time.
+    """
+    def __init__(self, descriptors, dtype='float32', device='cpu', chunk_size=8192):
+        if dtype not in DESCRIPTOR_DTYPES:
+            raise ValueError(f"Unknown descriptor dtype {dtype}, expected one of {DESCRIPTOR_DTYPES}")
+        self.dtype = dtype
+        self.device = device
+        self.chunk_size = chunk_size
+
+        descriptors = torch.as_tensor(descriptors).to(device, dtype=torch.float32)
+        if descriptors.dim() == 1:
+            descriptors = descriptors[None]
+        self.dim = descriptors.shape[1] if descriptors.dim() == 2 else 0
+        self.scales = None
+        if dtype == 'int8':
+            self.scales = descriptors.abs().amax(dim=1).clamp(min=1e-12) / 127
+            self.data = torch.round(descriptors / self.scales[:, None]).to(torch.int8)
+        elif dtype == 'float16':
+            self.data = descriptors.half()
+        else:
+            self.data = descriptors
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @classmethod
+    def concatenate(cls, parts, device):
+        """
+        Rows of several StoredDescriptors of one dtype as a single one, without re-quantizing.
+        :param parts: List of (StoredDescriptors, rows), rows None for all of them.
+        """
+        parts = [(part, rows) for part, rows in parts if len(part) > 0 and (rows is None or len(rows) > 0)]
+        if len(parts) == 0:
+            return cls(np.zeros((0, 0), dtype=np.float32), 'float32', device)
+        if len(parts) == 1 and parts[0][1] is None:
+            return parts[0][0]
+
+        first = parts[0][0]
+        stored = cls.__new__(cls)
+        stored.dtype, stored.device, stored.chunk_size, stored.dim = first.dtype, device, first.chunk_size, first.dim
+        select = lambda tensor, rows: tensor if rows is None else tensor[torch.as_tensor(rows, dtype=torch.long, device=tensor.device)]
+        stored.data = torch.cat([select(part.data, rows).to(device) for part, rows in parts])
+        stored.scales = None if first.scales is None else torch.cat([select(part.scales, rows).to(device) for part, rows in parts])
+        return stored
+
+    @property
+    def nbytes(self):
+        return self.data.element_size() * self.data.nelement() + (self.scales.element_size() * self.scales.nelement() if self.scales is not None else 0)
+
+    def _compute_dtype(self):
+        # Half matmuls are only worth it (and only implemented everywhere) on the GPU
+        return torch.float16 if self.dtype != 'float32' and torch.device(self.device).type == 'cuda' else torch.float32
+
+    def similarity(self, queries, rows=None):
+        """
+        Inner products [B x N] (or [B x len(rows)]) between queries [B x d] and the stored descriptors.
+        """
+        compute_dtype = self._compute_dtype()
+        queries = queries.to(self.device, dtype=compute_dtype)
+        data = self.data if rows is None else self.data[rows]
+        scales = None if self.scales is None else (self.scales if rows is None else self.scales[rows])
+
+        if self.dtype == 'float32':
+            return queries.float() @ data.T
+
+        chunks = []
+        for start in range(0, data.shape[0], self.chunk_size):
+            chunk = queries @ data[start:start + self.chunk_size].to(compute_dtype).T
+            chunk = chunk.float()
+            if scales is not None:
+                chunk = chunk * scales[start:start + self.chunk_size][None]
+            chunks.append(chunk)
+        if len(chunks) == 0:
+            return torch.zeros((queries.shape[0], 0), dtype=torch.float32, device=self.device)
+        return torch.cat(chunks, dim=1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit a PCA-whitening projection on the global descriptors of a place.')
+    parser.add_argument('features', help='global_features.h5 of the place')
+    parser.add_argument('output', help='output .npz, referenced from feature.global.<extractor>.projection')
+    parser.add_argument('--dim', type=int, default=4096)
+    parser.add_argument('--no_whiten', action='store_true')
+    parser.add_argument('--max_samples', type=int, default=50000, help='fit on a random subset of this size')
+    args = parser.parse_args()
+
+    with h5py.File(args.features, 'r') as f:
+        descriptors = f['descriptors'][:].astype(np.float32)
+    if len(descriptors) > args.max_samples:
+        descriptors = descriptors[np.random.default_rng(0).choice(len(descriptors), args.max_samples, replace=False)]
+
+    mean, components = DescriptorProjection.fit(descriptors, args.dim, whiten=not args.no_whiten)
+    DescriptorProjection(mean, components, 'cpu').save(args.output)
+    print(f"Fit {components.shape[0]} -> {components.shape[1]} projection on {len(descriptors)} descriptors: {args.output}")
+
+if __name__ == '__main__':
+    main()
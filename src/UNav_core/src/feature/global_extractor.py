@@ -1,5 +1,6 @@
 from UNav_core.src.third_party.global_feature.pytorch_NetVlad.Feature_Extractor import NetVladFeatureExtractor
 from UNav_core.src.third_party.global_feature.mixVPR_main.main import VPRModel
+from UNav_core.src.feature.descriptor_projection import DescriptorProjection
 from os.path import join
 import torch
 
@@ -9,8 +10,31 @@ class Global_Extractors():
         self.root = config['IO_root']
         self.extractor = config['feature']['global']
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")  # Set device
+        self.loaded = {}  # Built extractors, so get() and get_batch() share one model
+
+        # Optional PCA-whitening of the descriptors and the precision database descriptors are stored in
+        self.projection = None
+        self.descriptor_dtype = 'float32'
+        for extractor, content in self.extractor.items():
+            if content.get('projection'):
+                self.projection = DescriptorProjection.load(join(self.root, content['projection']), self.device)
+            self.descriptor_dtype = content.get('descriptor_dtype', 'float32')
+            break
+
+    def _projected(self, extractor):
+        if self.projection is None:
+            return extractor
+        return lambda images: self.projection(extractor(images))
+
+    def get_projection(self):
+        """
+        Projection applied to every extracted descriptor, database descriptors have to go through it too. None if unused.
+        """
+        return self.projection
 
     def netvlad(self, content):
+        if 'netvlad' in self.loaded:
+            return self.loaded['netvlad']
         model = NetVladFeatureExtractor(join(self.root, content['ckpt_path']), 
                                         arch=content['arch'],
                                         num_clusters=content['num_clusters'],
@@ -20,6 +44,7 @@ class Global_Extractors():
         if hasattr(model, 'model'):  # Check if it has a model attribute
             model.model = model.model.to(self.device)  # Move model to the GPU
          # Move NetVlad model to GPU if available
+        self.loaded['netvlad'] = model
         return model
 
     def mixvpr(self, content):
@@ -37,10 +62,19 @@ class Global_Extractors():
     def get(self):
         for extractor, content in self.extractor.items():
             if extractor == 'netvlad':
-                return self.netvlad(content).feature
+                return self._projected(self.netvlad(content).feature)
             if extractor == 'mixvpr':
                 return self.mixvpr(content)
             if extractor == 'vlad':
                 pass
             if extractor == 'bovw':
                 pass
+
+    def get_batch(self):
+        """
+        Batched extractor taking a list of images and returning an (N, D) tensor, None if unsupported.
+        """
+        for extractor, content in self.extractor.items():
+            if extractor == 'netvlad':
+                return self._projected(self.netvlad(content).features)
+        return None
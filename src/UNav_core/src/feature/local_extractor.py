@@ -1,15 +1,60 @@
 from UNav_core.src.third_party.local_feature.SuperPoint_SuperGlue.base_model import dynamic_load
 from UNav_core.src.third_party.local_feature.SuperPoint_SuperGlue import extractors,matchers
 from UNav_core.src.third_party.local_feature.LightGlue.lightglue import LightGlue
+from UNav_core.src.feature import model_registry
+from collections import OrderedDict
+import threading
 import numpy as np
 import torch
 import cv2
 
+# cv2.COLOR_BGR2GRAY weights, in BGR channel order
+BGR_TO_GRAY = [0.114, 0.587, 0.299]
+
+class PinnedUploader():
+    """
+    Uploads stacks of uint8 frames to the device through page-locked host buffers reused across calls.
+
+    One buffer is kept per batch shape (a few recent shapes at most), and a CUDA event
+    recorded after each copy guards the buffer against being refilled while the
+    previous asynchronous copy out of it is still running.
+    """
+    def __init__(self, device, max_shapes=4):
+        self.device = torch.device(device)
+        self.max_shapes = max_shapes
+        self.buffers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def upload(self, images):
+        images = [np.asarray(image) for image in images]
+        if self.device.type != 'cuda' or images[0].dtype != np.uint8:
+            return torch.from_numpy(np.stack(images)).to(self.device)
+
+        shape = (len(images),) + images[0].shape
+        with self.lock:
+            buffer, copied = self.buffers.pop(shape, (None, None))
+            if buffer is None:
+                buffer = torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+            else:
+                copied.synchronize()
+            np.stack(images, out=buffer.numpy())
+            uploaded = buffer.to(self.device, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+
+            self.buffers[shape] = (buffer, copied)
+            while len(self.buffers) > self.max_shapes:
+                self.buffers.popitem(last=False)
+        return uploaded
+
 class Superpoint():
     def __init__(self,device,conf):
         Model_sp = dynamic_load(extractors, conf['detector_name'])
-        self.local_feature_extractor=Model_sp({'name':conf['detector_name'],'nms_radius':conf['nms_radius'],'max_keypoints':conf['max_keypoints']}).eval().to(device)
+        sp_conf = {'name':conf['detector_name'],'nms_radius':conf['nms_radius'],'max_keypoints':conf['max_keypoints']}
+        self.local_feature_extractor=model_registry.get_model(conf['detector_name'], sp_conf, device, lambda: Model_sp(sp_conf), warmup=model_registry.warmup_superpoint)
         self.device=device
+        self.uploader = PinnedUploader(device)
+        self.gray_weights = torch.tensor(BGR_TO_GRAY, dtype=torch.float32, device=device)
 
     def prepare_data(self, image):
         image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY).astype(np.float32)
@@ -21,28 +66,75 @@ class Superpoint():
         data0 = self.prepare_data(image0)
         pred0 = self.local_feature_extractor(data0.to(self.device))
         del data0
-        torch.cuda.empty_cache()
         pred0 = {k: v[0].cpu().detach().numpy() for k, v in pred0.items()}
         if 'keypoints' in pred0:
             pred0['keypoints'] = (pred0['keypoints'] + .5) - .5
         pred0.update({'image_size': np.array([image0.shape[1], image0.shape[0]])})
         return pred0
 
+    def extract_local_features_batch(self, images):
+        """
+        Batched counterpart of extract_local_features: one forward pass per group of equally sized images.
+        Returns one feature dictionary per image, in the order of images.
+        """
+        groups = {}
+        for index, image in enumerate(images):
+            groups.setdefault(image.shape[:2], []).append(index)
+
+        preds = [None] * len(images)
+        for (height, width), indices in groups.items():
+            data = torch.cat([self.prepare_data(images[index]) for index in indices]).to(self.device)
+            pred = self.local_feature_extractor(data)
+            del data
+            for row, index in enumerate(indices):
+                pred0 = {k: v[row].cpu().detach().numpy() for k, v in pred.items()}
+                pred0['image_size'] = np.array([width, height])
+                preds[index] = pred0
+        return preds
+
+    def extract_local_features_device(self, images):
+        """
+        Device-native extraction: frames go up as uint8 through reused pinned buffers, grayscale conversion
+        runs on the device and the outputs stay device tensors for the matcher, with no numpy round trip.
+        One forward pass per group of equally sized images, each image keeping its own keypoint count.
+        :return: One dictionary per image of keypoints [N x 2], scores [N], descriptors [D x N] and image_size [2].
+        """
+        groups = {}
+        for index, image in enumerate(images):
+            groups.setdefault(np.asarray(image).shape, []).append(index)
+
+        preds = [None] * len(images)
+        with torch.inference_mode():
+            for shape, indices in groups.items():
+                pixels = self.uploader.upload([images[index] for index in indices]).float()
+                gray = pixels @ self.gray_weights if pixels.dim() == 4 else pixels
+                pred = self.local_feature_extractor(gray.div_(255).unsqueeze(1))
+                image_size = torch.tensor([shape[1], shape[0]], dtype=torch.float32, device=self.device)
+                for row, index in enumerate(indices):
+                    preds[index] = {k: v[row] for k, v in pred.items()}
+                    preds[index]['image_size'] = image_size
+        return preds
+
 class Local_extractor():
     def __init__(self,configs):
         self.configs=configs
         self.device='cuda' if torch.cuda.is_available() else 'cpu'
 
     def lightglue(self,conf):
-        Model_lg=LightGlue(pretrained='superpoint', **conf['match_conf']).eval()
+        lg_conf = {'pretrained': 'superpoint', **conf['match_conf']}
+        Model_lg=model_registry.get_model('lightglue', lg_conf, self.device, lambda: LightGlue(pretrained='superpoint', **conf['match_conf']), warmup=model_registry.warmup_lightglue)
         return Model_lg
     
     def superglue(self,conf):
         Model_sg = dynamic_load(matchers, conf['matcher_name'])
-        return Model_sg({'name':conf['matcher_name'],'weights':conf['weights'],'sinkhorn_iterations':conf['sinkhorn_iterations']}).eval()
+        sg_conf = {'name':conf['matcher_name'],'weights':conf['weights'],'sinkhorn_iterations':conf['sinkhorn_iterations']}
+        return model_registry.get_model(conf['matcher_name'], sg_conf, self.device, lambda: Model_sg(sg_conf))
 
     def extractor(self):
         for name,content in self.configs.items():
+            if name in ('superpoint+superglue', 'superpoint+lightglue') and content.get('device_native', False):
+                superpoint=Superpoint(self.device,content)
+                return lambda image: superpoint.extract_local_features_device([image])[0]
             if name=='superpoint+superglue':
                 superpoint=Superpoint(self.device,self.configs['superpoint+superglue'])
                 return superpoint.extract_local_features
@@ -55,6 +147,15 @@ class Local_extractor():
             elif name=='surf':
                 pass
 
+    def batch_extractor(self):
+        for name,content in self.configs.items():
+            if name in ('superpoint+superglue', 'superpoint+lightglue'):
+                superpoint=Superpoint(self.device,self.configs[name])
+                if content.get('device_native', False):
+                    return superpoint.extract_local_features_device
+                return superpoint.extract_local_features_batch
+        return None
+
     def matcher(self):
         for name,content in self.configs.items():
             if name == 'superpoint+superglue':
@@ -3,34 +3,70 @@ from UNav_core.src.third_party.local_feature.LightGlue.lightglue.utils import lo
 import torch
 import numpy as np
 
+def filter_matches_to_landmarks(matches, keypoints0, keypoints1, landmarks, valid):
+    """
+    Keep the matches whose database keypoint has a 3D landmark, for a whole batch at once.
+    :param matches: [B x M] index of the matched database keypoint for every query keypoint, -1 if unmatched.
+    :param keypoints0: [M x 2] query keypoints.
+    :param keypoints1: [B x N x 2] database keypoints.
+    :param landmarks: [B x N x 3] dense keypoint -> landmark lookup of the database frames.
+    :param valid: [B x N] True where the database keypoint has a landmark.
+    :return: Per batch element lists of pts0 [K x 2], pts1 [K x 2] and lms [K x 3] numpy arrays,
+             ordered by query keypoint like the former per-keypoint loop.
+    """
+    matches = matches.long()
+    safe_matches = matches.clamp(min=0)
+    keep = (matches > -1) & torch.gather(valid, 1, safe_matches)
+
+    batch_ids, query_ids = torch.nonzero(keep, as_tuple=True)
+    db_ids = safe_matches[batch_ids, query_ids]
+
+    pts0 = keypoints0[query_ids].cpu().numpy()
+    pts1 = keypoints1[batch_ids, db_ids].cpu().numpy()
+    lms = landmarks[batch_ids, db_ids].cpu().numpy()
+
+    # nonzero is row-major, so each batch element is a contiguous block
+    splits = np.cumsum(keep.sum(dim=1).cpu().numpy())[:-1]
+    return np.split(pts0, splits), np.split(pts1, splits), np.split(lms, splits)
+
+def query_tensors(feats0, device):
+    """
+    Query features as [1 x ...] tensors on the device. Features from the device-native SuperPoint
+    extraction are used in place, numpy features are uploaded.
+    """
+    return {k: (v if torch.is_tensor(v) else torch.from_numpy(np.asarray(v))).to(device).unsqueeze(0) for k, v in feats0.items()}
+
 class Local_matcher():
     device='cuda' if torch.cuda.is_available() else "cpu"
-    def __init__(self, frame_name, map_data, threshold = 10, **feature_configs):
+    def __init__(self, threshold = 10, **feature_configs):
+        # Shared, warmed model from the process-wide registry
         local_feature = Local_extractor(feature_configs['local'])
-        self.local_feature_matcher = local_feature.matcher().to(self.device)
-
-        self.frame_name = frame_name
-        
-        self.map_data = map_data
+        self.local_feature_matcher = local_feature.matcher()
         
         self.threshold = threshold
+
+        # Adaptive LightGlue: depth/width confidences per call and early exit over the candidates.
+        # min_correspondences counts geometrically verified correspondences, Hloc.progressive_matching applies it
+        self.adaptive = feature_configs['local'].get('superpoint+lightglue', {}).get('adaptive') or {}
+        self.min_correspondences = self.adaptive.get('min_correspondences', 0)
+
+    def adaptive_options(self):
+        """
+        Per-call LightGlue confidences, empty when adaptive matching is off.
+        """
+        return {key: self.adaptive[key] for key in ('depth_confidence', 'width_confidence') if key in self.adaptive}
         
-    def match_filter(self, matches, feats0, feats1, valid_landmarks):
-        pts0 = []
-        pts1 = []
-        lms = []
-        
-        # Iterate over matches and filter using valid_landmarks
-        for n, m in enumerate(matches):
-            if m != -1 and m in valid_landmarks:
-                pts0.append(feats0['keypoints'][n])
-                pts1.append(feats1['keypoints'][m])
-                lms.append(valid_landmarks[m])
-        
-        return np.array(pts0), np.array(pts1), np.array(lms)
+    def match_filter(self, matches, keypoints0, db_feats):
+        pts0, pts1, lms = filter_matches_to_landmarks(matches, keypoints0, db_feats['keypoints'], db_feats['landmarks'], db_feats['valid'])
+        return pts0[0], pts1[0], lms[0]
 
 
-    def lightglue_batch(self, parent, topk, feats0):
+    def lightglue_batch(self, map_view, topk, feats0, stats=None):
+        """
+        Match the query against the topk candidates (best first) in mini-batches.
+        :param stats: Optional dictionary filled with the candidates evaluated, the LightGlue layers run
+                      per candidate and the correspondences collected.
+        """
         batch_size = len(topk)
         mini_batch_size = 15
         batch_list = [min(mini_batch_size, batch_size - i) for i in range(0, batch_size, mini_batch_size)]
@@ -42,42 +78,21 @@ class Local_matcher():
         max_matched_num = 0
         
         # Precompute the static components of feats0 once
-        feats0_descriptors = torch.tensor(feats0['descriptors']).unsqueeze(0).to(self.device)
-        feats0_image_size = torch.tensor(feats0['image_size']).unsqueeze(0).to(self.device)
-        feats0_keypoints = torch.tensor(feats0['keypoints']).unsqueeze(0).to(self.device)
-        feats0_scores = torch.tensor(feats0['scores']).unsqueeze(0).to(self.device)
+        query = query_tensors(feats0, self.device)
+        feats0_descriptors = query['descriptors']
+        feats0_image_size = query['image_size']
+        feats0_keypoints = query['keypoints']
+        feats0_scores = query['scores']
         
         valid_db_frame_name = []
+        layers = []
+        correspondences = 0
         
         for batch in batch_list:
-            valid_keypoints_index, landmarks_list = [],[]
             batch_topk = topk[index:index+batch]
-                
-            
-            # Pre-allocate the data structure for feats1
-            desc_dim = feats0_descriptors.shape[1]
-            max_len = max(len(self.map_data[self.frame_name[i]]['local_features']['keypoints']) for i in batch_topk)
             
-            descriptors = torch.zeros((batch, desc_dim, max_len), device=self.device)
-            keypoints = torch.zeros((batch, max_len, 2), device=self.device)
-            scores = torch.zeros((batch, max_len), device=self.device)
-            image_size = torch.zeros((batch, 2), device=self.device)
-
-            for idx, i in enumerate(batch_topk):
-                frame_data = self.map_data[self.frame_name[i]]
-                
-                landmarks_list.append(frame_data['landmarks'])
-                
-                local_features = frame_data['local_features']
-                
-                valid_keypoints_index.append(local_features['valid_keypoints_index'])
-                
-                current_len = len(local_features['keypoints'])
-                
-                keypoints[idx, :current_len, :] = torch.tensor(local_features['keypoints'], device=self.device)
-                descriptors[idx, :, :current_len] = torch.tensor(local_features['descriptors'], device=self.device)
-                scores[idx, :current_len] = torch.tensor(local_features['scores'], device=self.device)
-                image_size[idx, :] = torch.tensor(local_features['image_size'], device=self.device)
+            # The database side is already padded and resident on the device, only gather by frame id
+            db_feats = map_view.gather_local_features(batch_topk)
 
             # Prepare pred for matching
             pred = {
@@ -85,117 +100,75 @@ class Local_matcher():
                 'image_size0': feats0_image_size.repeat(batch, 1),
                 'keypoints0': feats0_keypoints.repeat(batch, 1, 1),
                 'keypoint_scores0': feats0_scores.repeat(batch, 1),
-                'descriptors1': descriptors,
-                'image_size1': image_size,
-                'keypoints1': keypoints,
-                'keypoint_scores1': scores,
+                'descriptors1': db_feats['descriptors'],
+                'image_size1': db_feats['image_size'],
+                'keypoints1': db_feats['keypoints'],
+                'keypoint_scores1': db_feats['scores'],
+                **self.adaptive_options(),
             }
 
             # Perform inference
             with torch.inference_mode():
                 pred1 = self.local_feature_matcher(pred)
-            matches = pred1['matches0'].detach().cpu().short().numpy()
 
+            stop = pred1['stop']
+            layers.extend(stop.tolist() if torch.is_tensor(stop) else [stop] * batch)
+
+            # Filter the matches of the whole mini-batch against the dense landmark lookup at once
+            batch_pts0, batch_pts1, batch_lms = filter_matches_to_landmarks(pred1['matches0'], feats0_keypoints[0], db_feats['keypoints'], db_feats['landmarks'], db_feats['valid'])
             
             # Process matches
-            for ind, match in enumerate(matches):
-
-                feat0 = pred['keypoints0'][ind].detach().cpu().numpy()
-                feat1 = pred['keypoints1'][ind].detach().cpu().numpy()
-                
-                valid_landmarks = {valid_id:landmark for valid_id,landmark in zip(valid_keypoints_index[ind], landmarks_list[ind])}
-
-                pts0, pts1, lms = [], [], []
-                for n, m in enumerate(match):
-                    if m != -1 and m in valid_landmarks:
-                        pts0.append(feat0[n])
-                        pts1.append(feat1[m])
-                        lms.append(valid_landmarks[m])
-                
+            for ind, (pts0, pts1, lms) in enumerate(zip(batch_pts0, batch_pts1, batch_lms)):
                 inlier_num = len(pts0)
                 if inlier_num > self.threshold:
-                    valid_db_frame_name.append(parent.db_name[ind + index])
+                    valid_db_frame_name.append(map_view.db_name[batch_topk[ind]])
                     if max_matched_num < inlier_num:
                         max_matched_num = inlier_num
-                    pts0_list.append(np.array(pts0))
-                    pts1_list.append(np.array(pts1))
-                    lms_list.append(np.array(lms))
+                    pts0_list.append(pts0)
+                    pts1_list.append(pts1)
+                    lms_list.append(lms)
+                    correspondences += inlier_num
 
             index += batch
 
-        return valid_db_frame_name, pts0_list, pts1_list, lms_list, max_matched_num
-
-
-    def lightglue(self, i, feats0):
-        # Fetch local features and landmarks for the selected frame
-        frame_data = self.map_data[self.frame_name[i]]
-        
-        landmarks = frame_data['landmarks']
-        
-        local_features = frame_data['local_features']
-        
-        valid_keypoints_index = local_features['valid_keypoints_index']
+        if stats is not None:
+            stats.update({'candidates': index, 'candidates_total': batch_size, 'layers': layers, 'correspondences': correspondences})
 
-        feats1 = {
-            'descriptors': local_features['descriptors'],
-            'image_size': local_features['image_size'],
-            'scores': local_features['scores'],
-            'keypoints': local_features['keypoints'],
-        }
+        return valid_db_frame_name, pts0_list, pts1_list, lms_list, max_matched_num
 
-        # Create a mapping for valid landmarks using valid_keypoints_index
-        valid_landmarks = {valid_id:landmark for valid_id,landmark in zip(valid_keypoints_index, landmarks)}
 
-        # Batch data transfer to GPU
-        pred = {
-            **{k + '0': torch.tensor(np.array(v)).unsqueeze(0).to(self.device) for k, v in feats0.items()},
-            **{k + '1': torch.tensor(np.array(v)).unsqueeze(0).to(self.device) for k, v in feats1.items()},
+    def lightglue(self, map_view, i, feats0):
+        # The database side is read from the device-resident segment tensors
+        db_feats = map_view.gather_local_features([i])
+        data = {
+            **{k + '0': v for k, v in query_tensors(feats0, self.device).items()},
+            **{k + '1': db_feats[k] for k in ('descriptors', 'image_size', 'scores', 'keypoints')},
+            **self.adaptive_options(),
         }
 
         # Perform inference using local feature matcher
         with torch.inference_mode():
-            pred = self.local_feature_matcher(pred)
-
-        # Extract matches
-        matches = pred['matches0'][0].detach().cpu().short().numpy()
+            pred = self.local_feature_matcher(data)
 
-        # Use match_filter to filter valid matches based on valid_landmarks
-        pts0, pts1, lms = self.match_filter(matches, feats0, feats1, valid_landmarks)
+        # Use match_filter to keep the matches that have a landmark
+        pts0, pts1, lms = self.match_filter(pred['matches0'], data['keypoints0'][0], db_feats)
         
-        return [pts0, pts1, lms]
+        return [pts0, pts1, lms, int(pred['stop'])]
 
         
-    def superglue(self, i, feats0):
-        # Fetch local features and landmarks for the selected frame
-        local_features = self.map_data[self.frame_name[i]]['local_features']
-        landmarks = self.map_data[self.frame_name[i]]['landmarks']
-        valid_keypoints_index = local_features['valid_keypoints_index']
-
-        feats1 = {
-            'descriptors': local_features['descriptors'],
-            'image_size': local_features['image_size'],
-            'scores': local_features['scores'],
-            'keypoints': local_features['keypoints'],
-        }
-
-        # Create a mapping for valid landmarks using valid_keypoints_index
-        valid_landmarks = {valid_id: landmarks[valid_id] for valid_id in valid_keypoints_index}
-
-        # Batch data transfer to GPU
-        pred = {
-            **{k + '0': torch.tensor(np.array(v)).unsqueeze(0).to(self.device) for k, v in feats0.items()},
-            **{k + '1': torch.tensor(np.array(v)).unsqueeze(0).to(self.device) for k, v in feats1.items()},
+    def superglue(self, map_view, i, feats0):
+        # The database side is read from the device-resident segment tensors
+        db_feats = map_view.gather_local_features([i])
+        data = {
+            **{k + '0': v for k, v in query_tensors(feats0, self.device).items()},
+            **{k + '1': db_feats[k] for k in ('descriptors', 'image_size', 'scores', 'keypoints')},
         }
 
         # Perform inference using local feature matcher
         with torch.inference_mode():
-            pred = self.local_feature_matcher(pred)
-
-        # Extract matches
-        matches = pred['matches0'][0].detach().cpu().short().numpy()
+            pred = self.local_feature_matcher(data)
 
-        # Use match_filter to filter valid matches based on valid_landmarks
-        pts0, pts1, lms = self.match_filter(matches, feats0, feats1, valid_landmarks)
+        # Use match_filter to keep the matches that have a landmark
+        pts0, pts1, lms = self.match_filter(pred['matches0'], data['keypoints0'][0], db_feats)
         
         return [pts0, pts1, lms]
-
@@ -0,0 +1,58 @@
+import json
+import threading
+import torch
+
+# Process-wide registry of loaded networks, keyed by (model name, config, device).
+# Every Local_extractor / Local_matcher / Hloc asking for the same configuration
+# gets the same eval-mode, device-resident instance, so checkpoints are
+# deserialized once per process instead of once per map update.
+_models = {}
+_lock = threading.Lock()
+
+def _config_key(name, conf, device):
+    return (name, json.dumps(conf, sort_keys=True, default=str), str(device))
+
+def get_model(name, conf, device, builder, warmup=None):
+    """
+    Return the shared model for this configuration, building it on first use.
+    :param name: Model name, e.g. 'lightglue' or 'superpoint'.
+    :param conf: Configuration dictionary the model is built from, part of the registry key.
+    :param device: Device the model has to live on.
+    :param builder: Callable building the model when it is not registered yet.
+    :param warmup: Optional callable (model, device) running a dummy forward pass once after loading.
+    """
+    key = _config_key(name, conf, device)
+    with _lock:
+        model = _models.get(key)
+        if model is None:
+            model = builder().eval().to(device)
+            if warmup is not None:
+                with torch.inference_mode():
+                    warmup(model, device)
+            _models[key] = model
+    return model
+
+def registered_models():
+    return list(_models.keys())
+
+def clear():
+    with _lock:
+        _models.clear()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+def warmup_superpoint(model, device, height=480, width=640):
+    model({'image': torch.rand((1, 1, height, width), device=device)})
+
+def warmup_lightglue(model, device, num_keypoints=512, height=480, width=640):
+    image_size = torch.tensor([[width, height]], dtype=torch.float32, device=device)
+    keypoints = torch.rand((1, num_keypoints, 2), device=device) * image_size[:, None]
+    descriptors = torch.nn.functional.normalize(torch.rand((1, model.conf.input_dim, num_keypoints), device=device), dim=1)
+    model({
+        'keypoints0': keypoints,
+        'keypoints1': keypoints,
+        'descriptors0': descriptors,
+        'descriptors1': descriptors,
+        'image_size0': image_size,
+        'image_size1': image_size,
+    })
@@ -1,2 +1,3 @@
 from .trajectory import Trajectory
+from .path import Path
 from .command import command_count,actions,command_normal,command_alert,command_debug
\ No newline at end of file
@@ -1,5 +1,6 @@
 import logging
 import numpy as np
+from .path import Path
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -9,19 +10,20 @@ console_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(m
 console_handler.setFormatter(console_format)
 logger.addHandler(console_handler)
 
-def actions(trajectory):
-    xc, yc, an = current_pose
+def actions(trajectory, current_pose):
+    """
+    Clock-direction action list [rot_clock, distance in meters, is_interwaypoint] of a trajectory from Trajectory.calculate_path.
+    :param current_pose: [x, y, heading] of the user, the first step starts at it.
+    The first action on a floor reached by elevator or stairs is flagged as is_interwaypoint.
+    """
+    heading = current_pose[2]
     action_list = []
-    for p in path_list:
-        xn,yn =p
-        distance = np.linalg.norm([xn - xc, yn - yc])
-        rot = np.arctan2(xn - xc, yn - yc)/ np.pi * 180+180
-        rot_ang = (an - rot) % 360
-        rot_clock = (round(rot_ang.squeeze().tolist() / 30)) % 12
-        if rot_clock < 1:
-            rot_clock += 12
-        action_list.append([rot_clock, distance*scale])
-        xc, yc ,an= xn, yn,rot
+    for index, step in enumerate(sorted(trajectory.keys())):
+        step_info = trajectory[step]
+        path = step_info['paths'] if isinstance(step_info['paths'], Path) else Path(step_info['paths'])
+        step_actions, heading = path.actions(heading, step_info.get('scale') or 1)
+        for action_index, (rot_clock, distance) in enumerate(step_actions.tolist()):
+            action_list.append([rot_clock, distance, index > 0 and action_index == 0])
 
     return action_list
 
@@ -0,0 +1,75 @@
+import numpy as np
+
+class Path():
+    """
+    Polyline of floor plan points backed by an (N, 2) float array.
+
+    Segment lengths and their cumulative sum are computed once, so the total
+    length, the remaining distance from any point and the clock-direction
+    actions are all vectorized over the segments.
+    """
+    def __init__(self, points):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        self.segment_lengths = np.linalg.norm(np.diff(self.points, axis=0), axis=1)
+        self.cumulative_lengths = np.concatenate([[0.0], np.cumsum(self.segment_lengths)])
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def length(self):
+        return float(self.cumulative_lengths[-1])
+
+    def tolist(self):
+        return self.points.tolist()
+
+    def project(self, point):
+        """
+        Closest point of the path to point.
+        :return: Index i of the closest segment points[i] -> points[i+1], position t in [0, 1] along it
+                 and the distance from point to the path.
+        """
+        point = np.asarray(point, dtype=np.float64)[:2]
+        if len(self.points) < 2:
+            distance = float(np.linalg.norm(self.points[0] - point)) if len(self.points) else float('inf')
+            return 0, 0.0, distance
+
+        starts = self.points[:-1]
+        directions = self.points[1:] - starts
+        t = np.clip(((point - starts) * directions).sum(axis=1) / np.maximum(self.segment_lengths ** 2, 1e-12), 0, 1)
+        distances = np.linalg.norm(starts + t[:, None] * directions - point, axis=1)
+        segment = int(np.argmin(distances))
+        return segment, float(t[segment]), float(distances[segment])
+
+    def remaining_distance(self, point):
+        """
+        Length of the path left after the projection of point onto it.
+        """
+        if len(self.points) < 2:
+            return 0.0
+        segment, t, _ = self.project(point)
+        return self.length - float(self.cumulative_lengths[segment] + t * self.segment_lengths[segment])
+
+    def trim(self, point, segment):
+        """
+        Path starting at point and continuing after segment, for a point that was projected onto segment.
+        """
+        return Path(np.concatenate([np.asarray(point, dtype=np.float64)[None, :2], self.points[segment + 1:]]))
+
+    def actions(self, heading, scale=1):
+        """
+        Clock direction and walking distance of every segment, as in navigation.command.actions.
+        :param heading: Heading at the first point, in degrees.
+        :param scale: Meters per floor plan unit.
+        :return: [K x 2] array of rot_clock and distance in meters, and the heading at the last point.
+        """
+        moving = self.segment_lengths > 0
+        deltas = np.diff(self.points, axis=0)[moving]
+        if len(deltas) == 0:
+            return np.zeros((0, 2)), heading
+
+        rot = np.arctan2(deltas[:, 0], deltas[:, 1]) / np.pi * 180 + 180
+        previous = np.concatenate([[heading], rot[:-1]])
+        rot_clock = np.round((previous - rot) % 360 / 30) % 12
+        rot_clock[rot_clock < 1] += 12
+        return np.stack([rot_clock, self.segment_lengths[moving] * scale], axis=1), float(rot[-1])
@@ -1,109 +1,220 @@
 import numpy as np
 from scipy.sparse.csgraph import shortest_path
-from collections import defaultdict, deque
-import math
+from collections import defaultdict
+import heapq
+from .visibility import BoundaryIndex
+from .path import Path
+
+INTER_FLOOR_COST = 0.0  # Cost of taking an elevator or staircase between two floors, in floor plan units
+PRECOMPUTED_VERSION = 1  # Bump whenever the layout of precomputed_state changes
+REPLAN_DISTANCE = 2.0  # Meters the pose may be off the planned route before the route is planned again
+REPLAN_DISTANCE_UNSCALED = 40.0  # Same threshold in floor plan units, for floors without a scale
 
 class Trajectory():
-    def __init__(self, all_buildings_data, all_interwaypoint_connections):
+    def __init__(self, all_buildings_data, all_interwaypoint_connections, precomputed=None):
+        """
+        :param precomputed: Output of precomputed_state() of a Trajectory built from the same data,
+                            e.g. from the navigation cache, skips the shortest path precomputation.
+        """
         self.all_buildings_data = all_buildings_data
         self.all_interwaypoint_connections = all_interwaypoint_connections
         self.sessions = defaultdict(dict)
-        self.precalculated_inter_paths = self._precalculated_inter_paths()
-        self.precalculated_global_paths = self._precalculate_global_paths()
-
-    def _find_all_paths(self, current_building, current_floor, dest_building, dest_floor):
-        paths = []
-
-        # Helper function to get valid next waypoints
-        def get_next_waypoints(current_waypoint, visited):
-            next_waypoints = []
-            for inter_id, waypoints in self.all_interwaypoint_connections.items():
-                for waypoint in waypoints:
-                    # Check if it's a valid transition (same building/floor or connected via interwaypoints)
-                    if waypoint['building'] == current_waypoint['building'] and waypoint['floor'] == current_waypoint['floor']:
-                        if waypoint['waypoint'] != current_waypoint['waypoint'] and waypoint not in visited:
-                            next_waypoints.append(waypoint)
-                    elif waypoint['id'] == current_waypoint['id'] and waypoint not in visited:
-                        next_waypoints.append(waypoint)
-            return next_waypoints
-        
-        # BFS search for paths
-        queue = deque()
 
-        # Enqueue all interwaypoints in the current building and floor
+        self.loaded_precomputed = precomputed is not None and precomputed.get('version') == PRECOMPUTED_VERSION
+        if self.loaded_precomputed:
+            self.floor_graphs = precomputed['floor_graphs']
+            self.precalculated_inter_paths = precomputed['precalculated_inter_paths']
+            self.inter_floor_graph = precomputed['inter_floor_graph']
+        else:
+            self.floor_graphs = self._precalculate_floor_graphs()
+            self.precalculated_inter_paths = self._precalculated_inter_paths()
+            self.inter_floor_graph = self._build_inter_floor_graph()
+
+    def precomputed_state(self):
+        """
+        Everything derived from the map data at start-up, to be persisted and passed back as precomputed.
+        """
+        return {
+            'version': PRECOMPUTED_VERSION,
+            'floor_graphs': self.floor_graphs,
+            'precalculated_inter_paths': self.precalculated_inter_paths,
+            'inter_floor_graph': self.inter_floor_graph
+        }
+
+    def _precalculate_floor_graphs(self):
+        """
+        All-pairs shortest paths between the anchor points of every floor, computed once.
+
+        The last node of an access graph stands for the live pose, which only has
+        incoming edges (anchor -> pose), so it never lies on a path between two
+        anchors and the anchor-to-anchor paths do not depend on the pose.
+        """
+        floor_graphs = defaultdict(dict)
+
+        for building, building_data in self.all_buildings_data.items():
+            for floor, floor_data in building_data.items():
+                current_M = floor_data.get('access_graph')
+                if current_M is None:
+                    continue
+
+                anchor_location = self._form_anchor_points(floor_data.get('destinations'), floor_data.get('waypoints'))
+                anchor_num = len(anchor_location)
+
+                D, Pr = shortest_path(current_M[:anchor_num, :anchor_num], directed=True, method='FW', return_predecessors=True)
+
+                floor_graphs[building][floor] = {
+                    'anchor_location': anchor_location,
+                    'anchor_array': np.asarray(anchor_location, dtype=np.float64).reshape(-1, 2),
+                    'boundary_index': BoundaryIndex(floor_data.get('boundaries', [])),
+                    'distances': D,
+                    'predecessors': Pr
+                }
+
+        return floor_graphs
+
+    def _get_floor_graph(self, building, floor):
+        return self.floor_graphs.get(building, {}).get(floor)
+
+    def _pose_costs(self, floor_graph, pose, target_indices):
+        """
+        Shortest distances from the pose to several anchor points, relaxing only the edges from the pose to its
+        visible anchors on top of the precomputed all-pairs distances instead of re-running shortest_path with the pose added.
+        :return: Distance to each target (inf if unreachable) and the first anchor on the way to it.
+        """
+        D = floor_graph['distances']
+        target_indices = np.asarray(target_indices, dtype=np.int64)
+
+        # distance 0 means the anchor is hidden behind a boundary, as in the access graph
+        pose_edges = floor_graph['boundary_index'].visible_distances(pose, floor_graph['anchor_array'])
+        if len(pose_edges) == 0:
+            return np.full(len(target_indices), np.inf), np.zeros(len(target_indices), dtype=np.int64)
+
+        total = np.where(pose_edges[None] > 0, D[target_indices] + pose_edges[None], np.inf)
+        first_indices = np.argmin(total, axis=1)
+        return total[np.arange(len(target_indices)), first_indices], first_indices
+
+    def _path_from_pose(self, floor_graph, pose, destination_index, first_index=None):
+        """
+        Shortest path from the pose to an anchor point, see _pose_costs.
+        :return: List of anchor locations from the first anchor after the pose up to the destination, empty if unreachable.
+        """
+        anchor_location = floor_graph['anchor_location']
+
+        if first_index is None:
+            costs, first_indices = self._pose_costs(floor_graph, pose, [destination_index])
+            if not np.isfinite(costs[0]):
+                return []
+            first_index = int(first_indices[0])
+
+        return [anchor_location[first_index]] + self._trace_back_path(floor_graph['predecessors'], anchor_location, first_index, destination_index)
+
+    def _build_inter_floor_graph(self):
+        """
+        Weighted graph over all interwaypoints of the place, built once.
+
+        Nodes are (building, floor, index) of interwaypoints. Interwaypoints of the same
+        floor are connected by the length of the shortest path between them, and
+        interwaypoints sharing an id (the two ends of an elevator or staircase) by a
+        transition edge of INTER_FLOOR_COST. Routing between floors is a Dijkstra
+        search over this graph, see _route_between_floors.
+        """
+        nodes = {}
+        edges = defaultdict(list)
+        floor_interwaypoints = defaultdict(list)
+
         for inter_id, waypoints in self.all_interwaypoint_connections.items():
             for waypoint in waypoints:
-                if waypoint['building'] == current_building and waypoint['floor'] == current_floor:
-                    queue.append((waypoint, [waypoint], defaultdict(int)))  # (current_waypoint, path_so_far, id_count)
-
-        while queue:
-            current_waypoint, path_so_far, id_count = queue.popleft()
+                key = (waypoint['building'], waypoint['floor'], waypoint['index'])
+                nodes[key] = waypoint
+                floor_interwaypoints[(waypoint['building'], waypoint['floor'])].append(key)
 
-            # Update the count of the current waypoint's id
-            id_count[current_waypoint['id']] += 1
-            
-            # If any id is visited more than twice, skip this path
-            if id_count[current_waypoint['id']] > 2:
+        for (building, floor), keys in floor_interwaypoints.items():
+            floor_graph = self._get_floor_graph(building, floor)
+            if floor_graph is None:
                 continue
+            D = floor_graph['distances']
+            for start in keys:
+                for end in keys:
+                    # walking start -> end is traced with the predecessors rooted at end, see _trace_back_path
+                    if start != end and np.isfinite(D[end[2], start[2]]):
+                        edges[start].append((end, float(D[end[2], start[2]])))
 
-            # If we've reached the destination building and floor, check if the path is valid
-            if current_waypoint['building'] == dest_building and current_waypoint['floor'] == dest_floor:
-                # Ensure each id has been visited exactly twice
-                if all(count == 2 for count in id_count.values()):
-                    paths.append(path_so_far)
-                continue
-            
-            # Get next valid waypoints
-            next_waypoints = get_next_waypoints(current_waypoint, path_so_far)
-            for next_waypoint in next_waypoints:
-                # Pass along the current id_count dictionary
-                new_id_count = id_count.copy()
-                queue.append((next_waypoint, path_so_far + [next_waypoint], new_id_count))
-        
-        return paths
+        for inter_id, waypoints in self.all_interwaypoint_connections.items():
+            for start in waypoints:
+                for end in waypoints:
+                    if (start['building'], start['floor']) != (end['building'], end['floor']):
+                        edges[(start['building'], start['floor'], start['index'])].append(((end['building'], end['floor'], end['index']), INTER_FLOOR_COST))
+
+        return {'nodes': nodes, 'edges': edges, 'floor_interwaypoints': floor_interwaypoints}
 
-    # Function to precalculate all possible paths between every building and floor combination
-    def _precalculate_global_paths(self):
-        # Store the precalculated paths
-        precalculated_paths = defaultdict(dict)
+    def _route_between_floors(self, pose, current_building, current_floor, dest_building, dest_floor, destination_index):
+        """
+        Dijkstra from the pose to the destination through the interwaypoint graph.
+        :return: Interwaypoint keys along the route and the first anchor after the pose, ([], None) if there is no route.
+        """
+        floor_graph = self._get_floor_graph(current_building, current_floor)
+        dest_floor_graph = self._get_floor_graph(dest_building, dest_floor)
+        start_keys = self.inter_floor_graph['floor_interwaypoints'].get((current_building, current_floor), [])
+        end_keys = self.inter_floor_graph['floor_interwaypoints'].get((dest_building, dest_floor), [])
+        if floor_graph is None or dest_floor_graph is None or not start_keys or not end_keys:
+            return [], None
 
-        # Use keys from self.all_buildings_data to get all building and floor combinations
-        for current_building, floors in self.all_buildings_data.items():
-            for current_floor, _ in floors.items():
-                for dest_building, dest_floors in self.all_buildings_data.items():
-                    for dest_floor, _ in dest_floors.items():
-                        # Skip if the start and destination are the same
-                        if current_building == dest_building and current_floor == dest_floor:
-                            continue
+        start_costs, first_indices = self._pose_costs(floor_graph, pose, [key[2] for key in start_keys])
+        exit_costs = {key: float(dest_floor_graph['distances'][destination_index, key[2]]) for key in end_keys}
 
-                        # Calculate all paths between the start and destination
-                        paths = self._find_all_paths(current_building, current_floor, dest_building, dest_floor)
+        distances = {}
+        previous = {}
+        queue = []
+        for key, cost in zip(start_keys, start_costs):
+            if np.isfinite(cost) and cost < distances.get(key, float('inf')):
+                distances[key] = float(cost)
+                previous[key] = None
+                heapq.heappush(queue, (float(cost), key))
 
-                        # Store the result
-                        precalculated_paths[(current_building, current_floor)][(dest_building, dest_floor)] = paths
+        best_cost, best_key = float('inf'), None
+        while queue:
+            cost, key = heapq.heappop(queue)
+            if cost > distances.get(key, float('inf')) or cost >= best_cost:
+                continue
+            if key in exit_costs and cost + exit_costs[key] < best_cost:
+                best_cost, best_key = cost + exit_costs[key], key
+            for neighbor, weight in self.inter_floor_graph['edges'].get(key, []):
+                new_cost = cost + weight
+                if new_cost < distances.get(neighbor, float('inf')):
+                    distances[neighbor] = new_cost
+                    previous[neighbor] = key
+                    heapq.heappush(queue, (new_cost, neighbor))
+
+        if best_key is None:
+            return [], None
+
+        route = [best_key]
+        while previous[route[-1]] is not None:
+            route.append(previous[route[-1]])
+        route.reverse()
+        return route, int(first_indices[start_keys.index(route[0])])
 
-        return precalculated_paths
-            
     def _precalculated_inter_paths(self):
         path_between_interwaypoints = defaultdict(dict)
         
         for building, building_data  in self.all_buildings_data.items():
             for floor, floor_data  in building_data.items():
                 
-                current_M = floor_data.get('access_graph')
-                _, Pr = shortest_path(current_M, directed=True, method='FW', return_predecessors=True)
+                floor_graph = self._get_floor_graph(building, floor)
+                if floor_graph is None:
+                    continue
+                Pr = floor_graph['predecessors']
                 
                 interwaypoints = floor_data.get('interwaypoints')
                 
                 interwaypoints_index_in_floor = [interwaypoint.get('index') for interwaypoint in interwaypoints]
                 
-                anchor_location =  self._form_anchor_points(floor_data.get('destinations'), floor_data.get('waypoints'))
+                anchor_location = floor_graph['anchor_location']
                 
                 for current_index in interwaypoints_index_in_floor:
                     for target_index in interwaypoints_index_in_floor:
-                        if current_index < target_index:
+                        if current_index != target_index:
                             path_between_interwaypoints[(building, floor)][(current_index, target_index)] = self._trace_back_path(Pr, anchor_location, current_index, target_index)
-                            path_between_interwaypoints[(building, floor)][(target_index, current_index)] = path_between_interwaypoints[(building, floor)][(current_index, target_index)]
                             
         return path_between_interwaypoints
     
@@ -160,22 +271,6 @@ class Trajectory():
 
         return path_list
     
-    def _calculate_trajectory_length(self, points):
-        total_length = 0.0
-        
-        # Iterate over the list of points, calculating distance between consecutive pairs
-        for i in range(1, len(points)):
-            x1, y1 = points[i - 1]
-            x2, y2 = points[i]
-            
-            # Calculate the Euclidean distance between consecutive points
-            distance = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-            
-            # Add to the total length
-            total_length += distance
-        
-        return total_length
-
     def _initialize_session(self, session_id):
         """Initialize data for a new session."""
         if session_id not in self.sessions:
@@ -184,7 +279,8 @@ class Trajectory():
                 'destination_floor': None,
                 'destination_index': None,
                 'destination_name': None,
-                'dest_from_inter': defaultdict(dict)
+                'dest_from_inter': defaultdict(dict),
+                'planned_route': None
             }
             
     def update_destination_graph(self, session_id, navigation_states):
@@ -194,12 +290,13 @@ class Trajectory():
 
         session_data['destination_building'] = navigation_states['Building']
         session_data['destination_floor'] = navigation_states['Floor']
+        session_data['planned_route'] = None
         
         floor_data = self.all_buildings_data.get(session_data['destination_building'], {}).get(session_data['destination_floor'], {})
-        destination_M = floor_data.get('access_graph')
         destination_interwaypoints = floor_data.get('interwaypoints')
 
-        destination_anchor_location = self._form_anchor_points(floor_data.get('destinations'), floor_data.get('waypoints'))
+        floor_graph = self._get_floor_graph(session_data['destination_building'], session_data['destination_floor'])
+        destination_anchor_location = floor_graph['anchor_location']
 
         selected_destination_ID = navigation_states['Selected_destination_ID']
         destination_info = floor_data.get('destinations').get(selected_destination_ID)
@@ -212,11 +309,35 @@ class Trajectory():
                     session_data['destination_name'] = floor_data.get('destinations', {}).get(dest_id, {}).get('name', 'destination')
                     break
 
-        _, Pr = shortest_path(destination_M, directed=True, method='FW', return_predecessors=True)
+        Pr = floor_graph['predecessors']
 
         for interwaypoint in destination_interwaypoints:
             session_data['dest_from_inter'][interwaypoint['index']] = self._trace_back_path(Pr, destination_anchor_location, interwaypoint['index'], session_data['destination_index'])
 
+    def _progress_route(self, planned_route, pose, scale):
+        """
+        Re-use the route planned by a previous call while the pose stays close to its first leg.
+        :return: The route with its first leg starting at the pose and the passed part cut off,
+                 or None if the pose deviated too far and the route has to be planned again.
+        """
+        trajectory = planned_route['trajectory']
+        first_step = min(trajectory.keys())
+        first_path = planned_route['first_path']
+        if len(first_path) < 2:
+            return None
+
+        segment, _, deviation = first_path.project(pose)
+        threshold = REPLAN_DISTANCE / scale if scale else REPLAN_DISTANCE_UNSCALED
+        if deviation > threshold:
+            return None
+
+        first_path = first_path.trim(pose, segment)
+        progressed = defaultdict(dict, {step: dict(step_info) for step, step_info in trajectory.items()})
+        progressed[first_step]['paths'] = first_path.tolist()
+        planned_route['trajectory'] = progressed
+        planned_route['first_path'] = first_path
+        return progressed
+
     def calculate_path(self, manager, session_id, localization_states):
         """Calculate the path for a specific session."""
         self._initialize_session(session_id)
@@ -226,18 +347,22 @@ class Trajectory():
         current_floor = localization_states['floor']
         current_pose = localization_states['pose']
         
-        floor_data = self.all_buildings_data.get(current_building, {}).get(current_floor, {})
-        current_boundaries = floor_data.get('boundaries')
-        current_M = floor_data.get('access_graph')
-        current_anchor_location = self._form_anchor_points(floor_data.get('destinations'), floor_data.get('waypoints'))
-
-        # Update the access graph for the current pose
-        for i, loc in enumerate(current_anchor_location):
-            current_M[i, -1] = self._distance(current_pose[:2], loc, current_boundaries)
-
-        _, Pr = shortest_path(current_M, directed=True, method='FW', return_predecessors=True)
+        floor_graph = self._get_floor_graph(current_building, current_floor)
         
         trajectory = defaultdict(dict)
+        if floor_graph is None:
+            return trajectory
+
+        # Consecutive poses of a walking user mostly stay on the route planned last time,
+        # it is only planned again after leaving the floor or deviating from it
+        planned_route = session_data.get('planned_route')
+        session_data['planned_route'] = None
+        if planned_route is not None and (planned_route['building'], planned_route['floor']) == (current_building, current_floor):
+            scale = manager.scale_data.get(manager.config['location']['place'], {}).get(current_building, {}).get(current_floor, None)
+            progressed = self._progress_route(planned_route, current_pose, scale)
+            if progressed is not None:
+                session_data['planned_route'] = planned_route
+                return progressed
 
         # Check if current building and floor match the destination
         if (current_building, current_floor) == (session_data['destination_building'], session_data['destination_floor']) and session_data['destination_index']:
@@ -245,45 +370,55 @@ class Trajectory():
                 'name': 'destination',
                 'building': current_building,
                 'floor': current_floor,
-                'paths': [[current_pose[0], current_pose[1]]] + self._trace_back_path(Pr, current_anchor_location, -1, session_data['destination_index']),
+                'paths': [[current_pose[0], current_pose[1]]] + self._path_from_pose(floor_graph, current_pose[:2], session_data['destination_index']),
                 'scale': manager.scale_data.get(manager.config['location']['place'], {}).get(current_building, {}).get(current_floor, None)
             }
-        else:
-            possible_paths = self.precalculated_global_paths.get((current_building, current_floor), {}).get((session_data['destination_building'], session_data['destination_floor']), {})
-
-            min_distance = float('inf')
-            for path_candidate in possible_paths:
-                enter_id = set()
-                local_trajectory = defaultdict(dict)
-                distance = 0
-                for step, step_info in enumerate(path_candidate):
-                    inter_name = step_info.get('name')
-                    building = step_info.get('building')
-                    floor = step_info.get('floor')
-                    if step == 0:
-                        current_paths = [[current_pose[0], current_pose[1]]] + self._trace_back_path(Pr, current_anchor_location, -1, step_info.get('index'))
-                        distance += self._calculate_trajectory_length(current_paths)
-                    elif step == len(path_candidate) - 1:
-                        current_paths = session_data['dest_from_inter'].get(step_info.get('index'))
-                        distance += self._calculate_trajectory_length(current_paths)
-                    else:
-                        inter_id = step_info.get('id')
-                        inter_index = step_info.get('index')
-                        if inter_id not in enter_id:
-                            enter_id.add(inter_index)
-                            target_index = step_info.get('index')
-                            current_paths = self.precalculated_inter_paths.get((building, floor)).get((step_info.get('index'), target_index))
-                            distance += self._calculate_trajectory_length(current_paths)
-                        else:
-                            continue
-                    local_trajectory[step] = {
-                        'name': inter_name if step < len(path_candidate) - 1 else session_data['destination_name'],
-                        'building': building,
-                        'floor': floor,
-                        'paths': current_paths,
-                        'scale': manager.scale_data.get(manager.config['location']['place'], {}).get(building, {}).get(floor, None)
-                    }
-                if distance < min_distance:
-                    min_distance = distance
-                    trajectory = local_trajectory
+        elif session_data['destination_index'] is not None and (current_building, current_floor) != (session_data['destination_building'], session_data['destination_floor']):
+            route, first_index = self._route_between_floors(current_pose[:2], current_building, current_floor, session_data['destination_building'], session_data['destination_floor'], session_data['destination_index'])
+            if not route:
+                return trajectory
+
+            nodes = self.inter_floor_graph['nodes']
+
+            def scale(building, floor):
+                return manager.scale_data.get(manager.config['location']['place'], {}).get(building, {}).get(floor, None)
+
+            # Walk from the pose to the first interwaypoint
+            step = 0
+            trajectory[step] = {
+                'name': nodes[route[0]].get('name'),
+                'building': current_building,
+                'floor': current_floor,
+                'paths': [[current_pose[0], current_pose[1]]] + self._path_from_pose(floor_graph, current_pose[:2], route[0][2], first_index=first_index),
+                'scale': scale(current_building, current_floor)
+            }
+
+            # Walks between interwaypoints of intermediate floors, transitions between floors have no path of their own
+            for start, end in zip(route[:-1], route[1:]):
+                if start[:2] != end[:2]:
+                    continue
+                step += 1
+                building, floor = start[:2]
+                trajectory[step] = {
+                    'name': nodes[end].get('name'),
+                    'building': building,
+                    'floor': floor,
+                    'paths': [nodes[start].get('location')] + self.precalculated_inter_paths.get((building, floor), {}).get((start[2], end[2]), []),
+                    'scale': scale(building, floor)
+                }
+
+            # Walk from the last interwaypoint to the destination
+            step += 1
+            building, floor = route[-1][:2]
+            trajectory[step] = {
+                'name': session_data['destination_name'],
+                'building': building,
+                'floor': floor,
+                'paths': [nodes[route[-1]].get('location')] + session_data['dest_from_inter'].get(route[-1][2], []),
+                'scale': scale(building, floor)
+            }
+
+        if len(trajectory) > 0:
+            first_path = Path(trajectory[min(trajectory.keys())]['paths'])
+            session_data['planned_route'] = {'building': current_building, 'floor': current_floor, 'trajectory': trajectory, 'first_path': first_path}
         return trajectory
\ No newline at end of file
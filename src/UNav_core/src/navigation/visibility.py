@@ -0,0 +1,117 @@
+import numpy as np
+
+def _ccw(A, B, C):
+    """
+    Vectorized counterpart of Trajectory._ccw, points are [..., 2] arrays.
+    """
+    return (C[..., 1] - A[..., 1]) * (B[..., 0] - A[..., 0]) > (B[..., 1] - A[..., 1]) * (C[..., 0] - A[..., 0])
+
+def segments_intersect(c, d, a, b):
+    """
+    Element-wise intersection test between the segments c-d and a-b, same predicate as Trajectory._distance.
+    """
+    return (_ccw(a, c, d) != _ccw(b, c, d)) & (_ccw(a, b, c) != _ccw(a, b, d))
+
+class BoundaryIndex():
+    """
+    Uniform grid over the boundary lines of one floor, built once at load time.
+
+    Each boundary is registered in every cell its bounding box overlaps. A query
+    segment is sampled every cell_size, so every cell it crosses is within one
+    cell of a sample; the 3x3 neighbourhood of the sampled cells therefore
+    yields a superset of the boundaries it can hit, which are then tested in one
+    vectorized call for all query segments at once.
+    """
+    def __init__(self, boundaries, cell_size=None):
+        self.boundaries = np.asarray(boundaries, dtype=np.float64).reshape(-1, 4)
+        self.starts = self.boundaries[:, :2]
+        self.ends = self.boundaries[:, 2:]
+
+        if len(self.boundaries) == 0:
+            self.cell_size = 1.0
+            self.origin = np.zeros(2)
+            self.shape = (1, 1)
+            self.cell_offsets = np.zeros(2, dtype=np.int64)
+            self.cell_items = np.zeros(0, dtype=np.int64)
+            return
+
+        lengths = np.linalg.norm(self.ends - self.starts, axis=1)
+        self.cell_size = float(cell_size) if cell_size else max(float(np.median(lengths)), 1.0)
+
+        lower = np.minimum(self.starts, self.ends)
+        upper = np.maximum(self.starts, self.ends)
+        self.origin = lower.min(axis=0)
+        self.shape = tuple((np.floor((upper.max(axis=0) - self.origin) / self.cell_size).astype(np.int64) + 1).tolist())
+
+        # (cell, boundary) pairs for every cell of every boundary's bounding box
+        cell_lower = self._cell_coordinates(lower)
+        cell_upper = self._cell_coordinates(upper)
+        spans = cell_upper - cell_lower + 1
+        counts = spans[:, 0] * spans[:, 1]
+        boundary_ids = np.repeat(np.arange(len(self.boundaries)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = cell_lower[boundary_ids, 0] + local // spans[boundary_ids, 1]
+        cell_y = cell_lower[boundary_ids, 1] + local % spans[boundary_ids, 1]
+        cell_ids = cell_x * self.shape[1] + cell_y
+
+        # CSR layout: boundaries of cell i are cell_items[cell_offsets[i]:cell_offsets[i+1]]
+        order = np.argsort(cell_ids, kind='stable')
+        self.cell_items = boundary_ids[order]
+        self.cell_offsets = np.concatenate([[0], np.cumsum(np.bincount(cell_ids, minlength=self.shape[0] * self.shape[1]))])
+
+    def __len__(self):
+        return len(self.boundaries)
+
+    def _cell_coordinates(self, points):
+        cells = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, np.array(self.shape) - 1)
+
+    def _candidates(self, c, d):
+        """
+        (query, boundary) pairs that may intersect, for query segments c[i]-d[i].
+        """
+        lengths = np.linalg.norm(d - c, axis=1)
+        samples = np.floor(lengths / self.cell_size).astype(np.int64) + 2
+        query_ids = np.repeat(np.arange(len(c)), samples)
+        t = (np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)) / np.repeat(samples - 1, samples)
+        points = c[query_ids] + t[:, None] * (d - c)[query_ids]
+
+        # Sampled cells and their 3x3 neighbourhood, clipped to the grid
+        cells = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        offsets = np.array([(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)])
+        cells = (cells[:, None, :] + offsets[None]).reshape(-1, 2)
+        query_ids = np.repeat(query_ids, len(offsets))
+        inside = np.all((cells >= 0) & (cells < np.array(self.shape)), axis=1)
+        cell_ids = cells[inside, 0] * self.shape[1] + cells[inside, 1]
+        query_cells = np.unique(np.stack([query_ids[inside], cell_ids], axis=1), axis=0)
+
+        # Expand every (query, cell) into the boundaries stored in that cell
+        starts = self.cell_offsets[query_cells[:, 1]]
+        counts = self.cell_offsets[query_cells[:, 1] + 1] - starts
+        pair_queries = np.repeat(query_cells[:, 0], counts)
+        items = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+        pairs = np.unique(np.stack([pair_queries, self.cell_items[items]], axis=1), axis=0)
+        return pairs[:, 0], pairs[:, 1]
+
+    def blocked(self, c, d):
+        """
+        Whether each segment c[i]-d[i] crosses any boundary.
+        """
+        c = np.asarray(c, dtype=np.float64).reshape(-1, 2)
+        d = np.asarray(d, dtype=np.float64).reshape(-1, 2)
+        if len(self.boundaries) == 0 or len(c) == 0:
+            return np.zeros(len(c), dtype=bool)
+
+        query_ids, boundary_ids = self._candidates(c, d)
+        hits = segments_intersect(c[query_ids], d[query_ids], self.starts[boundary_ids], self.ends[boundary_ids])
+        return np.bincount(query_ids[hits], minlength=len(c)) > 0
+
+    def visible_distances(self, point, targets):
+        """
+        Distance from point to every target, 0 where a boundary is in the way (the convention of the access graphs).
+        """
+        targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
+        point = np.broadcast_to(np.asarray(point, dtype=np.float64)[:2], targets.shape)
+        distances = np.linalg.norm(targets - point, axis=1)
+        distances[self.blocked(point, targets)] = 0
+        return distances
@@ -7,17 +7,22 @@ import json
 import torch
 import torchvision.models as models
 import torch.nn as nn
+import numpy as np
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
 
 def input_transform():
     return transforms.Compose([
         transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                             std=[0.229, 0.224, 0.225]),
+        transforms.Normalize(mean=IMAGENET_MEAN,
+                             std=IMAGENET_STD),
     ])
 
 class NetVladFeatureExtractor:
     def __init__(self, ckpt_path, arch='vgg16', num_clusters=64, pooling='netvlad', vladv2=False, nocuda=False,
-                 input_transform=input_transform()):
+                 input_transform=None):
+        # None normalizes on the device (see features), a torchvision transform runs on the CPU per image
         self.input_transform = input_transform
 
         flag_file = join(ckpt_path, 'checkpoints', 'flags.json')
@@ -38,6 +43,8 @@ class NetVladFeatureExtractor:
             raise Exception("No GPU found, please run with --nocuda")
 
         self.device = torch.device("cuda" if cuda else "cpu")
+        self.mean = torch.tensor(IMAGENET_MEAN, device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor(IMAGENET_STD, device=self.device).view(1, 3, 1, 1)
 
         print('===> Building model')
 
@@ -88,14 +95,40 @@ class NetVladFeatureExtractor:
             print("=> no checkpoint found at '{}'".format(resume_ckpt))
 
     def feature(self, image):
-        if self.input_transform:
-            image = self.input_transform(image).unsqueeze(0)
-
+        """
+        Descriptor [1 x D] of one image.
+        """
+        return self.features([image])
+
+    def _to_device(self, images):
+        """
+        Stack equally sized images (H x W x 3 uint8 arrays or PIL images) into a normalized [N x 3 x H x W] batch on the device.
+        Only the uint8 pixels cross to the device, conversion and normalization are tensor ops there.
+        """
+        if self.input_transform is not None:
+            return torch.stack([self.input_transform(image) for image in images]).to(self.device)
+        pixels = torch.from_numpy(np.stack([np.asarray(image) for image in images]))
+        if self.device.type == 'cuda':
+            pixels = pixels.pin_memory()
+        pixels = pixels.to(self.device, non_blocking=True).permute(0, 3, 1, 2).float().div_(255)
+        return (pixels - self.mean) / self.std
+
+    def features(self, images):
+        """
+        Batched descriptors: one forward pass per group of equally sized images (a single pass for camera frames).
+        :param images: List of H x W x 3 images, or an [N x H x W x 3] array.
+        :return: (N, D) tensor on the device, in the order of images.
+        """
+        groups = {}
+        for index, image in enumerate(images):
+            groups.setdefault(np.asarray(image).shape, []).append(index)
+
+        vlad_encodings = [None] * len(images)
         with torch.no_grad():
-            input = image.to(self.device)
-            image_encoding = self.model.encoder(input)
-            vlad_encoding = self.model.pool(image_encoding)
-
-            del input
-            torch.cuda.empty_cache()
-            return vlad_encoding
\ No newline at end of file
+            for indices in groups.values():
+                input = self._to_device([images[index] for index in indices])
+                vlad_encoding = self.model.pool(self.model.encoder(input))
+                for row, index in enumerate(indices):
+                    vlad_encodings[index] = vlad_encoding[row]
+                del input
+        return torch.stack(vlad_encodings)
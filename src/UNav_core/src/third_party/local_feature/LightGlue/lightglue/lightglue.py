@@ -1,3 +1,4 @@
+import logging
 from pathlib import Path
 from types import SimpleNamespace
 import numpy as np
@@ -15,6 +16,8 @@ except ModuleNotFoundError:
 
 torch.backends.cudnn.deterministic = True
 
+logger = logging.getLogger(__name__)
+
 
 @torch.cuda.amp.custom_fwd(cast_inputs=torch.float32)
 def normalize_keypoints(
@@ -317,6 +320,9 @@ class LightGlue(nn.Module):
             state_dict = torch.load(str(path), map_location='cpu')
             self.load_state_dict(state_dict, strict=False)
 
+        # batched calls cannot prune points, warned about once per model
+        self.warned_batch_width = False
+
     def forward(self, data: dict) -> dict:
         """
         Match keypoints and descriptors between two images
@@ -370,7 +376,17 @@ class LightGlue(nn.Module):
         ind1 = torch.arange(0, n).to(device=kpts0.device).expand(b,-1)
         prune0 = torch.ones_like(ind0)  # store layer where pruning is detected
         prune1 = torch.ones_like(ind1)
-        dec, wic = self.conf.depth_confidence, self.conf.width_confidence
+        # per-call overrides, so one shared model serves both fixed and adaptive matching
+        dec = data.get('depth_confidence', self.conf.depth_confidence)
+        wic = data.get('width_confidence', self.conf.width_confidence)
+        if b > 1:
+            # point pruning gathers the surviving points of a single pair, batched pairs keep all points
+            if wic > 0 and not self.warned_batch_width:
+                logger.warning('width_confidence=%s is ignored for batches of %d pairs, point pruning only applies to single pairs', wic, b)
+                self.warned_batch_width = True
+            wic = -1
+            if dec > 0:
+                return self._forward_adaptive_depth(desc0, desc1, encoding0, encoding1, dec)
         token0, token1 = None, None
         for i in range(self.conf.n_layers):
             # self+cross attention
@@ -422,6 +438,56 @@ class LightGlue(nn.Module):
             'prune1': prune1,
         }
 
+    def _forward_adaptive_depth(self, desc0, desc1, encoding0, encoding1, dec: float) -> dict:
+        """ early stopping per batch element: each pair leaves at the first layer
+        where its own tokens are confident, instead of waiting for the whole batch """
+        b, m, n = desc0.shape[0], desc0.shape[1], desc1.shape[1]
+        device = desc0.device
+        active = torch.arange(b, device=device)
+        stop = torch.full((b,), self.conf.n_layers, dtype=torch.long, device=device)
+        scores = None
+        for i in range(self.conf.n_layers):
+            desc0, desc1 = self.self_attn[i](
+                desc0, desc1, encoding0, encoding1)
+            desc0, desc1 = self.cross_attn[i](desc0, desc1)
+            if i == self.conf.n_layers - 1:
+                break
+            token0, token1 = self.token_confidence[i](desc0, desc1)
+            done = self.stop_per_element(token0, token1, self.conf_th(i), dec, m+n)
+            if not done.any():
+                continue
+            scores_, _ = self.log_assignment[i](desc0[done], desc1[done])
+            if scores is None:
+                scores = scores_.new_zeros((b, m+1, n+1))
+            scores[active[done]] = scores_
+            stop[active[done]] = i+1
+            keep = ~done
+            active, desc0, desc1 = active[keep], desc0[keep], desc1[keep]
+            # the batch dimension of the rotary encodings is the third one
+            encoding0, encoding1 = encoding0[:, :, keep], encoding1[:, :, keep]
+            if len(active) == 0:
+                break
+
+        if len(active) > 0:
+            scores_, _ = self.log_assignment[i](desc0, desc1)
+            if scores is None:
+                scores = scores_.new_zeros((b, m+1, n+1))
+            scores[active] = scores_
+
+        m0, m1, mscores0, mscores1 = filter_matches(
+            scores, self.conf.filter_threshold)
+
+        return {
+            'log_assignment': scores,
+            'matches0': m0,
+            'matches1': m1,
+            'matching_scores0': mscores0,
+            'matching_scores1': mscores1,
+            'stop': stop,
+            'prune0': torch.ones((b, m), dtype=torch.long, device=device),
+            'prune1': torch.ones((b, n), dtype=torch.long, device=device),
+        }
+
     def conf_th(self, i: int) -> float:
         """ scaled confidence threshold """
         return np.clip(
@@ -442,4 +508,13 @@ class LightGlue(nn.Module):
             pos = 1.0 - (tokens < conf_th).float().sum() / seql
             return pos > inl_th
         else:
-            return tokens.mean() > inl_th
\ No newline at end of file
+            return tokens.mean() > inl_th
+
+    def stop_per_element(self, token0: torch.Tensor, token1: torch.Tensor, conf_th: float, inl_th: float, seql: int) -> torch.Tensor:
+        """ evaluate stopping condition for every batch element [B] """
+        tokens = torch.cat([token0, token1], -1)
+        if conf_th:
+            pos = 1.0 - (tokens < conf_th).float().sum(-1) / seql
+            return pos > inl_th
+        else:
+            return tokens.mean(-1) > inl_th
\ No newline at end of file
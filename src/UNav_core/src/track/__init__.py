@@ -1,3 +1,5 @@
 from .hierarchical_localization import Coarse_Locator
 from .hierarchical_localization import Hloc as localization
+from .map_view import MapView
+from .frame_features import FrameFeatures
 from .implicit_distortion_model import coarse_pose,pose_refine,pose_multi_refine
\ No newline at end of file
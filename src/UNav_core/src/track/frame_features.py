@@ -0,0 +1,48 @@
+import threading
+
+import numpy as np
+import torch
+
+class FrameFeatures():
+    """
+    Per-frame feature context: the query image and everything the localization pipeline derives from it.
+
+    Created once when a frame is ingested and threaded through coarse VPR, global
+    retrieval and local feature matching, so each extractor runs at most once per
+    frame. A batch (Hloc.extract_features) fills the features in up front; otherwise
+    they are computed on first access with the extractors given here.
+    """
+    def __init__(self, image, global_extractor=None, local_extractor=None, global_descriptor=None, local_features=None):
+        self.image = image if isinstance(image, np.ndarray) else np.array(image)
+        self.image_size = self.image.shape[:2]
+        self.global_extractor = global_extractor
+        self.local_extractor = local_extractor
+        self._global_descriptor = global_descriptor
+        self._local_features = local_features
+        # (top-k segments, segment, success) once coarse VPR ran for this frame
+        self.coarse = None
+        # Candidates, LightGlue layers and correspondences of the matching step, see Local_matcher.lightglue_batch
+        self.matching_stats = None
+        self.lock = threading.Lock()
+
+    @property
+    def global_descriptor(self):
+        """
+        Global descriptor [1 x D].
+        """
+        with self.lock:
+            if self._global_descriptor is None:
+                with torch.inference_mode():
+                    self._global_descriptor = self.global_extractor(self.image)
+            return self._global_descriptor
+
+    @property
+    def local_features(self):
+        """
+        Local features (keypoints, descriptors, scores, image_size) of the query side of the matchers.
+        """
+        with self.lock:
+            if self._local_features is None:
+                with torch.inference_mode():
+                    self._local_features = self.local_extractor(self.image)
+            return self._local_features
@@ -3,14 +3,26 @@ from UNav_core.src.feature.local_extractor import Local_extractor
 from UNav_core.src.feature.local_matcher import Local_matcher
 from UNav_core.src.third_party.torchSIFT.src.torchsift.ransac.ransac import ransac
 from UNav_core.src.track.implicit_distortion_model import coarse_pose,pose_multi_refine
+from UNav_core.src.track.retrieval_index import FlatIndex, load_index, index_path
+from UNav_core.src.feature.descriptor_projection import StoredDescriptors
+from UNav_core.src.track.frame_features import FrameFeatures
 import torch
 import numpy as np
-from os.path import join
+from scipy import sparse
+import logging
+from os.path import join, exists
 from time import time
+from collections import defaultdict
 import h5py
 import pickle
 from skimage.transform import resize
 
+logger = logging.getLogger(__name__)
+
+# Progressive matching retries a coarse PnP that kept too few inliers only after the verified
+# correspondences grew by this factor, so it runs a handful of times instead of once per stage
+PNP_RETRY_GROWTH = 1.5
+
 def read_pickle_file(file_path):
     try:
         with open(file_path, 'rb') as file:
@@ -31,16 +43,25 @@ class Coarse_Locator:
         :param config: Configuration dictionary containing parameters for VPR.
         """
         self.device = config['devices']
-        self.global_extractor = Global_Extractors(config).get()
+        global_extractors = Global_Extractors(config)
+        self.global_extractor = global_extractors.get()
+        self.global_batch_extractor = global_extractors.get_batch()
+        self.global_projection = global_extractors.get_projection()
+        self.descriptor_dtype = global_extractors.descriptor_dtype
         self.config = config['hloc']
 
-        # Load global descriptors and segment IDs
-        self.global_descriptors, self.segment_ids = self.load_global_features(join(config['IO_root'],'data', config['location']['place']))
+        # Load global descriptors and segment IDs, projected like the query descriptors
+        place_root = join(config['IO_root'],'data', config['location']['place'])
+        self.global_descriptors, self.segment_ids = self.load_global_features(place_root)
+        if self.global_projection is not None:
+            self.global_descriptors = self.global_projection(self.global_descriptors).cpu()
+        self.retrieval_index = self.load_retrieval_index(place_root)
         
         # Load connection graph
         file_path = join(config['IO_root'],'data', config['location']['place'], 'MapConnnection_Graph.pkl')
         connection_graph = read_pickle_file(file_path)
-        self.connection_graph = connection_graph
+        self.connection_graph = connection_graph if connection_graph is not None else {}
+        self.build_segment_graph()
         
     def load_global_features(self, root):
         """
@@ -53,36 +74,87 @@ class Coarse_Locator:
             descriptors = f['descriptors'][:]
             segment_ids = f['segments'][:].astype(str)
         
-        return torch.tensor(descriptors, dtype=torch.float32).to(self.device), segment_ids
+        # Kept on the CPU, the retrieval index moves what it scores against to the device
+        return torch.tensor(descriptors, dtype=torch.float32), segment_ids
+
+    def load_retrieval_index(self, root):
+        """
+        Load the retrieval index configured under hloc.retrieval_index (built offline with
+        python -m UNav_core.src.track.retrieval_index), falling back to exact search.
+        """
+        index_config = self.config.get('retrieval_index', {})
+        index_type = index_config.get('type', 'flat')
+        if index_type != 'flat':
+            path = index_path(root, index_type)
+            if exists(path):
+                try:
+                    return load_index(path, self.global_descriptors, self.device, nprobe=index_config.get('nprobe'), dtype=self.descriptor_dtype)
+                except ValueError as e:
+                    logger.warning("Could not load retrieval index %s, using exact search: %s", path, e)
+            else:
+                logger.warning("Retrieval index %s not found, using exact search", path)
+        return FlatIndex(self.global_descriptors, self.device, self.descriptor_dtype)
 
-    def coarse_vpr(self, image):
+    def store_database_descriptors(self, descriptors, device):
+        """
+        Bring map global descriptors [N x D] into the space and precision queries are compared in.
+        :return: StoredDescriptors on the device.
+        """
+        descriptors = torch.as_tensor(np.asarray(descriptors, dtype=np.float32))
+        if self.global_projection is not None:
+            descriptors = self.global_projection(descriptors)
+        return StoredDescriptors(descriptors, self.descriptor_dtype, device)
+
+    def build_segment_graph(self):
+        """
+        Integer ids for the segments of the database descriptors and the sparse voting matrix of the
+        connection graph: row s has a 1 for s itself and for every adjacent segment of s, so
+        segment_adjacency @ counts gives each segment its own votes plus the votes of its neighbors.
+        """
+        self.segment_names, self.descriptor_segments = np.unique(self.segment_ids, return_inverse=True)
+        self.segment_index = {segment: i for i, segment in enumerate(self.segment_names)}
+
+        num_segments = len(self.segment_names)
+        rows, cols = list(range(num_segments)), list(range(num_segments))
+        for segment, connection_data in self.connection_graph.items():
+            if segment not in self.segment_index:
+                continue
+            neighbors = connection_data.get('adjacent_segment', ()) if isinstance(connection_data, dict) else connection_data
+            for neighbor in neighbors or ():
+                if neighbor in self.segment_index:
+                    rows.append(self.segment_index[segment])
+                    cols.append(self.segment_index[neighbor])
+        self.segment_adjacency = sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)), shape=(num_segments, num_segments))
+
+    def coarse_vpr(self, image, query_desc=None):
             """
             Perform coarse visual place recognition.
             :param image: The query image for which to find the place.
+            :param query_desc: Global descriptor of the image if it was already extracted, e.g. by a batch.
             :return: Top-k matches and a boolean indicating if the corresponding segment is found.
             """
-            print("Starting coarse_vpr function")
-            
             # Extract global descriptor from the query image
-            query_desc = self.global_extractor(image).to(self.device)
-            print(f"Extracted query descriptor: {query_desc.shape}")
-    
-            # Compute similarity between the query descriptor and database descriptors
-            sim = torch.einsum('id,jd->ij', query_desc, self.global_descriptors)
-            print(f"Computed similarity matrix: {sim.shape}")
-            
-            topk_indices = torch.topk(sim, self.config['retrieval_num'], dim=1).indices.cpu().numpy()
-            print(f"Top-k indices: {topk_indices}")
-    
-            # Retrieve the corresponding segment IDs for the top-k matches
-            topk_segments = self.segment_ids[topk_indices[0]]
-            print(f"Top-k segments: {topk_segments}")
-            
-            # Analyze top-k results
-            segment, success = self.analyze_topk_results(topk_segments)
-            print(f"Analyzed top-k results: segment={segment}, success={success}")
-            
-            return topk_segments, segment, success
+            if query_desc is None:
+                query_desc = self.global_extractor(image)
+            return self.coarse_vpr_batch(query_desc[:1] if query_desc.dim() > 1 else query_desc[None])[0]
+
+    def coarse_vpr_batch(self, query_descs):
+            """
+            Coarse visual place recognition of several queries with one index search.
+            :param query_descs: [B x D] global descriptors, e.g. the frames of several sessions.
+            :return: List of (top-k segments, segment, success) per query.
+            """
+            # Search the database descriptors through the retrieval index
+            _, topk_indices = self.retrieval_index.search(query_descs.to(self.device), self.config['retrieval_num'])
+            topk_indices = topk_indices.cpu().numpy()
+
+            # Retrieve the corresponding segment IDs for the top-k matches, -1 pads missing results
+            results = []
+            for row, (segment, success) in zip(topk_indices, self.analyze_topk_batch(topk_indices)):
+                topk_segments = self.segment_ids[row[row >= 0]]
+                logger.debug("coarse_vpr: top-k segments %s, segment=%s, success=%s", topk_segments, segment, success)
+                results.append((topk_segments, segment, success))
+            return results
     
     def get_topk_segments(self, topk_indices):
         """
@@ -101,44 +173,46 @@ class Coarse_Locator:
         :param topk_segments: List of segment IDs corresponding to the top-k matches.
         :return: The most likely segment and a boolean indicating if localization succeeded.
         """
-        print("Starting analyze_topk_results function")
-        print(f"Top-k segments: {topk_segments}")
-    
-        segment_counts = {}
-        
-        # First, count occurrences of each segment in topk_segments
-        for segment in topk_segments:
-            if segment in segment_counts:
-                segment_counts[segment] += 1
-            else:
-                segment_counts[segment] = 1
-        
-        print(f"Segment counts: {segment_counts}")
-        
-        # Initialize a dictionary to accumulate counts for segments and their neighbors
-        segment_wt_neighbor_counts = {}
-    
-        # Accumulate counts including neighbor segments
-        for segment, count in segment_counts.items():
-            # Start with the count of the segment itself
-            total_count = count
-            
-            # Add counts of neighbors if they exist in the topk_segments
-            if segment in self.connection_graph:
-                for neighbor in self.connection_graph[segment]:
-                    if neighbor in segment_counts:
-                        total_count += segment_counts[neighbor]
-            
-            # Record the accumulated count for the segment
-            segment_wt_neighbor_counts[segment] = total_count
-        
-        print(f"Segment with neighbor counts: {segment_wt_neighbor_counts}")
-        
-        # Determine the segment with the highest total count
-        most_likely_segment = max(segment_wt_neighbor_counts, key=segment_wt_neighbor_counts.get)
-        success = (segment_wt_neighbor_counts[most_likely_segment] / len(topk_segments)) >= 0.1
-        print(f"Success ratio: {success}")
-        return most_likely_segment, success
+        segments = np.array([[self.segment_index.get(segment, -1) for segment in topk_segments]], dtype=np.int64).reshape(1, -1)
+        return self._vote_segments(segments)[0]
+
+    def analyze_topk_batch(self, topk_indices):
+        """
+        Neighbor-weighted segment voting for a batch of queries.
+        :param topk_indices: [B x k] database rows from the retrieval index, -1 pads missing results.
+        :return: List of (most likely segment, success) per query.
+        """
+        topk_indices = np.atleast_2d(np.asarray(topk_indices))
+        valid = topk_indices >= 0
+        segments = np.where(valid, self.descriptor_segments[np.where(valid, topk_indices, 0)], -1)
+        return self._vote_segments(segments)
+
+    def _vote_segments(self, segments):
+        """
+        :param segments: [B x k] integer segment ids, -1 for missing results.
+        """
+        valid = segments >= 0
+        batch_size, num_segments = segments.shape[0], len(self.segment_names)
+
+        # Votes of every segment per query [B x S], then plus the votes of its neighbors
+        offsets = np.arange(batch_size)[:, None] * num_segments
+        counts = np.bincount((offsets + segments)[valid], minlength=batch_size * num_segments).reshape(batch_size, num_segments)
+        weighted = np.asarray(self.segment_adjacency @ counts.T).T
+
+        # Only retrieved segments are candidates, ties go to the one retrieved first
+        scores = np.where(valid, np.take_along_axis(weighted, np.where(valid, segments, 0), axis=1), -1)
+        best = np.argmax(scores, axis=1)
+        num_valid = valid.sum(axis=1)
+
+        results = []
+        for b in range(batch_size):
+            if num_valid[b] == 0:
+                results.append((None, False))
+                continue
+            score = scores[b, best[b]]
+            results.append((self.segment_names[segments[b, best[b]]], bool(score / num_valid[b] >= 0.1)))
+        logger.debug("Segment votes %s", results)
+        return results
     
     def get_segment_id(self, index):
         """
@@ -154,6 +228,9 @@ class Coarse_Locator:
 
     def get_global_extractor(self):
         return self.global_extractor
+
+    def get_global_batch_extractor(self):
+        return self.global_batch_extractor
     
 class Hloc():
     device='cuda' if torch.cuda.is_available() else "cpu"
@@ -161,121 +238,161 @@ class Hloc():
         # loading config setting
         self.config=config['hloc']
         self.batch_mode=self.config['batch_mode']
+        # Progressive matching: candidates in stages of stage_size, verified per stage, see progressive_matching
+        self.progressive=self.config.get('progressive') or {}
         self.thre=self.config['ransac_thre']
         self.match_type=self.config['match_type']
         self.feature_configs=config['feature']
 
 
         self.global_extractor = coarse_locator.get_global_extractor()
+        self.global_batch_extractor = coarse_locator.get_global_batch_extractor()
 
+        # Extractor and matcher networks come warmed from the process-wide model registry
         local_feature = Local_extractor(self.feature_configs['local'])
         self.local_feature_extractor = local_feature.extractor()
+        self.local_feature_batch_extractor = local_feature.batch_extractor()
+        
+        # The matcher is independent of the map, map data is passed in as a shared MapView
+        self.local_feature_matcher = Local_matcher(threshold = self.thre, **self.feature_configs)
+        
+        # Per-session pose history used by pnp for multi-frame refinement
+        self.sessions = defaultdict(dict)
         
         self.logger = logger
 
-    def form_global_descriptor_tensor(self):
+    def warmup(self, height=480, width=640):
         """
-        Iterate over self.map_data['perspective_frames'] and form a global descriptor tensor.
+        Run the query-side networks once on a dummy frame at startup, so the first
+        real frame does not pay for lazy CUDA context / cudnn initialization.
         """
-        global_descriptors = []
-        self.db_name = []
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        with torch.inference_mode():
+            self.global_extractor(image)
+            self.local_feature_extractor(image)
+        self.logger.info("Localization models warmed up")
 
-        # Iterate over each frame in perspective_frames
-        for frame_name, frame_data in self.map_data['perspective_frames'].items():
-            # Extract the global_descriptor for this frame
-            global_descriptor = frame_data['global_descriptor']
-            
-            # Append frame name
-            self.db_name.append(frame_name)
-            
-            # Append to the list of global descriptors
-            global_descriptors.append(torch.tensor(global_descriptor, dtype=torch.float32))
+    def extract_features(self, images):
+        """
+        Run the global and local extractors once over a batch of frames (possibly from different sessions).
+        :return: One dictionary per frame with its global descriptor [1 x D] and local features,
+                 to be passed back into get_location.
+        """
+        images = [np.array(image) for image in images]
+        with torch.inference_mode():
+            if self.global_batch_extractor is not None:
+                global_descriptors = self.global_batch_extractor(images)
+            else:
+                global_descriptors = torch.cat([self.global_extractor(image) for image in images])
+
+            if self.local_feature_batch_extractor is not None:
+                local_features = self.local_feature_batch_extractor(images)
+            else:
+                local_features = [self.local_feature_extractor(image) for image in images]
 
-        # Stack all global descriptors into a single tensor
-        global_descriptor_tensor = torch.stack(global_descriptors, dim=0)
+        return [FrameFeatures(image, self.global_extractor, self.local_feature_extractor, global_descriptor=global_descriptors[index:index+1], local_features=local_features[index]) for index, image in enumerate(images)]
 
-        return global_descriptor_tensor
+    def frame_features(self, image):
+        """
+        Feature context of a single frame, computing each feature on first use.
+        """
+        return FrameFeatures(image, self.global_extractor, self.local_feature_extractor)
 
-    def update_maps(self, map_data):
-        # loading map data
-        self.map_data=map_data
-        
-        self.rot_base=map_data['rot_base']
-        self.T=map_data['T']
-        self.db_global_descriptors=self.form_global_descriptor_tensor()
-        
-        self.local_feature_matcher= Local_matcher(self.db_name, self.map_data['perspective_frames'], threshold = self.thre, **self.feature_configs)
-        
-        # load process default data
-        self.list_2d, self.list_3d, self.initial_poses, self.pps = [], [], [], []
-        self.last_time=time()
+    def _initialize_session(self, session_id, map_view):
+        """
+        Get the pose history of a session, resetting it whenever the session moves to another cluster.
+        """
+        session_data = self.sessions[session_id]
+        if session_data.get('map_key') != map_view.key:
+            session_data.update({
+                'map_key': map_view.key,
+                'list_2d': [],
+                'list_3d': [],
+                'initial_poses': [],
+                'pps': [],
+                'current_reload_num': 0,
+                'last_time': time()
+            })
+        return session_data
+
+    def release_session(self, session_id):
+        if session_id in self.sessions:
+            del self.sessions[session_id]
         
-    def global_retrieval(self, image):
-        # Extract the global descriptor from the query image
-        self.query_desc = self.global_extractor(image)
+    def global_retrieval(self, image, map_view, query_desc=None):
+        """
+        Top-k frames of map_view for the image, or for query_desc when it was extracted already.
+        query_desc may hold several descriptors [B x D] (e.g. frames of sessions sharing the view), giving [B x k].
+        """
+        if query_desc is None:
+            query_desc = self.global_extractor(image)
+        if query_desc.dim() == 1:
+            query_desc = query_desc[None]
 
-        sim = torch.einsum('id,jd->ij', self.query_desc, self.db_global_descriptors.to(self.device))
-        topk = torch.topk(sim, self.config['retrieval_num'], dim=1).indices.cpu().numpy()
+        sim = map_view.db_global_descriptors.similarity(query_desc)
+        topk = torch.topk(sim, min(self.config['retrieval_num'], len(map_view)), dim=1).indices.cpu().numpy()
 
         return topk
 
-    def feature_matching_lightglue_batch(self,image,topk):
+    def feature_matching_lightglue_batch(self,image,map_view,topk,feats0=None,stats=None):
         """
         Local Feature Matching:
             Match the local features between query image and retrieved database images
         """
         with torch.inference_mode():  # Use torch.no_grad during inference
-            image_np = np.array(image)
-            feats0 = self.local_feature_extractor(image_np)
-            valid_db_frame_name, pts0_list,pts1_list,lms_list,max_len=self.local_feature_matcher.lightglue_batch(self, topk[0], feats0)
+            if feats0 is None:
+                image_np = np.array(image)
+                feats0 = self.local_feature_extractor(image_np)
+            valid_db_frame_name, pts0_list,pts1_list,lms_list,max_len=self.local_feature_matcher.lightglue_batch(map_view, topk[0], feats0, stats=stats)
 
         return valid_db_frame_name, pts0_list,pts1_list,lms_list,max_len
 
-    def feature_matching_lightglue(self,image,topk):
+    def feature_matching_lightglue(self,image,map_view,topk,feats0=None,stats=None):
         """
         Local Feature Matching:
             Match the local features between query image and retrieved database images
         """
-        with torch.inference_mode():  # Use torch.no_grad during inference
-            image_np = np.array(image)
-            feats0 = self.local_feature_extractor(image_np)
-            image_np = np.array(image)
-            feats0 = self.local_feature_extractor(image_np)
+        if feats0 is None:
+            with torch.inference_mode():  # Use torch.no_grad during inference
+                image_np = np.array(image)
+                feats0 = self.local_feature_extractor(image_np)
         pts0_list,pts1_list,lms_list=[],[],[]
         max_len=0
         
         valid_db_frame_name = []
-        
-        valid_db_frame_name = []
+        layers = []
+        correspondences = 0
         for i in topk[0]:
-            pts0,pts1,lms=self.local_feature_matcher.lightglue(i, feats0)
+            pts0,pts1,lms,stop=self.local_feature_matcher.lightglue(map_view, i, feats0)
+            layers.append(stop)
             
             feat_inliner_size=pts0.shape[0]
             if feat_inliner_size>self.thre:
-                valid_db_frame_name.append(self.db_name[i])
-                valid_db_frame_name.append(self.db_name[i])
+                valid_db_frame_name.append(map_view.db_name[i])
                 pts0_list.append(pts0)
                 pts1_list.append(pts1)
                 lms_list.append(lms)
+                correspondences += feat_inliner_size
                 if feat_inliner_size>max_len:
                     max_len=feat_inliner_size
             del pts0,pts1,lms
-        del self.query_desc, feats0
-        torch.cuda.empty_cache()
-        return valid_db_frame_name, pts0_list,pts1_list,lms_list,max_len
+        del feats0
+        if stats is not None:
+            stats.update({'candidates': len(layers), 'candidates_total': len(topk[0]), 'layers': layers, 'correspondences': correspondences})
         return valid_db_frame_name, pts0_list,pts1_list,lms_list,max_len
     
-    def feature_matching_superglue(self,image,topk):
+    def feature_matching_superglue(self,image,map_view,topk,feats0=None):
         """
         Local Feature Matching:
             Match the local features between query image and retrieved database images
         """
-        with torch.inference_mode():  # Use torch.no_grad during inference
-            feats0 = self.local_feature_extractor(image)
+        if feats0 is None:
+            with torch.inference_mode():  # Use torch.no_grad during inference
+                feats0 = self.local_feature_extractor(image)
         pts0_list,pts1_list,lms_list=[],[],[]
         max_len=0
         for i in topk[0]:
-            pts0,pts1,lms=self.local_feature_matcher.superglue(i, feats0)
+            pts0,pts1,lms=self.local_feature_matcher.superglue(map_view, i, feats0)
             feat_inliner_size=pts0.shape[0]
             if feat_inliner_size>self.thre:
                 pts0_list.append(pts0)
@@ -283,8 +400,7 @@ class Hloc():
                 lms_list.append(lms)
                 if feat_inliner_size>max_len:
                     max_len=feat_inliner_size
-        del self.query_desc, feats0
-        torch.cuda.empty_cache()
+        del feats0
         return pts0_list,pts1_list,lms_list,max_len
 
     def geometric_verification(self, valid_db_frame_name, pts0_list, pts1_list, lms_list, max_len):
@@ -328,7 +444,6 @@ class Hloc():
         masked_lms = [lms[i][diag_masks[i]] for i in range(lms.size(0))]
 
         del pts0, pts1, lms, mask
-        torch.cuda.empty_cache()
         
         if len(masked_pts0) > 0:
             return final_candidates, torch.cat(masked_pts0), torch.cat(masked_lms)
@@ -340,10 +455,11 @@ class Hloc():
         #     return None, torch.tensor([]), None
 
 
-    def pnp(self, image, feature2D, landmark3D):
+    def pnp(self, session_data, map_view, image, feature2D, landmark3D, coarse=None):
         """
         Start Perspective-n-points:
             Estimate the current location using implicit distortion model
+        :param coarse: Result of coarse_pose on feature2D / landmark3D when it was already computed (progressive matching).
         """
         print("Starting pnp function")
         if feature2D.size()[0] > 0:
@@ -356,24 +472,24 @@ class Hloc():
             print(f"Image shape: height={height}, width={width}")
             feature2D, landmark3D = feature2D.cpu().numpy(), landmark3D.cpu().numpy()
             print("Converted feature2D and landmark3D to numpy arrays")
-            out, p2d_inlier, p3d_inlier = coarse_pose(feature2D, landmark3D, np.array([width / 2, height / 2]))
+            out, p2d_inlier, p3d_inlier = coarse if coarse is not None else coarse_pose(feature2D, landmark3D, np.array([width / 2, height / 2]))
             print(f"Coarse pose output: {out}")
-            self.list_2d.append(p2d_inlier)
-            self.list_3d.append(p3d_inlier)
-            self.initial_poses.append(out['pose'])
-            self.pps.append(out['pp'])
+            session_data['list_2d'].append(p2d_inlier)
+            session_data['list_3d'].append(p3d_inlier)
+            session_data['initial_poses'].append(out['pose'])
+            session_data['pps'].append(out['pp'])
             print("Appended inliers and initial pose to lists")
-            if len(self.list_2d) > self.config['implicit_num']:
+            if len(session_data['list_2d']) > self.config['implicit_num']:
                 print("List sizes exceeded implicit_num, popping oldest elements")
-                self.list_2d.pop(0)
-                self.list_3d.pop(0)
-                self.initial_poses.pop(0)
-                self.pps.pop(0)
-            pose = pose_multi_refine(self.list_2d, self.list_3d, self.initial_poses, self.pps, self.rot_base, self.T)
+                session_data['list_2d'].pop(0)
+                session_data['list_3d'].pop(0)
+                session_data['initial_poses'].pop(0)
+                session_data['pps'].pop(0)
+            pose = pose_multi_refine(session_data['list_2d'], session_data['list_3d'], session_data['initial_poses'], session_data['pps'], map_view.rot_base, map_view.T)
             print(f"Refined pose: {pose}")
     
             # Reset reload num
-            self.current_reload_num = 0
+            session_data['current_reload_num'] = 0
             print("Reset current_reload_num to 0")
         else:
             pose = None
@@ -382,12 +498,67 @@ class Hloc():
         print("Returning pose")
         return pose
     
-    def _determine_next_segment(self, candidates):
+    def progressive_matching(self, image, map_view, topk, feats0, stats):
+        """
+        Match and verify the retrieved candidates in stages of hloc.progressive.stage_size, in retrieval order.
+        Also used for the adaptive min_correspondences of the local matcher, which is a min_inliers of its own.
+        Stops as soon as the verified correspondences reach min_inliers, or a coarse PnP on them keeps
+        min_pnp_inliers inliers; otherwise every stage runs, i.e. the full candidate set is used.
+        A coarse PnP that falls short is only retried once the correspondences grew by PNP_RETRY_GROWTH.
+        Verification is per candidate pair, so verifying stage by stage keeps the same correspondences.
+        :return: Verified candidates, feature2D, landmark3D and the coarse PnP result if it was computed.
+        """
+        stage_size = self.progressive.get('stage_size', 15)
+        min_inliers = min([threshold for threshold in (self.progressive.get('min_inliers', 0), self.local_feature_matcher.min_correspondences) if threshold > 0], default=0)
+        min_pnp_inliers = self.progressive.get('min_pnp_inliers', 0)
+        height, width = np.asarray(image).shape[:2]
+        match = self.feature_matching_lightglue_batch if self.batch_mode else self.feature_matching_lightglue
+
+        candidates = topk[0]
+        final_candidates, feature2D, landmark3D = [], [], []
+        num_inliers = 0
+        coarse = None
+        # Correspondences needed before the next coarse PnP attempt
+        next_pnp_inliers = min_pnp_inliers
+        stats.update({'candidates': 0, 'candidates_total': len(candidates), 'layers': [], 'correspondences': 0, 'stages': 0})
+        for start in range(0, len(candidates), stage_size):
+            stage_stats = {}
+            valid_db_frame_name, pts0_list, pts1_list, lms_list, max_matched_num = match(image, map_view, candidates[None, start:start + stage_size], feats0=feats0, stats=stage_stats)
+            stats['candidates'] += stage_stats['candidates']
+            stats['layers'].extend(stage_stats['layers'])
+            stats['correspondences'] += stage_stats['correspondences']
+            stats['stages'] += 1
+            if len(pts0_list) == 0:
+                continue
+
+            verified, stage_2d, stage_3d = self.geometric_verification(valid_db_frame_name, pts0_list, pts1_list, lms_list, max_matched_num)
+            if len(verified) == 0:
+                continue
+            final_candidates.extend(verified)
+            feature2D.append(stage_2d)
+            landmark3D.append(stage_3d)
+            num_inliers += len(stage_2d)
+
+            if min_inliers > 0 and num_inliers >= min_inliers:
+                break
+            if min_pnp_inliers > 0 and num_inliers >= next_pnp_inliers:
+                coarse = coarse_pose(torch.cat(feature2D).cpu().numpy(), torch.cat(landmark3D).cpu().numpy(), np.array([width / 2, height / 2]))
+                if len(coarse[1]) >= min_pnp_inliers:
+                    break
+                coarse = None
+                next_pnp_inliers = num_inliers * PNP_RETRY_GROWTH
+
+        stats['verified_inliers'] = num_inliers
+        if len(final_candidates) == 0:
+            return [], torch.tensor([]), None, None
+        return final_candidates, torch.cat(feature2D), torch.cat(landmark3D), coarse
+
+    def _determine_next_segment(self, map_view, candidates):
         candidate_histogram = {}
         max_counts = 0
         next_segment_id = None
         for candidate in candidates:
-            segment_id = self.map_data['perspective_frames'][candidate].get('segment_id')
+            segment_id = map_view.segment_of(candidate)
             if segment_id in candidate_histogram:
                 candidate_histogram[segment_id] += 1
             else:
@@ -398,37 +569,56 @@ class Hloc():
         
         return next_segment_id
             
-    def get_location(self, image):
+    def get_location(self, session_id, map_view, image, features=None):
+        """
+        Localize one frame of a session against a map view.
+        :param features: FrameFeatures of the frame, so features already computed for it (by a batch or by
+                         coarse VPR) are reused. Created here if not given.
+        """
+        session_data = self._initialize_session(session_id, map_view)
+        if features is None:
+            features = self.frame_features(image)
+        
         self.logger.debug("Start image retrieval")
 
-        topk=self.global_retrieval(image)
+        topk=self.global_retrieval(image, map_view, query_desc=features.global_descriptor)
         
         valid_db_frame_name = []
         next_segment_id = None
+        coarse = None
         
         if self.match_type=='superglue':
             self.logger.debug("Matching local feature")
-            pts0_list,pts1_list,lms_list,max_matched_num=self.feature_matching_superglue(image,topk)
+            pts0_list,pts1_list,lms_list,max_matched_num=self.feature_matching_superglue(image,map_view,topk,feats0=features.local_features)
             self.logger.debug("Start geometric verification")
             feature2D,landmark3D=self.geometric_verification(pts0_list, pts1_list, lms_list, max_matched_num)
 
         elif self.match_type=='lightglue':
             self.logger.debug("Matching local feature")
-            if self.batch_mode:
-                valid_db_frame_name, pts0_list,pts1_list,lms_list,max_matched_num=self.feature_matching_lightglue_batch(image,topk)
+            stats = {}
+            # Early exit over the candidates counts verified correspondences, so it needs staged verification
+            if self.progressive or self.local_feature_matcher.min_correspondences > 0:
+                final_candidates, feature2D, landmark3D, coarse = self.progressive_matching(image, map_view, topk, features.local_features, stats)
             else:
-                valid_db_frame_name, pts0_list,pts1_list,lms_list,max_matched_num=self.feature_matching_lightglue(image,topk)
-            
-            self.logger.debug("Start geometric verification")
-            if len(pts0_list)>0:
-                final_candidates, feature2D,landmark3D=self.geometric_verification(valid_db_frame_name, pts0_list, pts1_list, lms_list, max_matched_num)
-                if len(final_candidates)>0:
-                    next_segment_id = self._determine_next_segment(final_candidates)
+                if self.batch_mode:
+                    valid_db_frame_name, pts0_list,pts1_list,lms_list,max_matched_num=self.feature_matching_lightglue_batch(image,map_view,topk,feats0=features.local_features,stats=stats)
                 else:
-                    return None, None
+                    valid_db_frame_name, pts0_list,pts1_list,lms_list,max_matched_num=self.feature_matching_lightglue(image,map_view,topk,feats0=features.local_features,stats=stats)
+
+                self.logger.debug("Start geometric verification")
+                final_candidates = []
+                if len(pts0_list)>0:
+                    final_candidates, feature2D,landmark3D=self.geometric_verification(valid_db_frame_name, pts0_list, pts1_list, lms_list, max_matched_num)
+            features.matching_stats = stats
+            self.logger.debug(f"Matched {stats['candidates']}/{stats['candidates_total']} candidates, "
+                              f"{np.mean(stats['layers']) if stats['layers'] else 0:.1f} LightGlue layers on average, "
+                              f"{stats['correspondences']} 2D-3D correspondences")
+
+            if len(final_candidates)>0:
+                next_segment_id = self._determine_next_segment(map_view, final_candidates)
             else:
                 return None, None
 
         self.logger.debug("Estimate the camera pose using PnP algorithm")
-        pose=self.pnp(image,feature2D,landmark3D)
+        pose=self.pnp(session_data,map_view,image,feature2D,landmark3D,coarse=coarse)
         return pose, next_segment_id
\ No newline at end of file
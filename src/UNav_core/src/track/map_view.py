@@ -0,0 +1,252 @@
+import threading
+from collections import OrderedDict
+import torch
+import numpy as np
+from UNav_core.src.feature.descriptor_projection import StoredDescriptors
+
+def frame_tensors(frame_data):
+    """
+    Convert the local features and landmarks of one frame into tensors.
+    Landmarks are stored densely per keypoint, valid marks the keypoints that have one.
+    """
+    features = frame_data['local_features']
+    keypoints = torch.from_numpy(np.asarray(features['keypoints'], dtype=np.float32))
+    current_len = keypoints.shape[0]
+
+    # landmarks[i] belongs to keypoint valid_keypoints_index[i]
+    valid_keypoints_index = torch.from_numpy(np.asarray(features['valid_keypoints_index'], dtype=np.int64))
+    landmarks = torch.zeros((current_len, 3), dtype=torch.float64)
+    landmarks[valid_keypoints_index] = torch.from_numpy(np.asarray(frame_data['landmarks'], dtype=np.float64))
+    valid = torch.zeros(current_len, dtype=torch.bool)
+    valid[valid_keypoints_index] = True
+
+    return {
+        'keypoints': keypoints,
+        'descriptors': torch.from_numpy(np.asarray(features['descriptors'], dtype=np.float32)),
+        'scores': torch.from_numpy(np.asarray(features['scores'], dtype=np.float32)),
+        'image_size': torch.from_numpy(np.asarray(features['image_size'], dtype=np.float32)),
+        'landmarks': landmarks,
+        'valid': valid,
+    }
+
+def segment_global_descriptors(frames, frame_names, device, store_descriptors=None):
+    """
+    Global descriptors of the frames of one segment as one device-resident StoredDescriptors, rows following frame_names.
+    :param store_descriptors: Callable (descriptors [N x D], device) -> StoredDescriptors bringing the
+                              global descriptors into the query space (Coarse_Locator.store_database_descriptors).
+    """
+    global_descriptors = [np.asarray(frames[frame_name]['global_descriptor'], dtype=np.float32).reshape(-1) for frame_name in frame_names]
+    global_descriptors = np.stack(global_descriptors, axis=0) if len(global_descriptors) > 0 else np.zeros((0, 0), dtype=np.float32)
+    if store_descriptors is not None:
+        return store_descriptors(global_descriptors, device)
+    return StoredDescriptors(global_descriptors, 'float32', device)
+
+def empty_batch(batch, max_len, desc_dim, device):
+    return {
+        'keypoints': torch.zeros((batch, max_len, 2), dtype=torch.float32, device=device),
+        'descriptors': torch.zeros((batch, desc_dim, max_len), dtype=torch.float32, device=device),
+        'scores': torch.zeros((batch, max_len), dtype=torch.float32, device=device),
+        'image_size': torch.zeros((batch, 2), dtype=torch.float32, device=device),
+        'landmarks': torch.zeros((batch, max_len, 3), dtype=torch.float64, device=device),
+        'valid': torch.zeros((batch, max_len), dtype=torch.bool, device=device),
+    }
+
+def fill_batch(batch, position, tensors, max_len):
+    """
+    Copy the tensors of one frame into row position of a padded batch.
+    """
+    length = min(max_len, tensors['keypoints'].shape[0])
+    batch['keypoints'][position, :length] = tensors['keypoints'][:length]
+    batch['descriptors'][position, :, :length] = tensors['descriptors'][:, :length]
+    batch['scores'][position, :length] = tensors['scores'][:length]
+    batch['image_size'][position] = tensors['image_size']
+    batch['landmarks'][position, :length] = tensors['landmarks'][:length]
+    batch['valid'][position, :length] = tensors['valid'][:length]
+
+class SegmentTensors():
+    """
+    Contiguous, padded, device-resident copy of the local features of one map segment.
+
+    Built once when the segment enters the cache, so per-query matching only
+    indexes into these tensors by frame id instead of copying numpy arrays to
+    the device. Rows follow frame_names; descriptors keep the (D, N) layout
+    used by the matchers and landmarks are stored densely per keypoint, with
+    valid marking the keypoints that have a 3D landmark. global_descriptors
+    holds the retrieval descriptors of the same rows.
+    """
+    def __init__(self, segment_id, map_data, device, store_descriptors=None):
+        self.segment_id = segment_id
+        self.device = device
+
+        frames = map_data['perspective_frames']
+        self.frame_names = list(frames.keys())
+        self.name_to_index = {frame_name: index for index, frame_name in enumerate(self.frame_names)}
+        self.global_descriptors = segment_global_descriptors(frames, self.frame_names, device, store_descriptors)
+
+        local_features = [frames[frame_name]['local_features'] for frame_name in self.frame_names]
+        frame_num = len(local_features)
+
+        self.num_keypoints = np.array([len(features['keypoints']) for features in local_features], dtype=np.int64)
+        max_len = int(self.num_keypoints.max()) if frame_num > 0 else 0
+        self.desc_dim = np.asarray(local_features[0]['descriptors']).shape[0] if frame_num > 0 else 0
+
+        packed = empty_batch(frame_num, max_len, self.desc_dim, 'cpu')
+        for idx, frame_name in enumerate(self.frame_names):
+            fill_batch(packed, idx, frame_tensors(frames[frame_name]), max_len)
+
+        self.keypoints = packed['keypoints'].to(device)
+        self.descriptors = packed['descriptors'].to(device)
+        self.scores = packed['scores'].to(device)
+        self.image_size = packed['image_size'].to(device)
+        self.landmarks = packed['landmarks'].to(device)
+        self.valid = packed['valid'].to(device)
+
+    def __len__(self):
+        return len(self.frame_names)
+
+    def gather(self, rows, max_len):
+        """
+        Padded batch of the given rows, truncated or padded to max_len keypoints.
+        """
+        rows = torch.as_tensor(rows, dtype=torch.long, device=self.device)
+        length = min(max_len, self.keypoints.shape[1])
+        batch = empty_batch(len(rows), max_len, self.desc_dim, self.device)
+        batch['keypoints'][:, :length] = self.keypoints[rows, :length]
+        batch['descriptors'][:, :, :length] = self.descriptors[rows, :, :length]
+        batch['scores'][:, :length] = self.scores[rows, :length]
+        batch['image_size'][:] = self.image_size[rows]
+        batch['landmarks'][:, :length] = self.landmarks[rows, :length]
+        batch['valid'][:, :length] = self.valid[rows, :length]
+        return batch
+
+    def close(self):
+        pass
+
+class LazySegmentTensors():
+    """
+    On-demand counterpart of SegmentTensors for segments loaded with DataHandler.load_map(lazy=True).
+
+    Only keypoint counts are known up front; the local features of a frame are
+    read from the segment file the first time the frame is matched and kept on
+    the device in an LRU of hot frames, so resident memory follows what queries
+    actually retrieve. Global descriptors are small and always resident.
+    """
+    def __init__(self, segment_id, map_data, device, hot_frames=512, store_descriptors=None):
+        self.segment_id = segment_id
+        self.device = device
+        self.reader = map_data['reader']
+
+        frames = map_data['perspective_frames']
+        self.frame_names = list(frames.keys())
+        self.name_to_index = {frame_name: index for index, frame_name in enumerate(self.frame_names)}
+        self.global_descriptors = segment_global_descriptors(frames, self.frame_names, device, store_descriptors)
+        self.groups = [frames[frame_name]['group'] for frame_name in self.frame_names]
+
+        self.num_keypoints = np.array([self.reader.num_keypoints(group) for group in self.groups], dtype=np.int64)
+        self.desc_dim = self.reader.descriptor_dim(self.groups[0]) if len(self.groups) > 0 else 0
+
+        self.hot_frames = OrderedDict()
+        self.hot_frames_capacity = hot_frames
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.frame_names)
+
+    def _frame(self, row):
+        with self.lock:
+            tensors = self.hot_frames.get(row)
+            if tensors is not None:
+                self.hot_frames.move_to_end(row)
+                return tensors
+
+        tensors = {k: v.to(self.device) for k, v in frame_tensors(self.reader.read_frame(self.groups[row])).items()}
+
+        with self.lock:
+            self.hot_frames[row] = tensors
+            while len(self.hot_frames) > self.hot_frames_capacity:
+                self.hot_frames.popitem(last=False)
+        return tensors
+
+    def gather(self, rows, max_len):
+        """
+        Padded batch of the given rows, truncated or padded to max_len keypoints.
+        """
+        batch = empty_batch(len(rows), max_len, self.desc_dim, self.device)
+        for position, row in enumerate(rows):
+            fill_batch(batch, position, self._frame(row), max_len)
+        return batch
+
+    def close(self):
+        with self.lock:
+            self.hot_frames.clear()
+        self.reader.close()
+
+class MapView():
+    """
+    Read-only view over the map data of one loaded cluster of segments.
+
+    The view is built once per cluster composition and shared by every session
+    localizing against that cluster, so it must never be mutated after
+    construction. Per-session state (pose history for multi-frame refinement)
+    lives in Hloc.sessions instead. Local features are not copied, the view
+    indexes into the SegmentTensors / LazySegmentTensors of its segments, and
+    the retrieval matrix is the concatenation of their global descriptors.
+    """
+    def __init__(self, key, map_data, segment_tensors, device):
+        self.key = key
+        self.device = device
+
+        self.map_data = map_data
+        self.frames = map_data['perspective_frames']
+        self.rot_base = map_data['rot_base']
+        self.T = map_data['T']
+
+        # Frame ids run segment by segment, so the rows of db_global_descriptors follow db_name
+        self.db_name = []
+        self.frame_locations = []
+        segment_rows = []
+        for pack in segment_tensors:
+            rows = [row for row, frame_name in enumerate(pack.frame_names) if self.frames.get(frame_name, {}).get('segment_id') == pack.segment_id]
+            self.db_name.extend(pack.frame_names[row] for row in rows)
+            self.frame_locations.extend((pack, row) for row in rows)
+            segment_rows.append((pack.global_descriptors, None if len(rows) == len(pack) else rows))
+        self.name_to_index = {frame_name: index for index, frame_name in enumerate(self.db_name)}
+        self.num_keypoints = np.array([pack.num_keypoints[row] for pack, row in self.frame_locations], dtype=np.int64)
+
+        self.db_global_descriptors = StoredDescriptors.concatenate(segment_rows, device)
+
+    def __len__(self):
+        return len(self.db_name)
+
+    def gather_local_features(self, indices):
+        """
+        Assemble padded batch tensors for the given frame ids from the segment tensors.
+        :param indices: Frame ids (rows of db_name).
+        :return: Dictionary of keypoints [B x N x 2], descriptors [B x D x N], scores [B x N],
+                 image_size [B x 2], landmarks [B x N x 3] and valid [B x N].
+        """
+        max_len = int(self.num_keypoints[indices].max())
+
+        # Group the requested frames by the segment they live in
+        groups = {}
+        for position, index in enumerate(indices):
+            pack, row = self.frame_locations[index]
+            positions, rows = groups.setdefault(pack.segment_id, (pack, ([], [])))[1]
+            positions.append(position)
+            rows.append(row)
+
+        if len(groups) == 1:
+            pack, (_, rows) = next(iter(groups.values()))
+            return pack.gather(rows, max_len)
+
+        gathered = empty_batch(len(indices), max_len, self.frame_locations[indices[0]][0].desc_dim, self.device)
+        for pack, (positions, rows) in groups.values():
+            segment_batch = pack.gather(rows, max_len)
+            positions = torch.as_tensor(positions, dtype=torch.long, device=self.device)
+            for key, value in segment_batch.items():
+                gathered[key][positions] = value
+
+        return gathered
+
+    def segment_of(self, frame_name):
+        return self.frames[frame_name].get('segment_id')
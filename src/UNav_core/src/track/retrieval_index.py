@@ -0,0 +1,259 @@
+"""
+Retrieval indexes over the place-wide global descriptors used by Coarse_Locator.
+
+    flat   exact inner product against every descriptor (the former einsum + topk)
+    ivf    k-means coarse quantizer, only the nprobe closest inverted lists are scored exactly
+    pq     product quantization, every descriptor scored from uint8 codes with lookup tables
+    ivfpq  ivf candidate selection, candidates scored from pq codes
+
+Indexes are built offline on the CPU and stored next to global_features.h5:
+    python -m UNav_core.src.track.retrieval_index /mnt/data/UNav-IO/data/New_York_City --type ivfpq
+and loaded at start-up with load_index. All indexes rank by inner product, which
+for the L2-normalized NetVLAD descriptors is the cosine similarity.
+"""
+import argparse
+import json
+from os.path import join
+
+import h5py
+import numpy as np
+import torch
+
+from UNav_core.src.feature.descriptor_projection import DescriptorProjection, StoredDescriptors
+
+INDEX_TYPES = ('flat', 'ivf', 'pq', 'ivfpq')
+
+def index_path(root, index_type):
+    return join(root, f'global_index_{index_type}.npz')
+
+def _kmeans(data, clusters, seed=0):
+    # Only needed to build indexes offline
+    from sklearn.cluster import MiniBatchKMeans
+    clusters = min(clusters, len(data))
+    kmeans = MiniBatchKMeans(n_clusters=clusters, random_state=seed, batch_size=max(1024, clusters * 4), n_init=3)
+    kmeans.fit(data)
+    return kmeans.cluster_centers_.astype(np.float32), kmeans.labels_.astype(np.int64)
+
+def _pad_topk(scores, indices, k):
+    """
+    Top k of already gathered candidate scores, padded with -1 when there are fewer than k candidates.
+    """
+    k_found = min(k, scores.shape[-1])
+    top_scores, top_positions = torch.topk(scores, k_found, dim=-1)
+    top_indices = indices.gather(-1, top_positions) if indices is not None else top_positions
+    if k_found < k:
+        pad = k - k_found
+        top_scores = torch.cat([top_scores, top_scores.new_full((top_scores.shape[0], pad), float('-inf'))], dim=1)
+        top_indices = torch.cat([top_indices, top_indices.new_full((top_indices.shape[0], pad), -1)], dim=1)
+    return top_scores, top_indices
+
+class ProductQuantizer():
+    """
+    Splits descriptors into m sub-vectors, each encoded by the id of its nearest of 2^nbits sub-centroids.
+    """
+    def __init__(self, codebooks, device):
+        # codebooks: [M x C x D/M]
+        self.codebooks = torch.as_tensor(codebooks, dtype=torch.float32, device=device)
+        self.m, self.clusters, self.sub_dim = self.codebooks.shape
+
+    @staticmethod
+    def fit(data, m, nbits=8):
+        dim = data.shape[1]
+        if dim % m != 0:
+            raise ValueError(f"Descriptor dimension {dim} is not divisible into {m} sub-vectors")
+        sub_dim = dim // m
+        codebooks, codes = [], []
+        for sub in range(m):
+            centroids, labels = _kmeans(data[:, sub * sub_dim:(sub + 1) * sub_dim], 2 ** nbits, seed=sub)
+            if len(centroids) < 2 ** nbits:
+                centroids = np.concatenate([centroids, np.zeros((2 ** nbits - len(centroids), sub_dim), dtype=np.float32)])
+            codebooks.append(centroids)
+            codes.append(labels)
+        return np.stack(codebooks), np.stack(codes, axis=1).astype(np.uint8 if nbits <= 8 else np.int32)
+
+    def lookup_tables(self, queries):
+        # [B x M x C] inner products between query sub-vectors and sub-centroids
+        return torch.einsum('bmd,mcd->bmc', queries.reshape(queries.shape[0], self.m, self.sub_dim), self.codebooks)
+
+    def scores(self, tables, codes):
+        """
+        Asymmetric distance computation: scores [B x N] of the queries of tables against codes [N x M] or [B x N x M].
+        """
+        if codes.dim() == 2:
+            codes = codes.unsqueeze(0).expand(tables.shape[0], -1, -1)
+        # tables[b, m, codes[b, n, m]] summed over m
+        return tables.gather(2, codes.transpose(1, 2)).sum(dim=1)
+
+class FlatIndex():
+    index_type = 'flat'
+
+    def __init__(self, descriptors, device, dtype='float32'):
+        self.device = device
+        self.descriptors = StoredDescriptors(descriptors, dtype, device)
+        self.dim = self.descriptors.dim
+
+    def __len__(self):
+        return len(self.descriptors)
+
+    @classmethod
+    def build(cls, descriptors, device='cpu', dtype='float32', **kwargs):
+        return cls(descriptors, device, dtype)
+
+    def arrays(self):
+        return {}
+
+    def search(self, queries, k):
+        """
+        :param queries: [B x D] query descriptors.
+        :return: Scores and database indices [B x k], best first, indices -1 where there are fewer than k results.
+        """
+        return _pad_topk(self.descriptors.similarity(queries), None, k)
+
+class PQIndex():
+    index_type = 'pq'
+
+    def __init__(self, codebooks, codes, device):
+        self.device = device
+        self.pq = ProductQuantizer(codebooks, device)
+        self.codes = torch.as_tensor(np.asarray(codes, dtype=np.int64), device=device)
+        self.dim = self.pq.m * self.pq.sub_dim
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @classmethod
+    def build(cls, descriptors, device='cpu', m=64, nbits=8, **kwargs):
+        codebooks, codes = ProductQuantizer.fit(np.asarray(descriptors, dtype=np.float32), m, nbits)
+        return cls(codebooks, codes, device)
+
+    def arrays(self):
+        return {'codebooks': self.pq.codebooks.cpu().numpy(), 'codes': self.codes.cpu().numpy().astype(np.uint8 if self.pq.clusters <= 256 else np.int32)}
+
+    def search(self, queries, k):
+        queries = queries.to(self.device, dtype=torch.float32)
+        return _pad_topk(self.pq.scores(self.pq.lookup_tables(queries), self.codes), None, k)
+
+class IVFIndex():
+    """
+    Inverted lists over k-means cells of the descriptors. Candidates of the nprobe
+    closest cells are scored exactly, or from pq codes when a product quantizer is given.
+    """
+    def __init__(self, centroids, list_offsets, list_ids, device, nprobe=8, descriptors=None, codebooks=None, codes=None, dtype='float32'):
+        self.device = device
+        self.nprobe = nprobe
+        self.centroids = torch.as_tensor(centroids, dtype=torch.float32, device=device)
+        self.dim = self.centroids.shape[1]
+        # ids of cell i are list_ids[list_offsets[i]:list_offsets[i+1]]
+        self.list_offsets = np.asarray(list_offsets, dtype=np.int64)
+        self.list_ids = torch.as_tensor(np.asarray(list_ids, dtype=np.int64), device=device)
+
+        self.descriptors = StoredDescriptors(descriptors, dtype, device) if descriptors is not None else None
+        self.pq = ProductQuantizer(codebooks, device) if codebooks is not None else None
+        self.codes = torch.as_tensor(np.asarray(codes, dtype=np.int64), device=device) if codes is not None else None
+        self.index_type = 'ivfpq' if self.pq is not None else 'ivf'
+
+    def __len__(self):
+        return self.list_ids.shape[0]
+
+    @classmethod
+    def build(cls, descriptors, device='cpu', nlist=256, nprobe=8, pq=False, m=64, nbits=8, dtype='float32', **kwargs):
+        descriptors = np.asarray(descriptors, dtype=np.float32)
+        centroids, labels = _kmeans(descriptors, nlist)
+        order = np.argsort(labels, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=len(centroids)))])
+        if pq:
+            codebooks, codes = ProductQuantizer.fit(descriptors, m, nbits)
+            return cls(centroids, list_offsets, order, device, nprobe=nprobe, codebooks=codebooks, codes=codes)
+        return cls(centroids, list_offsets, order, device, nprobe=nprobe, descriptors=descriptors, dtype=dtype)
+
+    def arrays(self):
+        arrays = {'centroids': self.centroids.cpu().numpy(), 'list_offsets': self.list_offsets, 'list_ids': self.list_ids.cpu().numpy()}
+        if self.pq is not None:
+            arrays.update({'codebooks': self.pq.codebooks.cpu().numpy(), 'codes': self.codes.cpu().numpy().astype(np.uint8 if self.pq.clusters <= 256 else np.int32)})
+        return arrays
+
+    def search(self, queries, k):
+        queries = queries.to(self.device, dtype=torch.float32)
+        nprobe = min(self.nprobe, self.centroids.shape[0])
+        probes = torch.topk(queries @ self.centroids.T, nprobe, dim=1).indices.cpu().numpy()
+        tables = self.pq.lookup_tables(queries) if self.pq is not None else None
+
+        all_scores, all_indices = [], []
+        for row, cells in enumerate(probes):
+            candidates = torch.cat([self.list_ids[self.list_offsets[cell]:self.list_offsets[cell + 1]] for cell in cells])
+            if self.pq is not None:
+                scores = self.pq.scores(tables[row:row + 1], self.codes[candidates])
+            else:
+                scores = self.descriptors.similarity(queries[row:row + 1], rows=candidates)
+            top_scores, top_indices = _pad_topk(scores, candidates.unsqueeze(0), k)
+            all_scores.append(top_scores)
+            all_indices.append(top_indices)
+        return torch.cat(all_scores), torch.cat(all_indices)
+
+def build_index(descriptors, index_type='flat', device='cpu', **kwargs):
+    """
+    Build an index of the given type over descriptors [N x D].
+    """
+    if index_type == 'flat':
+        return FlatIndex.build(descriptors, device, **kwargs)
+    if index_type == 'pq':
+        return PQIndex.build(descriptors, device, **kwargs)
+    if index_type == 'ivf':
+        return IVFIndex.build(descriptors, device, pq=False, **kwargs)
+    if index_type == 'ivfpq':
+        return IVFIndex.build(descriptors, device, pq=True, **kwargs)
+    raise ValueError(f"Unknown retrieval index type {index_type}, expected one of {INDEX_TYPES}")
+
+def save_index(index, path):
+    meta = {'type': index.index_type, 'size': len(index), 'dim': index.dim, 'nprobe': getattr(index, 'nprobe', None)}
+    np.savez(path, meta=np.array(json.dumps(meta)), **index.arrays())
+
+def load_index(path, descriptors, device, nprobe=None, dtype='float32'):
+    """
+    Load an index written by save_index. Exact variants score against descriptors, the global descriptors of the place
+    (after projection, if any), stored in dtype.
+    """
+    with np.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        arrays = {key: data[key] for key in data.files if key != 'meta'}
+
+    if meta['size'] != len(descriptors):
+        raise ValueError(f"Retrieval index {path} covers {meta['size']} descriptors but the place has {len(descriptors)}, rebuild it")
+    if meta.get('dim') != descriptors.shape[1]:
+        raise ValueError(f"Retrieval index {path} was built on {meta.get('dim')}-dim descriptors but they have {descriptors.shape[1]} dims, rebuild it with the current projection")
+
+    index_type = meta['type']
+    if index_type == 'flat':
+        return FlatIndex(descriptors, device, dtype)
+    if index_type == 'pq':
+        return PQIndex(arrays['codebooks'], arrays['codes'], device)
+    nprobe = nprobe or meta.get('nprobe') or 8
+    if index_type == 'ivf':
+        return IVFIndex(arrays['centroids'], arrays['list_offsets'], arrays['list_ids'], device, nprobe=nprobe, descriptors=descriptors, dtype=dtype)
+    if index_type == 'ivfpq':
+        return IVFIndex(arrays['centroids'], arrays['list_offsets'], arrays['list_ids'], device, nprobe=nprobe, codebooks=arrays['codebooks'], codes=arrays['codes'])
+    raise ValueError(f"Unknown retrieval index type {index_type} in {path}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Build a retrieval index over the global_features.h5 of a place.')
+    parser.add_argument('place_directory', help='e.g. /mnt/data/UNav-IO/data/New_York_City')
+    parser.add_argument('--type', default='ivfpq', choices=INDEX_TYPES)
+    parser.add_argument('--nlist', type=int, default=256, help='number of inverted lists (ivf, ivfpq)')
+    parser.add_argument('--nprobe', type=int, default=8, help='default number of lists scanned per query (ivf, ivfpq)')
+    parser.add_argument('--m', type=int, default=64, help='number of pq sub-vectors (pq, ivfpq)')
+    parser.add_argument('--nbits', type=int, default=8, help='bits per pq code (pq, ivfpq)')
+    parser.add_argument('--projection', help='descriptor projection .npz the server applies (feature.global.<extractor>.projection)')
+    args = parser.parse_args()
+
+    with h5py.File(join(args.place_directory, 'global_features.h5'), 'r') as f:
+        descriptors = f['descriptors'][:].astype(np.float32)
+    if args.projection:
+        descriptors = DescriptorProjection.load(args.projection, 'cpu')(descriptors).numpy()
+
+    index = build_index(descriptors, args.type, nlist=args.nlist, nprobe=args.nprobe, m=args.m, nbits=args.nbits)
+    path = index_path(args.place_directory, args.type)
+    save_index(index, path)
+    print(f"Built {args.type} index over {len(descriptors)} descriptors: {path}")
+
+if __name__ == '__main__':
+    main()
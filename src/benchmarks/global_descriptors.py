@@ -0,0 +1,68 @@
+"""
+Recall impact, memory and latency of compact global descriptors.
+
+Fits PCA-whitening projections of several sizes on the database descriptors
+and stores the projected database as float32, float16 and int8, comparing the
+top-k of each variant with the top-k of the raw float32 descriptors that
+coarse_vpr and Hloc.global_retrieval used before.
+
+Usage (from src/):
+    python -m benchmarks.global_descriptors --features /mnt/data/UNav-IO/data/New_York_City/global_features.h5
+    python -m benchmarks.global_descriptors --database 10000 --dim 32768 --dims 512 1024 4096
+"""
+import argparse
+from time import perf_counter
+
+import h5py
+import numpy as np
+import torch
+
+from UNav_core.src.feature.descriptor_projection import DESCRIPTOR_DTYPES, DescriptorProjection, StoredDescriptors
+from benchmarks.retrieval_index import synthetic_database, make_queries, synchronize
+
+def topk(stored, queries, k, device):
+    synchronize(device)
+    start = perf_counter()
+    indices = torch.topk(stored.similarity(queries), min(k, len(stored)), dim=1).indices.cpu().numpy()
+    synchronize(device)
+    return indices, (perf_counter() - start) / len(queries)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', help='global_features.h5 of a place, synthetic data if omitted')
+    parser.add_argument('--database', type=int, default=10000)
+    parser.add_argument('--dim', type=int, default=32768)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--noise', type=float, default=0.3)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--dims', type=int, nargs='+', default=[256, 512, 1024, 4096])
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    if args.features:
+        with h5py.File(args.features, 'r') as f:
+            descriptors = f['descriptors'][:].astype(np.float32)
+    else:
+        descriptors = synthetic_database(args.database, args.dim, args.clusters)
+    queries = torch.from_numpy(make_queries(descriptors, args.queries, args.noise))
+
+    raw = StoredDescriptors(descriptors, 'float32', args.device)
+    ground_truth, raw_latency = topk(raw, queries, args.k, args.device)
+
+    print(f"{len(descriptors)} descriptors x {descriptors.shape[1]} dims, {args.queries} queries, k={args.k}, {args.device}")
+    print(f"{'variant':<18}{'recall@k':>10}{'MB':>10}{'ms/query':>10}")
+    print(f"{'raw/float32':<18}{1.0:>10.3f}{raw.nbytes / 2**20:>10.1f}{raw_latency * 1000:>10.2f}")
+
+    for dim in args.dims:
+        projection = DescriptorProjection(*DescriptorProjection.fit(descriptors, dim), args.device)
+        projected = projection(descriptors)
+        projected_queries = projection(queries)
+        for dtype in DESCRIPTOR_DTYPES:
+            stored = StoredDescriptors(projected, dtype, args.device)
+            results, latency = topk(stored, projected_queries, args.k, args.device)
+            recall = np.mean([len(np.intersect1d(result, truth)) / len(truth) for result, truth in zip(results, ground_truth)])
+            print(f"{f'pca{projection.dim}/{dtype}':<18}{recall:>10.3f}{stored.nbytes / 2**20:>10.1f}{latency * 1000:>10.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Load time and resident memory of one segment map in the .h5 and packed layouts.
+
+Each configuration runs in a fresh process so RSS deltas do not leak between runs.
+Convert the segment first with `python -m utils.packed_map <place_directory>`.
+
+Usage (from src/):
+    python -m benchmarks.map_loading /mnt/data/UNav-IO/data/New_York_City/LightHouse/6_floor/maps/Segment_00021.h5
+"""
+import argparse
+import multiprocessing
+from os.path import basename, dirname, exists
+from time import perf_counter
+
+import numpy as np
+
+def rss_mb():
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return float('nan')
+
+def run(layout, lazy, segment_file, frames_to_read, queue):
+    from utils.data_handler import load_h5_map
+    from utils.packed_map import load_packed_map, PACKED_SUFFIX
+
+    segment_id = 'Building_0_floor_' + basename(segment_file)[:-len('.h5')]
+    rss_before = rss_mb()
+    start = perf_counter()
+    if layout == 'packed':
+        map_data = load_packed_map(segment_file[:-len('.h5')] + PACKED_SUFFIX, segment_id, 'Building', '0_floor', lazy=lazy)
+    else:
+        map_data = load_h5_map(segment_file, segment_id, 'Building', '0_floor', lazy=lazy)
+    load_time = perf_counter() - start
+
+    # Lazy layouts pay for local features when frames are matched, time a typical retrieval's worth
+    read_time = 0.0
+    if lazy:
+        groups = [frame['group'] for frame in map_data['perspective_frames'].values()]
+        selected = np.random.default_rng(0).choice(len(groups), min(frames_to_read, len(groups)), replace=False)
+        start = perf_counter()
+        frames = [map_data['reader'].read_frame(groups[index]) for index in selected]
+        read_time = perf_counter() - start
+
+    queue.put((load_time, read_time, rss_mb() - rss_before, len(map_data['perspective_frames'])))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('segment_file', help='path of a Segment_XXXXX.h5 file')
+    parser.add_argument('--frames_to_read', type=int, default=100, help='frames materialized in lazy mode')
+    args = parser.parse_args()
+
+    layouts = ['h5']
+    if exists(args.segment_file[:-len('.h5')] + '.packed'):
+        layouts.append('packed')
+    else:
+        print(f"No packed copy next to {args.segment_file}, run utils.packed_map on {dirname(dirname(dirname(dirname(args.segment_file))))}")
+
+    context = multiprocessing.get_context('spawn')
+    print(f"{'layout':<8}{'mode':<7}{'frames':>8}{'load ms':>11}{'read ms':>11}{'RSS MB':>10}")
+    for layout in layouts:
+        for lazy in (False, True):
+            queue = context.Queue()
+            process = context.Process(target=run, args=(layout, lazy, args.segment_file, args.frames_to_read, queue))
+            process.start()
+            load_time, read_time, rss, frame_num = queue.get()
+            process.join()
+            print(f"{layout:<8}{'lazy' if lazy else 'eager':<7}{frame_num:>8}{load_time * 1000:>11.1f}{read_time * 1000:>11.1f}{rss:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the match-to-landmark filtering in Local_matcher.lightglue_batch.
+
+Compares the former per-keypoint Python loop over a valid_landmarks dict against
+the vectorized filter_matches_to_landmarks on synthetic matches.
+
+Usage (from src/):
+    python -m benchmarks.match_filter --keypoints 4096 --frames 100 --batch 15
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+import torch
+
+from UNav_core.src.feature.local_matcher import filter_matches_to_landmarks
+
+def make_batch(batch, keypoints, landmark_ratio, match_ratio, device):
+    keypoints0 = torch.rand((keypoints, 2), device=device) * 640
+    keypoints1 = torch.rand((batch, keypoints, 2), device=device) * 640
+    matches = torch.randint(0, keypoints, (batch, keypoints), device=device)
+    matches[torch.rand((batch, keypoints), device=device) > match_ratio] = -1
+
+    valid_keypoints_index = [np.sort(np.random.choice(keypoints, int(keypoints * landmark_ratio), replace=False)) for _ in range(batch)]
+    landmarks_list = [np.random.rand(len(index), 3) for index in valid_keypoints_index]
+
+    landmarks = torch.zeros((batch, keypoints, 3), dtype=torch.float64, device=device)
+    valid = torch.zeros((batch, keypoints), dtype=torch.bool, device=device)
+    for ind, (index, lms) in enumerate(zip(valid_keypoints_index, landmarks_list)):
+        landmarks[ind, index] = torch.from_numpy(lms).to(device)
+        valid[ind, index] = True
+    return matches, keypoints0, keypoints1, landmarks, valid, valid_keypoints_index, landmarks_list
+
+def loop_filter(matches, keypoints0, keypoints1, valid_keypoints_index, landmarks_list):
+    """The per-keypoint path lightglue_batch used before vectorization."""
+    matches = matches.detach().cpu().short().numpy()
+    feat0 = keypoints0.detach().cpu().numpy()
+    results = []
+    for ind, match in enumerate(matches):
+        feat1 = keypoints1[ind].detach().cpu().numpy()
+        valid_landmarks = {valid_id: landmark for valid_id, landmark in zip(valid_keypoints_index[ind], landmarks_list[ind])}
+        pts0, pts1, lms = [], [], []
+        for n, m in enumerate(match):
+            if m != -1 and m in valid_landmarks:
+                pts0.append(feat0[n])
+                pts1.append(feat1[m])
+                lms.append(valid_landmarks[m])
+        results.append((np.array(pts0), np.array(pts1), np.array(lms)))
+    return results
+
+def synchronize(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keypoints', type=int, default=4096)
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--batch', type=int, default=15)
+    parser.add_argument('--landmark_ratio', type=float, default=0.4)
+    parser.add_argument('--match_ratio', type=float, default=0.3)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    batches = [min(args.batch, args.frames - i) for i in range(0, args.frames, args.batch)]
+    data = [make_batch(batch, args.keypoints, args.landmark_ratio, args.match_ratio, args.device) for batch in batches]
+
+    synchronize(args.device)
+    start = perf_counter()
+    loop_results = [loop_filter(matches, kp0, kp1, index, lms) for matches, kp0, kp1, _, _, index, lms in data]
+    loop_time = perf_counter() - start
+
+    synchronize(args.device)
+    start = perf_counter()
+    vector_results = [filter_matches_to_landmarks(matches, kp0, kp1, landmarks, valid) for matches, kp0, kp1, landmarks, valid, _, _ in data]
+    synchronize(args.device)
+    vector_time = perf_counter() - start
+
+    # Both paths have to produce the same correspondences
+    for loop_batch, (pts0, pts1, lms) in zip(loop_results, vector_results):
+        for ind, (loop_pts0, loop_pts1, loop_lms) in enumerate(loop_batch):
+            assert len(loop_pts0) == len(pts0[ind])
+            if len(loop_pts0) > 0:
+                assert np.allclose(loop_pts0, pts0[ind]) and np.allclose(loop_pts1, pts1[ind]) and np.allclose(loop_lms, lms[ind])
+
+    print(f"{args.frames} frames x {args.keypoints} keypoints on {args.device}")
+    print(f"python loop : {loop_time * 1000:.1f} ms")
+    print(f"vectorized  : {vector_time * 1000:.1f} ms")
+    print(f"speedup     : {loop_time / vector_time:.1f}x")
+
+if __name__ == '__main__':
+    main()
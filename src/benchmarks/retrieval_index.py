@@ -0,0 +1,88 @@
+"""
+Recall@k vs latency of the coarse VPR retrieval indexes.
+
+Builds every index type over the place descriptors (or a synthetic clustered
+database) and compares its top-k against the exact einsum + topk that
+Coarse_Locator.coarse_vpr used, with queries made of perturbed database
+descriptors.
+
+Usage (from src/):
+    python -m benchmarks.retrieval_index --features /mnt/data/UNav-IO/data/New_York_City/global_features.h5
+    python -m benchmarks.retrieval_index --database 20000 --dim 4096
+"""
+import argparse
+from time import perf_counter
+
+import h5py
+import numpy as np
+import torch
+
+from UNav_core.src.track.retrieval_index import INDEX_TYPES, build_index
+
+def synthetic_database(size, dim, clusters):
+    centers = np.random.randn(clusters, dim).astype(np.float32)
+    descriptors = centers[np.random.randint(clusters, size=size)] + 0.5 * np.random.randn(size, dim).astype(np.float32)
+    return descriptors / np.linalg.norm(descriptors, axis=1, keepdims=True)
+
+def make_queries(descriptors, queries, noise):
+    rows = np.random.choice(len(descriptors), queries, replace=False)
+    perturbed = descriptors[rows] + noise * np.random.randn(queries, descriptors.shape[1]).astype(np.float32) / np.sqrt(descriptors.shape[1])
+    return perturbed / np.linalg.norm(perturbed, axis=1, keepdims=True)
+
+def synchronize(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+def timed_search(search, queries, k, device):
+    results = []
+    synchronize(device)
+    start = perf_counter()
+    for query in queries:
+        results.append(search(query[None], k)[1].cpu().numpy()[0])
+    synchronize(device)
+    return np.stack(results), (perf_counter() - start) / len(queries)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--features', help='global_features.h5 of a place, synthetic data if omitted')
+    parser.add_argument('--database', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=4096)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--noise', type=float, default=0.3)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--nlist', type=int, default=256)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--m', type=int, default=64)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    if args.features:
+        with h5py.File(args.features, 'r') as f:
+            descriptors = f['descriptors'][:].astype(np.float32)
+    else:
+        descriptors = synthetic_database(args.database, args.dim, args.clusters)
+    queries = torch.from_numpy(make_queries(descriptors, args.queries, args.noise))
+
+    exact = build_index(descriptors, 'flat', args.device)
+    ground_truth, exact_latency = timed_search(exact.search, queries, args.k, args.device)
+
+    print(f"{len(descriptors)} descriptors x {descriptors.shape[1]} dims, {args.queries} queries, k={args.k}, {args.device}")
+    print(f"{'index':<14}{'recall@k':>10}{'ms/query':>10}{'build s':>10}")
+    print(f"{'flat':<14}{1.0:>10.3f}{exact_latency * 1000:>10.2f}{0.0:>10.1f}")
+
+    for index_type in INDEX_TYPES[1:]:
+        start = perf_counter()
+        index = build_index(descriptors, index_type, args.device, nlist=args.nlist, m=args.m)
+        build_time = perf_counter() - start
+
+        for nprobe in (args.nprobe if index_type.startswith('ivf') else [None]):
+            if nprobe is not None:
+                index.nprobe = nprobe
+            results, latency = timed_search(index.search, queries, args.k, args.device)
+            recall = np.mean([len(np.intersect1d(result[result >= 0], truth)) / args.k for result, truth in zip(results, ground_truth)])
+            name = index_type if nprobe is None else f'{index_type}/{nprobe}'
+            print(f"{name:<14}{recall:>10.3f}{latency * 1000:>10.2f}{build_time:>10.1f}")
+
+if __name__ == '__main__':
+    main()
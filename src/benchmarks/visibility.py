@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the pose-to-anchor visibility test used by Trajectory.calculate_path.
+
+Compares the former per-anchor Trajectory._distance loop over every boundary line
+against BoundaryIndex.visible_distances on a synthetic floor of random wall pieces.
+
+Usage (from src/):
+    python -m benchmarks.visibility --boundaries 5000 --anchors 500 --queries 20
+"""
+import argparse
+from time import perf_counter
+
+import numpy as np
+
+from UNav_core.src.navigation.trajectory import Trajectory
+from UNav_core.src.navigation.visibility import BoundaryIndex
+
+def make_floor(boundaries, anchors, size, wall_length):
+    starts = np.random.rand(boundaries, 2) * size
+    angles = np.random.rand(boundaries) * 2 * np.pi
+    lengths = np.random.rand(boundaries) * wall_length
+    ends = starts + np.stack([np.cos(angles), np.sin(angles)], axis=1) * lengths[:, None]
+    lines = np.concatenate([starts, ends], axis=1).tolist()
+    anchor_location = (np.random.rand(anchors, 2) * size).tolist()
+    return lines, anchor_location
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--boundaries', type=int, default=5000)
+    parser.add_argument('--anchors', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--size', type=float, default=3000)
+    parser.add_argument('--wall_length', type=float, default=60)
+    args = parser.parse_args()
+
+    lines, anchor_location = make_floor(args.boundaries, args.anchors, args.size, args.wall_length)
+    poses = (np.random.rand(args.queries, 2) * args.size).tolist()
+
+    # Only the visibility helpers of Trajectory are needed, skip the graph precomputation
+    trajectory = Trajectory.__new__(Trajectory)
+
+    start = perf_counter()
+    loop_results = [[trajectory._distance(pose, loc, lines) for loc in anchor_location] for pose in poses]
+    loop_time = perf_counter() - start
+
+    start = perf_counter()
+    index = BoundaryIndex(lines)
+    build_time = perf_counter() - start
+
+    anchor_array = np.asarray(anchor_location)
+    start = perf_counter()
+    index_results = [index.visible_distances(pose, anchor_array) for pose in poses]
+    index_time = perf_counter() - start
+
+    # Both paths have to agree on which anchors are visible and how far they are
+    for loop_distances, index_distances in zip(loop_results, index_results):
+        assert np.allclose(np.asarray(loop_distances, dtype=np.float64), index_distances)
+
+    print(f"{args.queries} poses x {args.anchors} anchors, {args.boundaries} boundary lines, grid {index.shape} of {index.cell_size:.1f}")
+    print(f"python loop : {loop_time * 1000 / args.queries:.1f} ms per pose")
+    print(f"grid index  : {index_time * 1000 / args.queries:.1f} ms per pose (built once in {build_time * 1000:.1f} ms)")
+    print(f"speedup     : {loop_time / index_time:.1f}x")
+
+if __name__ == '__main__':
+    main()
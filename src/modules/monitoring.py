@@ -0,0 +1,7 @@
+# Socket.IO clients watching camera previews: flask sid -> session id watched, None for all sessions.
+# Frame previews are only encoded and broadcast while someone is watching.
+MONITOR_ROOM = 'monitors'
+monitors = {}
+
+def has_monitor(session_id):
+    return any(watched is None or watched == session_id for watched in list(monitors.values()))
@@ -1,14 +1,15 @@
 from flask import request, jsonify, send_file
-from PIL import Image
 import io
-import base64
 import os
 import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import cv2
-import numpy as np
 from utils.time_logger import TimeLogger
 
 from utils.cache_manager import CacheManager
+from utils.localization_scheduler import FRAME_DROPPED
+from utils.image_utils import ingest_frame, decode_base64
+from modules.monitoring import MONITOR_ROOM, has_monitor
 
 # This dictionary is used to store frames associated with client sessions
 client_frames = {}
@@ -31,61 +32,53 @@ def register_frame_routes(app, server, socketio):
         do_localize = data.get('do_localize', False)
 
         if frame_base64 and session_id:
-            frame_data = base64.b64decode(frame_base64.split(',')[1]) if ',' in frame_base64 else base64.b64decode(frame_base64)
-            frame = Image.open(io.BytesIO(frame_data))
+            # Decode, resize and (only if someone is watching) re-encode the preview in one pass
+            image_np, preview_base64 = ingest_frame(decode_base64(frame_base64), preview=has_monitor(session_id))
 
-            # Convert to RGB format
-            r, g, b = frame.split()
-            frame = Image.merge("RGB", (b, g, r))
-
-            original_width, original_height = frame.size
-
-            new_width = 640
-            new_height = int((new_width / original_width) * original_height)
-
-            # Resize the image
-            resized_image = frame.resize((new_width, new_height))
-
-            image_np = np.array(resized_image)
-
-            original_width, original_height = frame.size
-
-            new_width = 640
-            new_height = int((new_width / original_width) * original_height)
-
-            # Resize the image
-            resized_image = frame.resize((new_width, new_height))
-
-            image_np = np.array(resized_image)
-            
-            if frame is not None:
-                client_frames[session_id] = image_np
+            if image_np is not None:
                 client_frames[session_id] = image_np
                 response_data = {'status': 'frame received'}
+                pose_update_info = {}
+
+                if preview_base64 is not None:
+                    socketio.emit('camera_frame', {'session_id': session_id, 'frame': preview_base64}, to=MONITOR_ROOM)
 
                 # Perform localization if requested
                 if do_localize:
                     localization_start_time = time.time()
-                    pose_update_info = server.handle_localization(session_id, image_np)
-                    # Extract building and floor from pose_update_info, defaulting to 'N/A' if None
-                    building = pose_update_info.get('building')
-                    floor = pose_update_info.get('floor')
-                    time_logger.log_localization_time(session_id, building, floor, localization_start_time, pose_update_info)
+                    try:
+                        pose_update_info = server.localization_scheduler.localize(session_id, image_np)
+                    except RuntimeError as e:
+                        return jsonify({'error': str(e)}), 503
+                    except FutureTimeoutError:
+                        return jsonify({'error': 'Localization timed out'}), 504
+                    if pose_update_info is FRAME_DROPPED:
+                        # A newer frame of this session arrived while this one was waiting
+                        response_data['status'] = 'frame dropped'
+                        pose_update_info = {}
+                    else:
+                        # Extract building and floor from pose_update_info, defaulting to 'N/A' if None
+                        building = pose_update_info.get('building')
+                        floor = pose_update_info.get('floor')
+                        time_logger.log_localization_time(session_id, building, floor, localization_start_time, pose_update_info)
+
+                        response_data['pose'] = pose_update_info.get('pose')
+                    response_data['frame_stats'] = server.localization_scheduler.session_stats(session_id)
 
-                    response_data['pose'] = pose_update_info.get('pose')
-
-                buffered = io.BytesIO()
-                resized_image.save(buffered, format="JPEG")
-                resized_image.save(buffered, format="JPEG")
-                new_frame_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
                 response_data['floorplan_base64'] = pose_update_info.get('floorplan_base64')
-                socketio.emit('camera_frame', {'session_id': session_id, 'frame': new_frame_base64})
                 return jsonify(response_data), 200
             else:
                 return jsonify({'error': 'Failed to process frame'}), 500
         else:
             return jsonify({'error': 'No frame provided or session_id missing'}), 400
 
+    @app.route('/frame_stats/<session_id>', methods=['GET'])
+    def frame_stats(session_id):
+        """
+        Number of processed and dropped frames of a session.
+        """
+        return jsonify(server.localization_scheduler.session_stats(session_id))
+
     @app.route('/list_clients', methods=['GET'])
     def list_clients():
         """
@@ -100,15 +93,13 @@ def register_frame_routes(app, server, socketio):
         """
         frame = client_frames.get(client_id)
         if frame is not None:
-            buffered = io.BytesIO()
-            frame.save(buffered, format="JPEG")
-            buffered.seek(0)
-            return send_file(buffered, mimetype='image/jpeg')
+            success, buffer = cv2.imencode('.jpg', frame)
+            if not success:
+                return jsonify({'error': 'Failed to encode frame'}), 500
+            return send_file(io.BytesIO(buffer.tobytes()), mimetype='image/jpeg')
         else:
             return jsonify({'error': 'No frame available for this client'}), 404
 
-    @app.route('/get_image/<id>/<imageName>', methods=['POST'])
-    def get_image(id, imageName):
     @app.route('/get_image/<id>/<imageName>', methods=['POST'])
     def get_image(id, imageName):
         """
@@ -117,10 +108,6 @@ def register_frame_routes(app, server, socketio):
         data = request.json
         session_id = data.get('username')
     
-        image_path = os.path.join(server.root, 'logs', server.config['location']['place'], server.config['location']['building'], server.config['location']['floor'], id, 'images', imageName)
-        data = request.json
-        session_id = data.get('username')
-    
         image_path = os.path.join(server.root, 'logs', server.config['location']['place'], server.config['location']['building'], server.config['location']['floor'], id, 'images', imageName)
         if os.path.exists(image_path):
             return send_file(image_path, mimetype='image/png')
@@ -1,9 +1,13 @@
-from flask_socketio import emit
+from flask_socketio import emit, join_room, leave_room
 from flask import request
 from datetime import datetime
 import logging
 import json
 
+from utils.image_utils import ingest_frame
+from modules.monitoring import MONITOR_ROOM, monitors, has_monitor
+from utils.localization_scheduler import FRAME_DROPPED
+
 # Set up SocketIO handlers with selective logging
 def setup_socketio_handlers(socketio, server, client_frames):
     client_sessions = {}
@@ -21,12 +25,81 @@ def setup_socketio_handlers(socketio, server, client_frames):
             'connected_at': datetime.now(),
             'flask_sid': request.sid  # Optionally map the Flask sid to the custom session ID
         }
+        # Localization results of the session are emitted to its room
+        join_room(custom_session_id)
         print(f"Client registered with custom session ID: {custom_session_id}")
         logging.getLogger().info(f"Client registered with custom session ID: {custom_session_id}")
 
+    @socketio.on('join_room')
+    def handle_join_room(data):
+        session_id = data.get('session_id') if isinstance(data, dict) else None
+        if session_id:
+            join_room(session_id)
+
+    @socketio.on('start_monitoring')
+    def handle_start_monitoring(data=None):
+        """
+        Subscribe to camera previews, of one session if data carries a session_id, else of all sessions.
+        """
+        session_id = data.get('session_id') if isinstance(data, dict) else None
+        monitors[request.sid] = session_id
+        join_room(MONITOR_ROOM)
+
+    @socketio.on('stop_monitoring')
+    def handle_stop_monitoring(data=None):
+        monitors.pop(request.sid, None)
+        leave_room(MONITOR_ROOM)
+
+    @socketio.on('frame')
+    def handle_frame(data):
+        """
+        Receive a binary JPEG frame and queue it for localization without waiting for the result.
+        Expects {'session_id': ..., 'frame': <bytes>}; the result is emitted as 'pose_update' to the session's room.
+        """
+        session_id = data.get('session_id') if isinstance(data, dict) else None
+        frame_bytes = data.get('frame') if isinstance(data, dict) else None
+        if not session_id or not frame_bytes:
+            return {'error': 'No frame provided or session_id missing'}
+
+        image_np, preview_base64 = ingest_frame(frame_bytes, preview=has_monitor(session_id))
+        if image_np is None:
+            return {'error': 'Failed to decode frame'}
+        client_frames[session_id] = image_np
+        if preview_base64 is not None:
+            socketio.emit('camera_frame', {'session_id': session_id, 'frame': preview_base64}, to=MONITOR_ROOM)
+
+        try:
+            future = server.localization_scheduler.submit(session_id, image_np)
+        except RuntimeError as e:
+            return {'error': str(e)}
+        future.add_done_callback(lambda future: emit_pose_update(session_id, future))
+        return {'status': 'frame queued'}
+
+    def emit_pose_update(session_id, future):
+        # Runs on the scheduler thread, outside of any request context
+        try:
+            pose_update_info = future.result()
+        except Exception as e:
+            socketio.emit('pose_update', {'session_id': session_id, 'error': str(e)}, to=session_id)
+            return
+
+        if pose_update_info is FRAME_DROPPED:
+            # Superseded by a newer frame of the same session, which will be answered instead
+            return
+
+        socketio.emit('pose_update', {
+            'session_id': session_id,
+            'pose': pose_update_info.get('pose'),
+            'building': pose_update_info.get('building'),
+            'floor': pose_update_info.get('floor'),
+            'floorplan_base64': pose_update_info.get('floorplan_base64'),
+            'frame_stats': server.localization_scheduler.session_stats(session_id),
+        }, to=session_id)
+
     @socketio.on('disconnect')
     def handle_disconnect():
         flask_sid = request.sid
+        monitors.pop(flask_sid, None)
 
         # Find the custom session ID based on Flask's sid
         custom_session_id = None
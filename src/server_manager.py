@@ -1,6 +1,6 @@
 import os
 import json
-from utils import DataHandler, CacheManager
+from utils import DataHandler, CacheManager, LocalizationScheduler
 
 import time
 
@@ -15,6 +15,7 @@ import base64
 import cv2
 from PIL import Image
 import numpy as np
+import torch
 
 COARSE_LOCALIZE_THRESHOLD = 5  # Example threshold for coarse localization failures
 TIMEOUT_SECONDS = 600  # Example timeout for coarse localization in seconds
@@ -35,12 +36,21 @@ class Server(DataHandler):
             
         self.coarse_locator = Coarse_Locator(config=self.config)
         self.refine_locator = localization(self.coarse_locator, config=self.config, logger=self.logger)
+        self.refine_locator.warmup()
         
-        self.trajectory_maker = Trajectory(self.all_buildings_data, self.all_interwaypoint_connections)
+        precomputed_trajectory = self.navigation_cache.get('trajectory')
+        self.trajectory_maker = Trajectory(self.all_buildings_data, self.all_interwaypoint_connections, precomputed=precomputed_trajectory)
+        if not self.trajectory_maker.loaded_precomputed:
+            self.navigation_cache.set('trajectory', self.trajectory_maker.precomputed_state())
         
-        self.cache_manager = CacheManager()
+        self.cache_manager = CacheManager(lazy_maps=config['hloc'].get('lazy_maps', False), hot_frames=config['hloc'].get('hot_frames', 512), store_descriptors=self.coarse_locator.store_database_descriptors)
+        # Segments of each floor, for load_all_maps
+        self.floor_clusters = {}
         self.localization_states = {}
         self.destination_states = {}
+
+        scheduler_config = config['hloc'].get('scheduler', {})
+        self.localization_scheduler = LocalizationScheduler(self, max_batch_size=scheduler_config.get('max_batch_size', 8), max_wait_ms=scheduler_config.get('max_wait_ms', 20), result_timeout_s=scheduler_config.get('result_timeout_s', 30))
             
             
         with open(os.path.join(self.root, 'data', 'scale.json'), 'r') as f:
@@ -92,6 +102,14 @@ class Server(DataHandler):
     def terminate(self, session_id):
         self.logger.info(f"Terminating session of {session_id}...")
         
+        # Drop the pending frame first, a batch already being localized may still match this session
+        # against its map view, so the segments and session state are released on the worker after it
+        self.localization_scheduler.release_session(session_id)
+        self.localization_scheduler.call_in_worker(lambda: self._release_session(session_id)).result(timeout=self.localization_scheduler.result_timeout)
+            
+        self.logger.info(f"Session of {session_id} terminated successfully.")
+
+    def _release_session(self, session_id):
         segment_id = self.localization_states.get(session_id, {}).get('segment_id', None)
         
         if segment_id:
@@ -107,10 +125,35 @@ class Server(DataHandler):
             if session_id in self.trajectory_maker.sessions:
                 del self.trajectory_maker.sessions[session_id]
             
-        self.logger.info(f"Session of {session_id} terminated successfully.")
+        self.refine_locator.release_session(session_id)
 
-    def coarse_localize(self, query_image):
-        _, SEGMENTID, success = self.coarse_locator.coarse_vpr(query_image)
+    def _floor_cluster(self, building, floor):
+        """
+        Every segment of a floor, computed once per floor since the connection graph never changes.
+        """
+        key = building + '_' + floor
+        cluster = self.floor_clusters.get(key)
+        if cluster is None:
+            cluster = [segment_id for segment_id in self.coarse_locator.connection_graph if segment_id.startswith(key)]
+            self.floor_clusters[key] = cluster
+        return cluster
+
+    def _needs_coarse_localization(self, state):
+        """
+        Whether handle_localization runs coarse VPR for a session in this state.
+        """
+        if self.load_all_maps:
+            return False
+        if state is None:
+            return True
+        return state['failures'] >= COARSE_LOCALIZE_THRESHOLD or time.time() - state['last_success_time'] > TIMEOUT_SECONDS or not state['segment_id']
+
+    def coarse_localize(self, query_image, features=None):
+        if features is None:
+            features = self.refine_locator.frame_features(query_image)
+        if features.coarse is None:
+            features.coarse = self.coarse_locator.coarse_vpr(query_image, query_desc=features.global_descriptor)
+        _, SEGMENTID, success = features.coarse
         if success:
             return SEGMENTID
         else:
@@ -178,11 +221,39 @@ class Server(DataHandler):
         pass
 
 
-    def handle_localization(self, session_id, frame):
+    def handle_localization_batch(self, session_ids, frames):
+        """
+        Localizes a batch of frames, possibly from different sessions.
+        Features are extracted for the whole batch at once, matching and pose estimation run per frame.
+        Returns one pose_update_info per frame, or the exception raised while localizing it.
+        """
+        features = self.refine_locator.extract_features(frames)
+
+        # Coarse VPR of every frame that needs it in one retrieval index search
+        coarse_rows = [index for index, session_id in enumerate(session_ids) if self._needs_coarse_localization(self.localization_states.get(session_id))]
+        if len(coarse_rows) > 0:
+            query_descs = torch.cat([features[index].global_descriptor for index in coarse_rows])
+            for index, coarse in zip(coarse_rows, self.coarse_locator.coarse_vpr_batch(query_descs)):
+                features[index].coarse = coarse
+
+        results = []
+        for session_id, frame, frame_features in zip(session_ids, frames, features):
+            try:
+                results.append(self.handle_localization(session_id, frame, features=frame_features))
+            except Exception as e:
+                self.logger.error(f"Localization failed for session {session_id}: {e}")
+                results.append(e)
+        return results
+
+    def handle_localization(self, session_id, frame, features=None):
         """
         Handles the localization process for a given session and frame.
         Returns the pose and segment_id if localization is successful.
+        :param features: FrameFeatures of the frame from Hloc.extract_features, when it was extracted as part of a batch.
         """
+        if features is None:
+            # One feature context per frame, shared by coarse VPR and refinement so no extractor runs twice
+            features = self.refine_locator.frame_features(frame)
         state = self.localization_states.get(session_id, {'failures': 0, 'last_success_time': time.time(), 'building': None, 'floor': None, 'segment_id': None, 'pose': None})
         pose_update_info = {
             'building': None,
@@ -195,12 +266,10 @@ class Server(DataHandler):
             building = self.config["location"]["building"]
             floor = self.config["location"]["floor"]
             
-            if not state['building'] and not state['floor']:
-                current_cluster = [key for key in self.coarse_locator.connection_graph if key.startswith(building + '_' + floor)]
-                map_data = self.cache_manager.load_segments(self, session_id, current_cluster)
-                self.refine_locator.update_maps(map_data)
+            current_cluster = self._floor_cluster(building, floor)
+            map_view = self.cache_manager.get_map_view(self, session_id, current_cluster)
             
-            pose, next_segment_id = self.refine_locator.get_location(frame)
+            pose, next_segment_id = self.refine_locator.get_location(session_id, map_view, frame, features=features)
             
             if pose:
                 pose_update_info['pose'] = pose
@@ -218,10 +287,9 @@ class Server(DataHandler):
                     pose_update_info['floorplan_base64'] = self.get_floorplan(building, floor).get('floorplan', None)
 
         else:
-            time_since_last_success = time.time() - state['last_success_time']
             previous_segment_id = state['segment_id']
-            if state['failures'] >= COARSE_LOCALIZE_THRESHOLD or time_since_last_success > TIMEOUT_SECONDS or not state['segment_id']:
-                segment_id = self.coarse_localize(frame) #debug
+            if self._needs_coarse_localization(state):
+                segment_id = self.coarse_localize(frame, features=features) #debug
                                 
                 if segment_id:
                     building, floor = self._split_id(segment_id)
@@ -231,11 +299,9 @@ class Server(DataHandler):
                     
                     current_cluster = [segment_id] + current_neighbors
                     
-                    map_data = self.cache_manager.load_segments(self, session_id, current_cluster)
-                    
-                    self.refine_locator.update_maps(map_data)
+                    map_view = self.cache_manager.get_map_view(self, session_id, current_cluster)
                     
-                    pose, next_segment_id = self.refine_locator.get_location(frame) #debug
+                    pose, next_segment_id = self.refine_locator.get_location(session_id, map_view, frame, features=features) #debug
                     
                     if pose:
                         pose_update_info['pose'] = pose
@@ -291,11 +357,9 @@ class Server(DataHandler):
                 current_neighbors = list(connection_data.get('adjacent_segment', set()))
                 current_cluster = [state['segment_id']] + current_neighbors
                 
-                map_data = self.cache_manager.load_segments(self, session_id, current_cluster)
-
-                self.refine_locator.update_maps(map_data)
+                map_view = self.cache_manager.get_map_view(self, session_id, current_cluster)
                 
-                pose, next_segment_id = self.refine_locator.get_location(frame) #debug
+                pose, next_segment_id = self.refine_locator.get_location(session_id, map_view, frame, features=features) #debug
                 
                 if pose:
 
@@ -344,7 +408,6 @@ class Server(DataHandler):
         pose = localization_state.get('pose')
         if pose:
             trajectory = self.trajectory_maker.calculate_path(self, session_id, localization_state)
-            # action_list = actions(trajectory)
             
             if len(trajectory) > 0:
                 return trajectory, None
@@ -13,6 +13,7 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     socket.emit('join_room', { session_id: sessionId });
+    socket.emit('start_monitoring', { session_id: sessionId });
 
     socket.on('planner_update', function(data) {
         drawFloorplan(data.floorplan, data.paths);
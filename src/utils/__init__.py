@@ -1,3 +1,5 @@
 from .data_handler import DataHandler
 from .logging_utils import configure_logging
-from .cache_manager import CacheManager
\ No newline at end of file
+from .cache_manager import CacheManager
+from .localization_scheduler import LocalizationScheduler, FRAME_DROPPED
+from .navigation_cache import NavigationCache
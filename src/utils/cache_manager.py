@@ -1,72 +1,87 @@
 from collections import defaultdict
+import threading
 import torch
 
+from UNav_core.src.track.map_view import MapView, SegmentTensors, LazySegmentTensors
+
+def building_floor(segment_id):
+    """
+    Building and floor part of a segment id, e.g. 'LightHouse_6_floor' for 'LightHouse_6_floor_Segment_00021'.
+    """
+    parts = segment_id.split('_')
+    return parts[0] + '_' + parts[1] + '_' + parts[2]
+
 class CacheManager:
-    def __init__(self):
+    def __init__(self, device=None, lazy_maps=False, hot_frames=512, store_descriptors=None):
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        # Brings the global descriptors of each cached segment into the query space, see Coarse_Locator.store_database_descriptors
+        self.store_descriptors = store_descriptors
+        # Lazy maps keep local features on disk until a frame is matched, see DataHandler.load_map
+        self.lazy_maps = lazy_maps
+        self.hot_frames = hot_frames
         # Cache to store loaded map segments
         self.shared_cache = {}
+        # Padded device tensors of each cached segment, packed once when the segment enters the cache
+        self.segment_tensors = {}
         # Dictionary to store the reference count for each segment
         self.reference_counts = defaultdict(int)
         # Dictionary to track loaded segments for each session
         self.session_segments = defaultdict(set)
+        # Read-only map views shared by all sessions, keyed by cluster composition
+        self.map_views = {}
+        self.lock = threading.RLock()
 
     def load_segments(self, server, session_id, segment_ids):
         """
         Load the segments into the cache if they are not already loaded.
         For each segment, increment its reference count.
-        Segments from the same building and floor are merged into one combined map data.
         Ensure each segment_id is only loaded once per session_id.
         """
         if not isinstance(segment_ids, list):
             segment_ids = [segment_ids]
 
-        combined_segments = {}
-
         for segment_id in segment_ids:
-            # Parse segment_id to get building and floor
-            parts = segment_id.split('_')
-            building = parts[0]  # Extract building name
-            floor = parts[1] + '_' + parts[2]  # Extract floor name (e.g., '6_floor')
-            building_floor = f"{building}_{floor}"  # Combine to get the unique identifier for building and floor
-
-            # If this building_floor is not yet in combined_segments, initialize its structure
-            if building_floor not in combined_segments:
-                combined_segments[building_floor] = {
-                    'T': None,
-                    'rot_base': None,
-                    'perspective_frames': {},  # Use the same structure as in load_data
-                }
-
             # Ensure we only load the segment if it's not already loaded for this session
-            if segment_id not in self.session_segments[session_id]:
-                # If the segment is not in cache, load it from the server
-                if segment_id not in self.shared_cache:
-                    loaded_map = server.load_map(segment_id)
-                    if loaded_map is None:
-                        continue  # Skip if there's an issue loading the map
+            if segment_id in self.session_segments[session_id]:
+                continue
 
-                    # Store the loaded map in cache
-                    self.shared_cache[segment_id] = loaded_map
+            # If the segment is not in cache, load it from the server
+            if segment_id not in self.shared_cache:
+                loaded_map = server.load_map(segment_id, lazy=self.lazy_maps)
+                if loaded_map is None:
+                    continue  # Skip if there's an issue loading the map
 
-                # Increment the reference count for the segment
-                self.reference_counts[segment_id] += 1
+                # Store the loaded map in cache
+                self.shared_cache[segment_id] = loaded_map
+                if self.lazy_maps:
+                    self.segment_tensors[segment_id] = LazySegmentTensors(segment_id, loaded_map, self.device, self.hot_frames, store_descriptors=self.store_descriptors)
+                else:
+                    self.segment_tensors[segment_id] = SegmentTensors(segment_id, loaded_map, self.device, store_descriptors=self.store_descriptors)
 
-                # Add the segment_id to the session's loaded segments
-                self.session_segments[session_id].add(segment_id)
+            # Increment the reference count for the segment
+            self.reference_counts[segment_id] += 1
 
-            # Access the map data for the current segment from cache
-            cached_map = self.shared_cache[segment_id]
+            # Add the segment_id to the session's loaded segments
+            self.session_segments[session_id].add(segment_id)
 
-            # Merge the frames in 'perspective_frames' for this building and floor
-            for frame_name, frame_data in cached_map['perspective_frames'].items():
-                combined_segments[building_floor]['perspective_frames'][frame_name] = frame_data
+    def _merge_segments(self, segment_ids):
+        """
+        Merge the cached map data of segments of one building and floor into one combined map data.
+        """
+        combined = {
+            'T': None,
+            'rot_base': None,
+            'perspective_frames': {},  # Use the same structure as in load_data
+        }
+        for segment_id in segment_ids:
+            cached_map = self.shared_cache[segment_id]
+            combined['perspective_frames'].update(cached_map['perspective_frames'])
 
             # Set 'T' and 'rot_base' only once, as they are the same for all segments in this building and floor
-            if combined_segments[building_floor]['T'] is None:
-                combined_segments[building_floor]['T'] = cached_map['T']
-                combined_segments[building_floor]['rot_base'] = cached_map['rot_base']
-
-        return combined_segments[list(combined_segments.keys())[0]]
+            if combined['T'] is None:
+                combined['T'] = cached_map['T']
+                combined['rot_base'] = cached_map['rot_base']
+        return combined
 
     def release_segments(self, session_id, segment_ids):
         """
@@ -77,6 +92,10 @@ class CacheManager:
         if not isinstance(segment_ids, list):
             segment_ids = [segment_ids]
         
+        with self.lock:
+            self._release_segments(session_id, segment_ids)
+
+    def _release_segments(self, session_id, segment_ids):
         for segment_id in segment_ids:
             if segment_id in self.session_segments[session_id]:
                 if segment_id in self.reference_counts:
@@ -85,7 +104,42 @@ class CacheManager:
                     # If no user is using the segment, remove it from the cache
                     if self.reference_counts[segment_id] == 0:
                         del self.shared_cache[segment_id]
+                        self.segment_tensors.pop(segment_id).close()
                         del self.reference_counts[segment_id]
+                        self._drop_map_views(segment_id)
 
                 # Remove the segment from the session's loaded segments
                 self.session_segments[session_id].remove(segment_id)
+
+    def get_map_view(self, server, session_id, segment_ids):
+        """
+        Load the segments for the session and return the shared MapView of the resulting cluster.
+        Segments are only loaded when the session asks for segments it does not hold yet, and the
+        view is looked up by its segment ids, so a session staying on its cluster does no merge work.
+        The view is built only the first time this cluster composition is requested.
+        Like the merged map data it replaces, the view only covers the building and floor of the
+        first segment, neighbours on other floors are loaded but have their own T and rot_base.
+        """
+        if not isinstance(segment_ids, list):
+            segment_ids = [segment_ids]
+
+        with self.lock:
+            if not self.session_segments[session_id].issuperset(segment_ids):
+                self.load_segments(server, session_id, segment_ids)
+
+            # Segments that failed to load are left out of the cluster, the floor keeps the key unambiguous
+            floor = building_floor(segment_ids[0])
+            key = tuple(sorted({segment_id for segment_id in segment_ids if segment_id in self.shared_cache and building_floor(segment_id) == floor}))
+
+            map_view = self.map_views.get(key)
+            if map_view is None:
+                map_view = MapView(key, self._merge_segments(key), [self.segment_tensors[segment_id] for segment_id in key], self.device)
+                self.map_views[key] = map_view
+            return map_view
+
+    def _drop_map_views(self, segment_id):
+        """
+        Forget every map view built on top of an evicted segment.
+        """
+        for key in [key for key in self.map_views if segment_id in key]:
+            del self.map_views[key]
@@ -9,7 +9,10 @@ import matplotlib.pyplot as plt
 import json
 import h5py
 import torch
+import threading
 from collections import defaultdict
+from .packed_map import load_packed_map, PACKED_SUFFIX
+from .navigation_cache import NavigationCache
 
 def load_destination(path):
     with open(path, 'r') as f:
@@ -34,6 +37,114 @@ def load_boundaires(path):
             anchor_location.append(v['location'])
     return anchor_name,anchor_location,lines
 
+def read_frame_features(frame_group):
+    """
+    Read the local features and landmarks of one frame group of a segment .h5 file.
+    """
+    local_features_group = frame_group['local_features']
+    return {
+        'local_features': {
+            'keypoints': local_features_group['keypoints'][:],
+            'descriptors': local_features_group['descriptors'][:],
+            'image_size': local_features_group['image_size'][:],
+            'scores': local_features_group['scores'][:],
+            'valid_keypoints_index': local_features_group['valid_keypoints_index'][:]
+        },
+        'landmarks': frame_group['landmarks'][:]
+    }
+
+class LazySegmentReader:
+    """
+    Keeps a segment .h5 file open and reads the local features of single frames on demand.
+    h5py only reads the chunks of the requested datasets, so nothing but metadata is touched
+    until a frame is actually matched.
+    """
+    def __init__(self, segment_file):
+        self.segment_file = segment_file
+        self.h5_file = h5py.File(segment_file, 'r')
+        self.lock = threading.Lock()
+
+    def num_keypoints(self, group_name):
+        with self.lock:
+            return self.h5_file[group_name]['local_features']['keypoints'].shape[0]
+
+    def descriptor_dim(self, group_name):
+        with self.lock:
+            return self.h5_file[group_name]['local_features']['descriptors'].shape[0]
+
+    def read_frame(self, group_name):
+        with self.lock:
+            return read_frame_features(self.h5_file[group_name])
+
+    def close(self):
+        with self.lock:
+            if self.h5_file:
+                self.h5_file.close()
+                self.h5_file = None
+
+def load_h5_map(segment_file, segment_id, building, floor, lazy=False):
+    """
+    Read a Segment_XXXXX.h5 file into the map_data structure used by the cache.
+    With lazy=True local features and landmarks are left on disk behind a LazySegmentReader.
+    """
+    # Initialize a dictionary to store the loaded map data
+    map_data = {
+        'T': None,
+        'rot_base': None,
+        'perspective_frames': {},
+    }
+
+    reader = None
+    try:
+        if lazy:
+            reader = LazySegmentReader(segment_file)
+            h5_file = reader.h5_file
+        else:
+            h5_file = h5py.File(segment_file, 'r')
+
+        try:
+            # Load transformation matrix T
+            map_data['T'] = h5_file['T'][:]
+
+            # Calculate 'rot_base' for future usage (if necessary)
+            T = np.array(map_data['T'])
+            map_data['rot_base'] = np.arctan2(T[1, 0], T[0, 0])
+
+            # Iterate over all the frame groups
+            for frame_name in h5_file.keys():
+                if frame_name == 'T':
+                    continue  # Skip the transformation matrix
+
+                # Load the frame data for each frame
+                frame_group = h5_file[frame_name]
+
+                frame_data = {
+                    'segment_id': segment_id,
+                    'group': frame_name,
+                    'global_descriptor': frame_group['global_descriptor'][:],
+                    'frame_pose': frame_group['frame_pose'][:]
+                }
+
+                # Local features and landmarks are read on demand in lazy mode
+                if not lazy:
+                    frame_data.update(read_frame_features(frame_group))
+
+                # Add the frame data into the map data dictionary
+                map_data['perspective_frames'][f'{building}_{floor}_{frame_name}'] = frame_data
+        finally:
+            if not lazy:
+                h5_file.close()
+
+        if lazy:
+            map_data['reader'] = reader
+
+        return map_data
+
+    except Exception:
+        if reader is not None:
+            reader.close()
+        raise
+
 class DataHandler:
     def __init__(self, new_root_dir, place):
         self.new_root_dir = new_root_dir
@@ -165,9 +276,15 @@ class DataHandler:
         return all_buildings_data, all_interwaypoint_connections
 
     def _load_global_graph(self):
-        # Load all buildings and floors
+        # Load all buildings and floors, from the navigation cache when the inputs did not change
         base_directory = join(self.new_root_dir, 'data', self.place)
+        self.navigation_cache = NavigationCache(base_directory)
+        cached_graph = self.navigation_cache.get('graph')
+        if cached_graph is not None:
+            return cached_graph
+
         all_buildings_data, all_interwaypoint_connections = self._load_all_buildings(base_directory)
+        self.navigation_cache.set('graph', (all_buildings_data, all_interwaypoint_connections))
         return all_buildings_data, all_interwaypoint_connections
 
     def load_graph(self, building, floor):
@@ -176,11 +293,17 @@ class DataHandler:
         access_graph = self.all_buildings_data[building][floor].get('access_graph',None)
         return destinations, waypoints, access_graph
     
-    def load_map(self, segment_id):
+    def load_map(self, segment_id, lazy=False):
         """
         Load a specific map segment from disk based on the segment ID.
         Example segment ID format: LightHouse_6_floor_Segment_00021
         Map file path example: /mnt/data/UNav-IO/data/New_York_City/LightHouse/6_floor/maps/Segment_00021.h5
+
+        With lazy=True only T and the global descriptors are read, local features and landmarks
+        stay on disk and are served by the reader stored under map_data['reader'].
+
+        A consolidated Segment_XXXXX.packed directory (see utils.packed_map) is preferred over
+        the .h5 file when present.
         """
         # Extract building, floor, and segment number from the segment_id
         building, floor, segment_number = self._get_building_floor(segment_id)
@@ -191,63 +314,15 @@ class DataHandler:
         # Define the segment file path
         segment_file = join(map_directory, f"{segment_number}.h5")
 
-
-        # Initialize a dictionary to store the loaded map data
-        map_data = {
-            'T': None,
-            'rot_base': None,
-            'perspective_frames': {},
-        }
+        packed_directory = join(map_directory, f"{segment_number}{PACKED_SUFFIX}")
+        if isdir(packed_directory):
+            try:
+                return load_packed_map(packed_directory, segment_id, building, floor, lazy=lazy)
+            except Exception as e:
+                print(f"Error loading packed map segment {packed_directory}, falling back to {segment_file}: {e}")
 
         try:
-            with h5py.File(segment_file, 'r') as h5_file:
-                # Load transformation matrix T
-                map_data['T'] = h5_file['T'][:]
-
-                # Calculate 'rot_base' for future usage (if necessary)
-                T = np.array(map_data['T'])
-                map_data['rot_base'] = np.arctan2(T[1, 0], T[0, 0])
-
-                # Iterate over all the frame groups
-                for frame_name in h5_file.keys():
-                    if frame_name == 'T':
-                        continue  # Skip the transformation matrix
-
-                    # Load the frame data for each frame
-                    frame_group = h5_file[frame_name]
-
-                    # Load global descriptor
-                    global_descriptor = frame_group['global_descriptor'][:]
-
-                    # Load local features
-                    local_features_group = frame_group['local_features']
-                    keypoints = local_features_group['keypoints'][:]
-                    descriptors = local_features_group['descriptors'][:]
-                    image_size = local_features_group['image_size'][:]
-                    scores = local_features_group['scores'][:]
-                    valid_keypoints_index = local_features_group['valid_keypoints_index'][:]
-
-                    # Load landmarks and frame pose
-                    landmarks = frame_group['landmarks'][:]
-                    frame_pose = frame_group['frame_pose'][:]
-
-                    # Add the frame data into the map data dictionary
-                    map_data['perspective_frames'][f'{building}_{floor}_{frame_name}'] = {
-                        'segment_id': segment_id,
-                        'global_descriptor': global_descriptor,
-                        'local_features': {
-                            'keypoints': keypoints,
-                            'descriptors': descriptors,
-                            'image_size': image_size,
-                            'scores': scores,
-                            'valid_keypoints_index': valid_keypoints_index
-                        },
-                        'landmarks': landmarks,
-                        'frame_pose': frame_pose
-                    }
-
-            return map_data
-
+            return load_h5_map(segment_file, segment_id, building, floor, lazy=lazy)
         except Exception as e:
             print(f"Error loading map segment {segment_file}: {e}")
             return None
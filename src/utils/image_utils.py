@@ -0,0 +1,69 @@
+import base64
+import io
+
+import cv2
+import numpy as np
+from PIL import Image
+
+FRAME_WIDTH = 640  # Width frames are resized to before localization
+PREVIEW_QUALITY = 80  # JPEG quality of the preview broadcast to monitors
+
+# cv2 flags decoding a JPEG directly at 1/2, 1/4 or 1/8 resolution (DCT scaling in libjpeg)
+_REDUCED_DECODE = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def _decode_flag(frame_bytes, width):
+    """
+    Pick the largest JPEG reduction that still decodes at least width pixels wide.
+    Only the header is parsed here, the pixels are decoded once by cv2.
+    """
+    try:
+        header = Image.open(io.BytesIO(frame_bytes))
+    except Exception:
+        return cv2.IMREAD_COLOR
+    if header.format != 'JPEG':
+        return cv2.IMREAD_COLOR
+    for factor, flag in _REDUCED_DECODE:
+        if header.size[0] // factor >= width:
+            return flag
+    return cv2.IMREAD_COLOR
+
+def decode_base64(frame_base64):
+    """
+    Decode a base64 frame, with or without a data URL prefix, into its encoded bytes.
+    """
+    return base64.b64decode(frame_base64.split(',')[1]) if ',' in frame_base64 else base64.b64decode(frame_base64)
+
+def encode_preview(image, quality=PREVIEW_QUALITY):
+    """
+    JPEG-encode a BGR frame and return it base64 encoded, as expected by the monitor pages.
+    """
+    success, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not success:
+        return None
+    return base64.b64encode(buffer).decode('utf-8')
+
+def ingest_frame(frame_bytes, width=FRAME_WIDTH, preview=False):
+    """
+    Single pass from encoded frame bytes to the model input: decode (at reduced
+    resolution when the JPEG is large enough), BGR channel order straight from
+    cv2 and one resize to the target width.
+    :param preview: Also return the base64 JPEG preview of the resized frame. Only ask for it
+                    when a monitor is subscribed, encoding is the most expensive part of ingest.
+    :return: (BGR frame or None if the bytes could not be decoded, preview or None)
+    """
+    image = cv2.imdecode(np.frombuffer(frame_bytes, dtype=np.uint8), _decode_flag(frame_bytes, width))
+    if image is None:
+        return None, None
+
+    if image.shape[1] != width:
+        height = int(width / image.shape[1] * image.shape[0])
+        image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+    return image, (encode_preview(image) if preview else None)
+
+def decode_frame(frame_bytes, width=FRAME_WIDTH):
+    """
+    Decode an encoded (JPEG/PNG) frame into a BGR numpy array resized to the given width.
+    :return: The frame, or None if the bytes could not be decoded.
+    """
+    return ingest_frame(frame_bytes, width)[0]
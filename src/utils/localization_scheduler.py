@@ -0,0 +1,187 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+class _FrameDropped:
+    def __repr__(self):
+        return 'FRAME_DROPPED'
+
+# Result of a frame that was superseded by a newer frame of the same session before it was localized,
+# a unique object so no result of handle_localization can be mistaken for it
+FRAME_DROPPED = _FrameDropped()
+
+class LocalizationScheduler:
+    """
+    Collects localization requests from all sessions into micro-batches.
+
+    Request handlers call submit() and wait on the returned future. A single
+    worker thread takes whatever is queued, waiting at most max_wait_ms for the
+    batch to fill up to max_batch_size, and hands the batch to
+    Server.handle_localization_batch so the feature extractors run once per
+    batch instead of once per frame. Since every frame goes through the worker,
+    GPU work is also serialized instead of racing between request threads.
+
+    Each session has a mailbox of one pending frame: a frame arriving while the
+    previous one is still queued replaces it (latest frame wins), and the
+    replaced frame's future resolves to FRAME_DROPPED, so a slow localization
+    never builds up a backlog of stale frames.
+    """
+    def __init__(self, server, max_batch_size=8, max_wait_ms=20, result_timeout_s=30):
+        self.server = server
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait_ms / 1000.0
+        # Longest a request handler should block on a result, see localize()
+        self.result_timeout = result_timeout_s
+
+        # session_id -> (frame, future), in order of the oldest pending frame
+        self.mailboxes = OrderedDict()
+        # (callable, future) to run on the worker between batches, see call_in_worker()
+        self.tasks = deque()
+        self.frame_counts = {}
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.worker = threading.Thread(target=self._run, name='localization-scheduler', daemon=True)
+        self.worker.start()
+
+    def submit(self, session_id, frame):
+        """
+        Queue a frame for localization, replacing the pending frame of the session if there is one.
+        :return: Future resolving to the pose_update_info of handle_localization, or FRAME_DROPPED.
+        """
+        future = Future()
+        with self.condition:
+            if not self.running:
+                raise RuntimeError("Localization scheduler is stopped.")
+            counts = self.frame_counts.setdefault(session_id, {'processed': 0, 'dropped': 0})
+            pending = self.mailboxes.get(session_id)
+            if pending is not None:
+                # Keep the session's place in line, only the frame is replaced
+                counts['dropped'] += 1
+                pending[1].set_result(FRAME_DROPPED)
+            self.mailboxes[session_id] = (frame, future)
+            self.condition.notify()
+        return future
+
+    def localize(self, session_id, frame, timeout=None):
+        """
+        Submit a frame and wait for its result, at most timeout seconds (result_timeout by default).
+        :raises RuntimeError: If the scheduler is stopped.
+        :raises concurrent.futures.TimeoutError: If no result arrived in time.
+        """
+        return self.submit(session_id, frame).result(timeout=self.result_timeout if timeout is None else timeout)
+
+    def session_stats(self, session_id):
+        """
+        Number of processed and dropped frames of a session.
+        """
+        with self.condition:
+            counts = self.frame_counts.get(session_id, {'processed': 0, 'dropped': 0})
+            return {**counts, 'pending': session_id in self.mailboxes}
+
+    def release_session(self, session_id):
+        with self.condition:
+            pending = self.mailboxes.pop(session_id, None)
+            self.frame_counts.pop(session_id, None)
+        if pending is not None:
+            pending[1].set_result(FRAME_DROPPED)
+
+    def call_in_worker(self, func):
+        """
+        Run func on the worker thread once the batch being localized, if any, is done, so it never
+        races with handle_localization_batch (e.g. to release segments a batch may still be matching).
+        Runs func right away if the scheduler is stopped, since no batch can be in flight then.
+        :return: Future resolving to the return value of func.
+        """
+        future = Future()
+        with self.condition:
+            if self.running:
+                self.tasks.append((func, future))
+                self.condition.notify()
+                return future
+        self._call(func, future)
+        return future
+
+    def _call(self, func, future):
+        try:
+            future.set_result(func())
+        except Exception as e:
+            future.set_exception(e)
+
+    def stop(self):
+        """
+        Stop accepting frames, localize the ones already queued and wait for the worker to exit.
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.worker.join()
+
+        # Nothing is left if the worker drained the mailboxes, but never leave a waiter hanging
+        with self.condition:
+            pending = list(self.mailboxes.values())
+            self.mailboxes.clear()
+        for _, future in pending:
+            future.set_result(FRAME_DROPPED)
+
+    def _next_batch(self):
+        """
+        Wait for work.
+        :return: Queued tasks, and the next batch if there are no tasks. Both are empty once stopped and drained.
+        """
+        with self.condition:
+            while self.running and not self.mailboxes and not self.tasks:
+                self.condition.wait()
+            if self.tasks:
+                tasks = list(self.tasks)
+                self.tasks.clear()
+                return tasks, []
+            if not self.mailboxes:
+                return [], []
+
+            # Give other sessions a moment to join the batch
+            deadline = time.monotonic() + self.max_wait
+            while self.running and len(self.mailboxes) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = []
+            while self.mailboxes and len(batch) < self.max_batch_size:
+                session_id, (frame, future) = self.mailboxes.popitem(last=False)
+                batch.append((session_id, frame, future))
+            return [], batch
+
+    def _run(self):
+        while True:
+            tasks, batch = self._next_batch()
+            for func, future in tasks:
+                self._call(func, future)
+            if not batch:
+                if tasks:
+                    continue
+                return
+
+            session_ids = [session_id for session_id, _, _ in batch]
+            frames = [frame for _, frame, _ in batch]
+            futures = [future for _, _, future in batch]
+
+            try:
+                results = self.server.handle_localization_batch(session_ids, frames)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            with self.condition:
+                for session_id in session_ids:
+                    if session_id in self.frame_counts:
+                        self.frame_counts[session_id]['processed'] += 1
+
+            for future, result in zip(futures, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,90 @@
+"""
+Persistent cache of the navigation data of a place.
+
+Parsing every boundaries_interwaypoint.json / access_graph.npy and running the
+per-floor shortest paths of Trajectory dominates server start-up, although the
+inputs rarely change. NavigationCache keeps the results in one pickle per place
+(data/<place>/navigation_cache.pkl), keyed on a format version and the content
+hashes of those input files, so a restart (or a Modal cold start) only pays for
+hashing the inputs when the map data has not changed.
+"""
+import hashlib
+import logging
+import os
+import pickle
+from os.path import join, isdir, exists
+
+NAVIGATION_CACHE_VERSION = 1
+NAVIGATION_CACHE_FILE = 'navigation_cache.pkl'
+NAVIGATION_INPUTS = ('boundaries_interwaypoint.json', 'access_graph.npy')
+
+def navigation_inputs(place_directory):
+    """
+    The per-floor navigation input files of a place, as paths relative to place_directory.
+    """
+    inputs = []
+    for building in sorted(os.listdir(place_directory)):
+        building_directory = join(place_directory, building)
+        if not isdir(building_directory):
+            continue
+        for floor in sorted(os.listdir(building_directory)):
+            for file_name in NAVIGATION_INPUTS:
+                if exists(join(building_directory, floor, file_name)):
+                    inputs.append(join(building, floor, file_name))
+    return inputs
+
+def input_signature(place_directory):
+    """
+    Content hash of every navigation input, any added, removed or edited file changes the signature.
+    """
+    signature = {}
+    for relative_path in navigation_inputs(place_directory):
+        sha1 = hashlib.sha1()
+        with open(join(place_directory, relative_path), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        signature[relative_path] = sha1.hexdigest()
+    return signature
+
+class NavigationCache:
+    """
+    Named entries ('graph', 'trajectory', ...) valid for one signature of the navigation inputs.
+    Entries are only returned while the signature and version match, and writes replace the file atomically.
+    """
+    def __init__(self, place_directory, cache_file=None):
+        self.place_directory = place_directory
+        self.cache_file = cache_file or join(place_directory, NAVIGATION_CACHE_FILE)
+        self.signature = input_signature(place_directory) if isdir(place_directory) else {}
+        self.entries = self._read()
+
+    def _read(self):
+        if not exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable navigation cache {self.cache_file}: {e}")
+            return {}
+
+        if cached.get('version') != NAVIGATION_CACHE_VERSION or cached.get('signature') != self.signature:
+            logging.info(f"Navigation cache {self.cache_file} is stale, recomputing")
+            return {}
+        return cached.get('entries', {})
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def set(self, name, value):
+        self.entries[name] = value
+        self._write()
+
+    def _write(self):
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                pickle.dump({'version': NAVIGATION_CACHE_VERSION, 'signature': self.signature, 'entries': self.entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            # A read-only data volume only costs the recomputation on the next start
+            logging.warning(f"Could not write navigation cache {self.cache_file}: {e}")
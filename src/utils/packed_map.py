@@ -0,0 +1,248 @@
+"""
+Consolidated ("packed") layout of a segment map.
+
+The .h5 segment maps store one group per frame with a handful of tiny datasets
+each, so loading is dominated by per-object HDF5 metadata. A packed segment is a
+directory next to the .h5 file (maps/Segment_00021.packed/) holding flat arrays
+concatenated over all frames plus offsets, readable with a few contiguous reads
+or np.memmap:
+
+    meta.json                  version, frame group names, descriptor dtype
+    T.npy                      transformation matrix
+    global_descriptors.npy     [F x Dg]
+    frame_poses.npy            [F x ...]
+    image_size.npy             [F x 2]
+    keypoint_offsets.npy       [F + 1]   frame i owns keypoints[offsets[i]:offsets[i+1]]
+    keypoints.npy              [K x 2]
+    descriptors.npy            [K x D]   float32 or float16
+    scores.npy                 [K]
+    landmark_offsets.npy       [F + 1]
+    valid_keypoints_index.npy  [L]
+    landmarks.npy              [L x 3]
+
+Convert a place once with:
+    python -m utils.packed_map /mnt/data/UNav-IO/data/New_York_City [--float16]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+from os.path import join, isdir, exists
+
+import h5py
+import numpy as np
+
+PACKED_MAP_VERSION = 1
+PACKED_SUFFIX = '.packed'
+PACKED_ARRAYS = ('T', 'global_descriptors', 'frame_poses', 'image_size', 'keypoint_offsets', 'keypoints',
+                 'descriptors', 'scores', 'landmark_offsets', 'valid_keypoints_index', 'landmarks')
+
+def read_packed_meta(packed_directory):
+    """
+    meta.json of a packed segment, raising ValueError unless the directory is a complete packed segment of this version.
+    """
+    meta_file = join(packed_directory, 'meta.json')
+    if not exists(meta_file):
+        raise ValueError(f"No meta.json in packed map {packed_directory}")
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != PACKED_MAP_VERSION:
+        raise ValueError(f"Unsupported packed map version {meta.get('version')} in {packed_directory}")
+    missing = [name for name in PACKED_ARRAYS if not exists(join(packed_directory, f'{name}.npy'))]
+    if missing:
+        raise ValueError(f"Incomplete packed map {packed_directory}, missing {missing}")
+    return meta
+
+def write_packed_segment(segment_file, packed_directory, float16=False):
+    """
+    Convert one Segment_XXXXX.h5 file into the packed layout.
+    """
+    frames = {'global_descriptors': [], 'frame_poses': [], 'image_size': [], 'keypoints': [],
+              'descriptors': [], 'scores': [], 'valid_keypoints_index': [], 'landmarks': []}
+    groups = []
+
+    with h5py.File(segment_file, 'r') as h5_file:
+        T = h5_file['T'][:]
+        for frame_name in h5_file.keys():
+            if frame_name == 'T':
+                continue
+            frame_group = h5_file[frame_name]
+            local_features_group = frame_group['local_features']
+            groups.append(frame_name)
+            frames['global_descriptors'].append(frame_group['global_descriptor'][:])
+            frames['frame_poses'].append(frame_group['frame_pose'][:])
+            frames['image_size'].append(local_features_group['image_size'][:])
+            frames['keypoints'].append(local_features_group['keypoints'][:])
+            # Stored per keypoint so a frame is one contiguous row range
+            frames['descriptors'].append(np.asarray(local_features_group['descriptors'][:]).T)
+            frames['scores'].append(local_features_group['scores'][:])
+            frames['valid_keypoints_index'].append(local_features_group['valid_keypoints_index'][:])
+            frames['landmarks'].append(frame_group['landmarks'][:])
+
+    descriptor_dtype = np.float16 if float16 else np.float32
+    # A fresh directory per write, a stale one left by an interrupted conversion is never reused
+    tmp_directory = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(packed_directory)), prefix=os.path.basename(packed_directory) + '.tmp-')
+
+    def offsets(arrays):
+        return np.concatenate([[0], np.cumsum([len(array) for array in arrays])]).astype(np.int64)
+
+    arrays = {
+        'T': np.asarray(T),
+        'global_descriptors': np.stack(frames['global_descriptors']).astype(np.float32),
+        'frame_poses': np.stack(frames['frame_poses']),
+        'image_size': np.stack(frames['image_size']),
+        'keypoint_offsets': offsets(frames['keypoints']),
+        'keypoints': np.concatenate(frames['keypoints']).astype(np.float32),
+        'descriptors': np.concatenate(frames['descriptors']).astype(descriptor_dtype),
+        'scores': np.concatenate(frames['scores']).astype(np.float32),
+        'landmark_offsets': offsets(frames['valid_keypoints_index']),
+        'valid_keypoints_index': np.concatenate(frames['valid_keypoints_index']).astype(np.int64),
+        'landmarks': np.concatenate(frames['landmarks']).astype(np.float64),
+    }
+    try:
+        for name, array in arrays.items():
+            np.save(join(tmp_directory, f'{name}.npy'), np.ascontiguousarray(array))
+
+        # meta.json last, the loader rejects a directory without it
+        with open(join(tmp_directory, 'meta.json'), 'w') as f:
+            json.dump({'version': PACKED_MAP_VERSION, 'groups': groups, 'descriptor_dtype': np.dtype(descriptor_dtype).name}, f)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+
+    # Move the old directory aside and the new one in with renames, so packed_directory is always either
+    # complete or absent (the loader then falls back to the .h5 file); the old copy is deleted afterwards
+    old_directory = None
+    if exists(packed_directory):
+        old_directory = tmp_directory + '.old'
+        os.rename(packed_directory, old_directory)
+    os.rename(tmp_directory, packed_directory)
+    if old_directory is not None:
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+class PackedSegmentReader:
+    """
+    Memory-mapped access to a packed segment. Implements the reader interface of
+    LazySegmentReader, so packed segments plug into LazySegmentTensors unchanged.
+    """
+    def __init__(self, packed_directory):
+        self.packed_directory = packed_directory
+        self.meta = read_packed_meta(packed_directory)
+
+        self.groups = self.meta['groups']
+        self.group_to_index = {group: index for index, group in enumerate(self.groups)}
+        self.lock = threading.Lock()
+
+        def load(name, mmap_mode='r'):
+            return np.load(join(packed_directory, f'{name}.npy'), mmap_mode=mmap_mode)
+
+        # Small per-frame arrays are read eagerly, per-keypoint arrays stay memory-mapped
+        self.T = load('T', None)
+        self.global_descriptors = load('global_descriptors', None)
+        self.frame_poses = load('frame_poses', None)
+        self.image_size = load('image_size', None)
+        self.keypoint_offsets = load('keypoint_offsets', None)
+        self.landmark_offsets = load('landmark_offsets', None)
+        self.keypoints = load('keypoints')
+        self.descriptors = load('descriptors')
+        self.scores = load('scores')
+        self.valid_keypoints_index = load('valid_keypoints_index')
+        self.landmarks = load('landmarks')
+
+    def num_keypoints(self, group_name):
+        index = self.group_to_index[group_name]
+        return int(self.keypoint_offsets[index + 1] - self.keypoint_offsets[index])
+
+    def descriptor_dim(self, group_name):
+        return self.descriptors.shape[1]
+
+    def read_frame(self, group_name):
+        index = self.group_to_index[group_name]
+        start, end = self.keypoint_offsets[index], self.keypoint_offsets[index + 1]
+        landmark_start, landmark_end = self.landmark_offsets[index], self.landmark_offsets[index + 1]
+        return {
+            'local_features': {
+                'keypoints': np.asarray(self.keypoints[start:end]),
+                'descriptors': np.asarray(self.descriptors[start:end]).T,
+                'image_size': self.image_size[index],
+                'scores': np.asarray(self.scores[start:end]),
+                'valid_keypoints_index': np.asarray(self.valid_keypoints_index[landmark_start:landmark_end])
+            },
+            'landmarks': np.asarray(self.landmarks[landmark_start:landmark_end])
+        }
+
+    def close(self):
+        # Dropping the references unmaps the files
+        self.keypoints = self.descriptors = self.scores = self.valid_keypoints_index = self.landmarks = None
+
+def load_packed_map(packed_directory, segment_id, building, floor, lazy=False):
+    """
+    Load a packed segment into the same map_data structure DataHandler.load_map returns.
+    """
+    reader = PackedSegmentReader(packed_directory)
+
+    map_data = {
+        'T': reader.T,
+        'rot_base': np.arctan2(reader.T[1, 0], reader.T[0, 0]),
+        'perspective_frames': {},
+    }
+
+    for index, frame_name in enumerate(reader.groups):
+        frame_data = {
+            'segment_id': segment_id,
+            'group': frame_name,
+            'global_descriptor': reader.global_descriptors[index],
+            'frame_pose': reader.frame_poses[index]
+        }
+        if not lazy:
+            frame_data.update(reader.read_frame(frame_name))
+        map_data['perspective_frames'][f'{building}_{floor}_{frame_name}'] = frame_data
+
+    if lazy:
+        map_data['reader'] = reader
+    else:
+        reader.close()
+
+    return map_data
+
+def convert_place(place_directory, float16=False, overwrite=False):
+    """
+    Convert every <building>/<floor>/maps/Segment_XXXXX.h5 of a place.
+    """
+    converted = []
+    for building in sorted(os.listdir(place_directory)):
+        building_directory = join(place_directory, building)
+        if not isdir(building_directory):
+            continue
+        for floor in sorted(os.listdir(building_directory)):
+            map_directory = join(building_directory, floor, 'maps')
+            if not isdir(map_directory):
+                continue
+            for file_name in sorted(os.listdir(map_directory)):
+                if not file_name.endswith('.h5'):
+                    continue
+                packed_directory = join(map_directory, file_name[:-len('.h5')] + PACKED_SUFFIX)
+                if exists(packed_directory) and not overwrite:
+                    try:
+                        read_packed_meta(packed_directory)
+                        continue
+                    except ValueError as e:
+                        print(f"Re-packing {packed_directory}: {e}")
+                write_packed_segment(join(map_directory, file_name), packed_directory, float16=float16)
+                converted.append(packed_directory)
+                print(f"Packed {join(map_directory, file_name)}")
+    return converted
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert segment .h5 maps of a place into the packed layout.')
+    parser.add_argument('place_directory', help='e.g. /mnt/data/UNav-IO/data/New_York_City')
+    parser.add_argument('--float16', action='store_true', help='store local descriptors as float16')
+    parser.add_argument('--overwrite', action='store_true', help='re-pack segments that are already converted')
+    args = parser.parse_args()
+    converted = convert_place(args.place_directory, float16=args.float16, overwrite=args.overwrite)
+    print(f"Packed {len(converted)} segments")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import numpy as np
+
+from utils.cache_manager import CacheManager, building_floor
+
+SIXTH = 'LightHouse_6_floor_Segment_00001'
+SIXTH_NEIGHBOUR = 'LightHouse_6_floor_Segment_00002'
+THIRD = 'LightHouse_3_floor_Segment_00001'
+
+
+def segment_map(segment_id, T):
+    frames = {}
+    for index in range(2):
+        frames[f'{segment_id}/{index}.png'] = {
+            'segment_id': segment_id,
+            'global_descriptor': np.full(4, index, dtype=np.float32),
+            'local_features': {
+                'keypoints': np.zeros((3, 2), dtype=np.float32),
+                'descriptors': np.zeros((8, 3), dtype=np.float32),
+                'scores': np.ones(3, dtype=np.float32),
+                'image_size': np.array([640, 360]),
+                'valid_keypoints_index': np.array([0, 2]),
+            },
+            'landmarks': np.zeros((2, 3)),
+        }
+    return {'T': T, 'rot_base': T[0, 0], 'perspective_frames': frames}
+
+
+class FakeServer:
+    def __init__(self, maps):
+        self.maps = maps
+        self.loads = []
+
+    def load_map(self, segment_id, lazy=False):
+        self.loads.append(segment_id)
+        return self.maps.get(segment_id)
+
+
+def fake_server():
+    return FakeServer({
+        SIXTH: segment_map(SIXTH, np.full((2, 3), 6.0)),
+        SIXTH_NEIGHBOUR: segment_map(SIXTH_NEIGHBOUR, np.full((2, 3), 6.0)),
+        # Sorts before the 6th floor segments
+        THIRD: segment_map(THIRD, np.full((2, 3), 3.0)),
+    })
+
+
+def test_building_floor():
+    assert building_floor(SIXTH) == 'LightHouse_6_floor'
+
+
+def test_two_floor_cluster_keeps_the_floor_of_the_first_segment():
+    cache = CacheManager(device='cpu')
+    server = fake_server()
+
+    map_view = cache.get_map_view(server, 'a', [SIXTH, THIRD, SIXTH_NEIGHBOUR])
+    assert map_view.key == (SIXTH, SIXTH_NEIGHBOUR)
+    assert np.all(map_view.T == 6.0)
+    assert all(map_view.segment_of(frame_name) != THIRD for frame_name in map_view.db_name)
+    assert len(map_view) == 4
+    # The neighbour on the other floor is still loaded for the session
+    assert cache.session_segments['a'] == {SIXTH, SIXTH_NEIGHBOUR, THIRD}
+
+    map_view = cache.get_map_view(server, 'b', [THIRD, SIXTH])
+    assert map_view.key == (THIRD,)
+    assert np.all(map_view.T == 3.0)
+
+
+def test_staying_on_the_cluster_reuses_the_view():
+    cache = CacheManager(device='cpu')
+    server = fake_server()
+    cluster = [SIXTH, SIXTH_NEIGHBOUR, THIRD]
+
+    map_view = cache.get_map_view(server, 'a', cluster)
+    assert cache.get_map_view(server, 'a', cluster) is map_view
+    assert cache.get_map_view(server, 'b', cluster) is map_view
+    assert sorted(server.loads) == sorted(cluster)
+    assert cache.reference_counts[SIXTH] == 2
+
+
+def test_failed_segments_are_left_out():
+    cache = CacheManager(device='cpu')
+    missing = 'LightHouse_6_floor_Segment_00009'
+    map_view = cache.get_map_view(fake_server(), 'a', [SIXTH, missing])
+    assert map_view.key == (SIXTH,)
+    assert missing not in cache.session_segments['a']
+
+
+def test_release_evicts_views_of_unused_segments():
+    cache = CacheManager(device='cpu')
+    server = fake_server()
+    cache.get_map_view(server, 'a', [SIXTH, SIXTH_NEIGHBOUR])
+    cache.get_map_view(server, 'b', [SIXTH])
+
+    cache.release_segments('a', [SIXTH, SIXTH_NEIGHBOUR])
+    assert SIXTH in cache.shared_cache and SIXTH_NEIGHBOUR not in cache.shared_cache
+    assert list(cache.map_views) == [(SIXTH,)]
@@ -0,0 +1,156 @@
+import threading
+
+import pytest
+
+from utils.localization_scheduler import LocalizationScheduler, FRAME_DROPPED
+
+TIMEOUT = 5
+
+
+class FakeServer:
+    """
+    Stands in for Server.handle_localization_batch, records every batch and
+    optionally blocks until released so frames can pile up in the mailboxes.
+    """
+    def __init__(self, block=False):
+        self.batches = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        if not block:
+            self.release.set()
+
+    def handle_localization_batch(self, session_ids, frames):
+        self.batches.append((list(session_ids), list(frames)))
+        self.entered.set()
+        self.release.wait(TIMEOUT)
+        return [{'session_id': session_id, 'frame': frame} for session_id, frame in zip(session_ids, frames)]
+
+
+def busy_scheduler(**kwargs):
+    """
+    Scheduler whose worker is stuck on a first frame of session 'busy', so submitted frames stay queued.
+    """
+    server = FakeServer(block=True)
+    scheduler = LocalizationScheduler(server, **kwargs)
+    first = scheduler.submit('busy', 0)
+    assert server.entered.wait(TIMEOUT)
+    return server, scheduler, first
+
+
+def test_frame_is_localized():
+    scheduler = LocalizationScheduler(FakeServer())
+    try:
+        assert scheduler.localize('a', 1, timeout=TIMEOUT) == {'session_id': 'a', 'frame': 1}
+        assert scheduler.session_stats('a') == {'processed': 1, 'dropped': 0, 'pending': False}
+    finally:
+        scheduler.stop()
+
+
+def test_latest_frame_wins():
+    server, scheduler, first = busy_scheduler()
+    try:
+        old = scheduler.submit('a', 1)
+        new = scheduler.submit('a', 2)
+        assert old.result(TIMEOUT) is FRAME_DROPPED
+        assert scheduler.session_stats('a') == {'processed': 0, 'dropped': 1, 'pending': True}
+
+        server.release.set()
+        assert new.result(TIMEOUT) == {'session_id': 'a', 'frame': 2}
+        assert first.result(TIMEOUT) == {'session_id': 'busy', 'frame': 0}
+        assert (['a'], [2]) in server.batches
+        assert scheduler.session_stats('a') == {'processed': 1, 'dropped': 1, 'pending': False}
+    finally:
+        server.release.set()
+        scheduler.stop()
+
+
+def test_sessions_share_a_batch():
+    server, scheduler, _ = busy_scheduler(max_batch_size=8, max_wait_ms=0)
+    try:
+        futures = [scheduler.submit(session_id, 1) for session_id in ('a', 'b', 'c')]
+        server.release.set()
+        assert [future.result(TIMEOUT)['session_id'] for future in futures] == ['a', 'b', 'c']
+        assert server.batches[1] == (['a', 'b', 'c'], [1, 1, 1])
+    finally:
+        server.release.set()
+        scheduler.stop()
+
+
+def test_release_session_resolves_pending_frame():
+    server, scheduler, _ = busy_scheduler()
+    try:
+        pending = scheduler.submit('a', 1)
+        scheduler.release_session('a')
+        assert pending.result(TIMEOUT) is FRAME_DROPPED
+        assert scheduler.session_stats('a') == {'processed': 0, 'dropped': 0, 'pending': False}
+    finally:
+        server.release.set()
+        scheduler.stop()
+    assert all('a' not in session_ids for session_ids, _ in server.batches)
+
+
+def test_stop_drains_queued_frames():
+    server, scheduler, first = busy_scheduler()
+    queued = scheduler.submit('a', 1)
+    server.release.set()
+    scheduler.stop()
+    assert first.result(TIMEOUT) == {'session_id': 'busy', 'frame': 0}
+    assert queued.result(TIMEOUT) == {'session_id': 'a', 'frame': 1}
+    assert not scheduler.worker.is_alive()
+
+
+def test_submit_after_stop_is_rejected():
+    scheduler = LocalizationScheduler(FakeServer())
+    scheduler.stop()
+    with pytest.raises(RuntimeError):
+        scheduler.submit('a', 1)
+
+
+def test_batch_errors_reach_the_waiters():
+    class FailingServer:
+        def handle_localization_batch(self, session_ids, frames):
+            return [ValueError('no map') if frame is None else frame for frame in frames]
+
+    scheduler = LocalizationScheduler(FailingServer(), max_wait_ms=0)
+    try:
+        with pytest.raises(ValueError):
+            scheduler.localize('a', None, timeout=TIMEOUT)
+        assert scheduler.localize('b', 3, timeout=TIMEOUT) == 3
+    finally:
+        scheduler.stop()
+
+
+def test_worker_calls_wait_for_the_batch_in_flight():
+    server, scheduler, first = busy_scheduler()
+    try:
+        order = []
+        task = scheduler.call_in_worker(lambda: order.append('task') or 'released')
+        first.add_done_callback(lambda _: order.append('batch'))
+        assert not task.done()
+
+        server.release.set()
+        assert task.result(TIMEOUT) == 'released'
+        assert order == ['batch', 'task']
+    finally:
+        server.release.set()
+        scheduler.stop()
+
+
+def test_worker_call_errors_reach_the_caller():
+    scheduler = LocalizationScheduler(FakeServer())
+    try:
+        with pytest.raises(KeyError):
+            scheduler.call_in_worker(lambda: {}['missing']).result(TIMEOUT)
+        assert scheduler.localize('a', 1, timeout=TIMEOUT) == {'session_id': 'a', 'frame': 1}
+    finally:
+        scheduler.stop()
+
+
+def test_stop_runs_queued_worker_calls():
+    server, scheduler, _ = busy_scheduler()
+    task = scheduler.call_in_worker(lambda: 'released')
+    server.release.set()
+    scheduler.stop()
+    assert task.result(TIMEOUT) == 'released'
+    # Nothing can race with a stopped scheduler, calls run right away
+    assert scheduler.call_in_worker(threading.current_thread).result(0) is threading.current_thread()
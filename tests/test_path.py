@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from UNav_core.src.navigation.path import Path
+from UNav_core.src.navigation.command import actions
+
+
+def scalar_actions(points, heading, scale=1):
+    """
+    Per-point loop actions() was computed with before Path.
+    """
+    xc, yc = points[0]
+    an = heading
+    action_list = []
+    for xn, yn in points[1:]:
+        distance = np.linalg.norm([xn - xc, yn - yc])
+        rot = np.arctan2(xn - xc, yn - yc) / np.pi * 180 + 180
+        rot_clock = round(((an - rot) % 360) / 30) % 12
+        if rot_clock < 1:
+            rot_clock += 12
+        action_list.append([rot_clock, distance * scale])
+        xc, yc, an = xn, yn, rot
+    return action_list, an
+
+
+@pytest.fixture
+def points():
+    return [[0, 0], [0, 10], [10, 10], [10, -5], [3, -12], [-4, 2]]
+
+
+def test_length(points):
+    path = Path(points)
+    assert len(path) == 6
+    assert path.length == pytest.approx(sum(np.hypot(*np.subtract(b, a)) for a, b in zip(points[:-1], points[1:])))
+
+
+def test_project(points):
+    path = Path(points)
+    segment, t, distance = path.project([2, 5])
+    assert (segment, t, distance) == (0, pytest.approx(0.5), pytest.approx(2))
+    segment, t, distance = path.project([5, 13])
+    assert (segment, t, distance) == (1, pytest.approx(0.5), pytest.approx(3))
+    # Beyond the end of the path the last point is the closest
+    segment, t, distance = path.project([-4, 5])
+    assert (segment, t, distance) == (4, pytest.approx(1), pytest.approx(3))
+
+
+def test_remaining_distance(points):
+    path = Path(points)
+    assert path.remaining_distance(points[0]) == pytest.approx(path.length)
+    assert path.remaining_distance(points[-1]) == pytest.approx(0)
+    assert path.remaining_distance([5, 11]) == pytest.approx(path.length - 15)
+
+
+def test_degenerate_paths():
+    assert Path([]).project([1, 1])[2] == float('inf')
+    assert Path([[1, 1]]).project([4, 5]) == (0, 0.0, pytest.approx(5))
+    assert Path([[1, 1]]).remaining_distance([4, 5]) == 0.0
+    assert Path([[1, 1]]).actions(90)[0].shape == (0, 2)
+
+
+def test_trim(points):
+    path = Path(points)
+    segment, _, _ = path.project([10, 4])
+    trimmed = path.trim([10, 4], segment)
+    assert trimmed.tolist() == [[10, 4], [10, -5], [3, -12], [-4, 2]]
+    assert trimmed.length == pytest.approx(path.remaining_distance([10, 4]))
+
+
+@pytest.mark.parametrize('heading', [0, 37.5, 90, 180, 271, 359.9])
+@pytest.mark.parametrize('scale', [1, 0.05])
+def test_actions_match_scalar_formula(points, heading, scale):
+    expected, expected_heading = scalar_actions(points, heading, scale)
+    result, final_heading = Path(points).actions(heading, scale)
+    np.testing.assert_allclose(result, expected)
+    assert final_heading == pytest.approx(expected_heading)
+
+
+def test_actions_match_scalar_formula_on_random_paths():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        points = rng.uniform(-100, 100, size=(rng.integers(2, 12), 2)).tolist()
+        heading = float(rng.uniform(0, 360))
+        expected, expected_heading = scalar_actions(points, heading, 0.1)
+        result, final_heading = Path(points).actions(heading, 0.1)
+        np.testing.assert_allclose(result, expected)
+        assert final_heading == pytest.approx(expected_heading)
+
+
+def test_actions_skip_repeated_points(points):
+    repeated = points[:2] + points[1:3] + points[2:]
+    result, final_heading = Path(repeated).actions(90)
+    expected, expected_heading = scalar_actions(points, 90)
+    np.testing.assert_allclose(result, expected)
+    assert final_heading == pytest.approx(expected_heading)
+
+
+def test_trajectory_actions_chain_headings(points):
+    trajectory = {
+        0: {'paths': points[:3], 'scale': 0.5},
+        1: {'paths': Path(points[2:]), 'scale': None},
+    }
+    first, heading = scalar_actions(points[:3], 45, 0.5)
+    second, _ = scalar_actions(points[2:], heading, 1)
+    expected = [[*action, False] for action in first] + [[*second[0], True]] + [[*action, False] for action in second[1:]]
+    result = actions(trajectory, [0, 0, 45])
+    assert [is_interwaypoint for _, _, is_interwaypoint in result] == [is_interwaypoint for _, _, is_interwaypoint in expected]
+    np.testing.assert_allclose([action[:2] for action in result], [action[:2] for action in expected])